@@ -1,9 +1,29 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+from datetime import datetime, timezone
+
 import pandas as pd
+import requests
 useeio_file = "https://pasteur.epa.gov/uploads/10.23719/1528686/SupplyChainGHGEmissionFactors_v1.2_NAICS_CO2e_USD2021.csv"
 naics_file = "https://www.census.gov/naics/2017NAICS/2017_NAICS_Index_File.xlsx"
+# Local, versioned snapshots of the merged NAICS table so it is downloaded once and can be loaded offline.
+# Same layout, versions and manifest as the catalog snapshots of parakeet (parakeet/src/catalog.py)
+snapshot_dir = os.path.join(os.path.expanduser("~"), ".cache", "caml", "naics")
+SNAPSHOT_FORMAT = 1
+
+def read_source(path):
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read()
+    res = requests.get(path)
+    res.raise_for_status()
+    return res.content
 
-def get_naics_data():
-    useeio_df = pd.read_csv(useeio_file)
+def parse_naics_data(useeio_content, naics_content):
+    useeio_df = pd.read_csv(io.BytesIO(useeio_content))
     useeio_df = useeio_df[['2017 NAICS Code', '2017 NAICS Title', 'Supply Chain Emission Factors with Margins', 'Reference USEEIO Code']]
     useeio_df = useeio_df.rename(columns={
         "2017 NAICS Code": "naics_code",
@@ -12,9 +32,8 @@ def get_naics_data():
         "Reference USEEIO Code": "bea_code",
     })
     print(useeio_df.shape)
-    useeio_df.head()
 
-    naics_df = pd.read_excel(naics_file)
+    naics_df = pd.read_excel(io.BytesIO(naics_content))
     naics_df = naics_df.rename(columns={
         "NAICS17": "naics_code",
         "INDEX ITEM DESCRIPTION": "naics_desc",
@@ -23,3 +42,92 @@ def get_naics_data():
     naics_df = pd.merge(naics_df, useeio_df, on="naics_code", how="left").dropna()
     naics_df = naics_df.groupby('naics_desc').first().reset_index()
     return naics_df
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_latest(directory=snapshot_dir):
+    path = os.path.join(directory, "latest.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+def build_naics_snapshot(directory=snapshot_dir, useeio_file=useeio_file, naics_file=naics_file):
+    """Download the sources and store the merged table as `<directory>/<version>/data.parquet` with a manifest.
+    The version is derived from the source checksums and becomes the latest snapshot."""
+    sources = {"useeio_file": useeio_file, "naics_file": naics_file}
+    contents = {key: read_source(path) for key, path in sources.items()}
+    checksums = {key: hashlib.sha256(content).hexdigest() for key, content in contents.items()}
+    version = hashlib.sha256(json.dumps({"name": "naics", "format": SNAPSHOT_FORMAT, "sources": checksums}, sort_keys=True).encode()).hexdigest()[:12]
+    version_dir = os.path.join(directory, version)
+    if not os.path.exists(os.path.join(version_dir, "manifest.json")):
+        naics_df = parse_naics_data(contents["useeio_file"], contents["naics_file"])
+        # Written to a directory of this process first, so a reader never sees a partial snapshot
+        tmp_dir = f"{version_dir}.tmp{os.getpid()}"
+        os.makedirs(tmp_dir, exist_ok=True)
+        naics_df.to_parquet(os.path.join(tmp_dir, "data.parquet"), index=False)
+        manifest = {
+            "name": "naics",
+            "version": version,
+            "format": SNAPSHOT_FORMAT,
+            "created": datetime.now(timezone.utc).isoformat(),
+            "sources": [{"key": key, "path": sources[key], "sha256": checksums[key], "bytes": len(contents[key])} for key in sources],
+            "rows": len(naics_df),
+            "columns": {col: str(dtype) for col, dtype in naics_df.dtypes.items()},
+            "data_sha256": sha256_file(os.path.join(tmp_dir, "data.parquet")),
+        }
+        with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+        try:
+            os.rename(tmp_dir, version_dir)
+        except OSError:
+            # Another process built the same version first
+            shutil.rmtree(tmp_dir)
+    latest_file = os.path.join(directory, "latest.json")
+    with open(f"{latest_file}.tmp{os.getpid()}", "w") as f:
+        json.dump({"version": version, "sources": sources}, f, indent=2)
+    os.replace(f"{latest_file}.tmp{os.getpid()}", latest_file)
+    return version
+
+def load_naics_snapshot(directory=snapshot_dir, version=None):
+    if version is None:
+        latest = read_latest(directory)
+        if latest is None:
+            raise FileNotFoundError(f"No NAICS snapshot in {directory}, build it with build_naics_snapshot()")
+        version = latest["version"]
+    version_dir = os.path.join(directory, version)
+    with open(os.path.join(version_dir, "manifest.json"), "r") as f:
+        manifest = json.load(f)
+    if sha256_file(os.path.join(version_dir, "data.parquet")) != manifest["data_sha256"]:
+        raise ValueError(f"NAICS snapshot {version} does not match its checksum, rebuild it with build_naics_snapshot()")
+    return pd.read_parquet(os.path.join(version_dir, "data.parquet"))
+
+def is_current(directory, sources):
+    # The latest snapshot is current if it was built from these sources and the local ones haven't changed since
+    latest = read_latest(directory)
+    if latest is None or latest["sources"] != sources:
+        return False
+    manifest_file = os.path.join(directory, latest["version"], "manifest.json")
+    if not os.path.exists(manifest_file):
+        return False
+    with open(manifest_file, "r") as f:
+        manifest = json.load(f)
+    # Snapshots of an earlier format are rebuilt
+    if manifest.get("format") != SNAPSHOT_FORMAT:
+        return False
+    checksums = {x["key"]: x["sha256"] for x in manifest["sources"]}
+    return all(sha256_file(path) == checksums.get(key) for key, path in sources.items() if os.path.exists(path))
+
+def get_naics_data(directory=snapshot_dir, version=None, offline=False, rebuild=False, useeio_file=useeio_file, naics_file=naics_file):
+    """Merged NAICS table from the local snapshot, downloading and building it first if there is none for the sources."""
+    sources = {"useeio_file": useeio_file, "naics_file": naics_file}
+    if version is None and (rebuild or not is_current(directory, sources)):
+        if offline:
+            raise FileNotFoundError(f"No NAICS snapshot of {sources} in {directory} and running offline")
+        version = build_naics_snapshot(directory, useeio_file, naics_file)
+    return load_naics_snapshot(directory, version)
@@ -0,0 +1,137 @@
+'''
+Port of parakeet/src/encoders.py, the canonical implementation, for the caml package: fixes go there first
+and are ported here. This copy keeps its exports in the caml cache, exports in __init__ instead of on the
+first encode, and returns torch tensors with convert_to_tensor like SentenceTransformer.encode.
+'''
+import fcntl
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+
+ONNX_DIR = os.path.join(os.path.expanduser("~"), ".cache", "caml", "onnx")
+
+
+def export_onnx(model_name, directory, quantize=True):
+    '''
+    Export the transformer of a SentenceTransformer to ONNX, with its tokenizer and pooling config.
+    :parameter
+        :param model_name: string - SentenceTransformer model name or path
+        :param directory: string - output directory
+        :param quantize: bool - whether to also write a dynamically int8-quantized copy (model.int8.onnx)
+    '''
+    from sentence_transformers import SentenceTransformer, models
+
+    model = SentenceTransformer(model_name, device="cpu")
+    tokenizer = model.tokenizer
+    input_names = [x for x in ["input_ids", "attention_mask", "token_type_ids"] if x in tokenizer.model_input_names]
+    # sentence-transformers >= 3.1 keeps the pooling mode as a string
+    pooling = getattr(model[1], "pooling_mode", None) or model[1].get_pooling_mode_str()
+    if pooling not in ["cls", "max", "mean"]:
+        raise ValueError(f"Pooling mode {pooling} can't be exported to ONNX")
+    config = {
+        "input_names": input_names,
+        "pooling": pooling,
+        "normalize": any(isinstance(x, models.Normalize) for x in model),
+        "max_seq_length": model.max_seq_length,
+        "pad_id": tokenizer.pad_token_id,
+        "pad_token": tokenizer.pad_token,
+    }
+
+    class TokenEmbeddings(torch.nn.Module):
+        def __init__(self, auto_model):
+            super().__init__()
+            self.auto_model = auto_model
+
+        def forward(self, *inputs):
+            return self.auto_model(**dict(zip(input_names, inputs))).last_hidden_state
+
+    os.makedirs(directory, exist_ok=True)
+    # Written under names of this process and renamed, so a reader never sees a partial file
+    tmp = lambda name: os.path.join(directory, f"{name}.tmp{os.getpid()}")
+    sample = tokenizer(["a product description", "a naics description"], padding=True, return_tensors="pt")
+    axes = {0: "batch", 1: "sequence"}
+    with torch.no_grad():
+        torch.onnx.export(
+            TokenEmbeddings(model[0].auto_model.eval()),
+            tuple(sample[x] for x in input_names),
+            tmp("model.onnx"),
+            input_names=input_names,
+            output_names=["token_embeddings"],
+            dynamic_axes={**{x: axes for x in input_names}, "token_embeddings": axes},
+            opset_version=17,
+            dynamo=False,
+        )
+    os.replace(tmp("model.onnx"), os.path.join(directory, "model.onnx"))
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(os.path.join(directory, "model.onnx"), tmp("model.int8.onnx"), weight_type=QuantType.QInt8)
+        os.replace(tmp("model.int8.onnx"), os.path.join(directory, "model.int8.onnx"))
+    tokenizer.backend_tokenizer.save(tmp("tokenizer.json"))
+    os.replace(tmp("tokenizer.json"), os.path.join(directory, "tokenizer.json"))
+    # Written last, a directory with a config is a complete export
+    with open(tmp("config.json"), "w") as f:
+        json.dump(config, f)
+    os.replace(tmp("config.json"), os.path.join(directory, "config.json"))
+
+
+class OnnxEncoder:
+    # SentenceTransformer encoder exported to ONNX and run with ONNX Runtime on CPU. The export is cached in
+    # cache_dir; quantize uses int8 weights, intra_op_threads sets the threads of each operator (all cores by default)
+    def __init__(self, model_name, quantize=True, cache_dir=ONNX_DIR, intra_op_threads=None):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        directory = os.path.join(cache_dir, hashlib.md5(model_name.encode()).hexdigest())
+        model_file = os.path.join(directory, "model.int8.onnx" if quantize else "model.onnx")
+        os.makedirs(directory, exist_ok=True)
+        # Processes starting on a cold cache wait for the first one's export instead of exporting again
+        with open(os.path.join(directory, "lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if not os.path.exists(os.path.join(directory, "config.json")) or not os.path.exists(model_file):
+                    export_onnx(model_name, directory, quantize=quantize)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        with open(os.path.join(directory, "config.json")) as f:
+            self.config = json.load(f)
+        self.tokenizer = Tokenizer.from_file(os.path.join(directory, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=self.config["max_seq_length"])
+        self.tokenizer.enable_padding(pad_id=self.config["pad_id"], pad_token=self.config["pad_token"])
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        self.session = onnxruntime.InferenceSession(model_file, options, providers=["CPUExecutionProvider"])
+
+    def encode_batch(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        inputs = {
+            "input_ids": np.array([x.ids for x in encodings], dtype=np.int64),
+            "attention_mask": np.array([x.attention_mask for x in encodings], dtype=np.int64),
+            "token_type_ids": np.array([x.type_ids for x in encodings], dtype=np.int64),
+        }
+        token_embeddings = self.session.run(None, {x: inputs[x] for x in self.config["input_names"]})[0]
+        mask = inputs["attention_mask"][:, :, None].astype(np.float32)
+        if self.config["pooling"] == "cls":
+            embeddings = token_embeddings[:, 0]
+        elif self.config["pooling"] == "max":
+            embeddings = np.where(mask > 0, token_embeddings, -1e9).max(axis=1)
+        else:
+            embeddings = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.config["normalize"]:
+            embeddings = embeddings / np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings
+
+    def encode(self, texts, batch_size=32, convert_to_tensor=False, **kwargs):
+        texts = [str(x) for x in ([texts] if isinstance(texts, str) else texts)]
+        if not texts:
+            embeddings = np.empty((0, 0), dtype=np.float32)
+            return torch.from_numpy(embeddings) if convert_to_tensor else embeddings
+        # Batches of similar lengths need less padding
+        order = np.argsort([-len(x) for x in texts], kind="stable")
+        embeddings = np.concatenate([self.encode_batch([texts[i] for i in order[j:j + batch_size]]) for j in range(0, len(texts), batch_size)])
+        embeddings = embeddings[np.argsort(order, kind="stable")]
+        return torch.from_numpy(embeddings) if convert_to_tensor else embeddings
@@ -4,10 +4,22 @@ from sentence_transformers import (
 from torch.utils.data import DataLoader
 import pandas as pd
 import numpy as np
+import torch
+
+from .onnx_encoder import OnnxEncoder
+
+# "torch" runs the SentenceTransformer, "onnx" and "onnx-int8" an ONNX export of it with ONNX Runtime on CPU
+BACKENDS = ['torch', 'onnx', 'onnx-int8']
 
 class MLModel:
-    def __init__(self, model_name = 'all-mpnet-base-v2'):
-        self.model = SentenceTransformer(model_name)
+    def __init__(self, model_name = 'all-mpnet-base-v2', backend = 'torch', intra_op_threads = None):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
+        self.backend = backend
+        if backend == 'torch':
+            self.model = SentenceTransformer(model_name)
+        else:
+            self.model = OnnxEncoder(model_name, quantize=backend == 'onnx-int8', intra_op_threads=intra_op_threads)
     
     def compute_similarity_scores(self, product_list, naics_list):
         prod_embeddings = self.model.encode(product_list, convert_to_tensor=True)
@@ -16,24 +28,71 @@ class MLModel:
         return cosine_scores
 
     # Given an product, use model to generate embedding and return the top-20 matched NAICS descriptions
-    def rank_similarity_scores(self, df, cosine_scores, product_ix, naics_df):
-        sorted_cs, indices = cosine_scores.sort(dim=1, descending=True)
-        
-        sorted_product_cs = sorted_cs[product_ix].cpu().numpy()
-        naics_ix = indices[product_ix].cpu().numpy()
-        similarity_scores = pd.DataFrame(index=np.arange(20))
-        for i in range(20):
-            similarity_scores.loc[i,'cosine_score'] = float("{:.8f}".format(sorted_product_cs[i]))
-            similarity_scores.loc[i, 'naics_code'] = naics_df.loc[naics_ix[i], 'naics_code']
-            similarity_scores.loc[i, 'naics_desc'] = naics_df.loc[naics_ix[i], 'naics_desc']
-            similarity_scores.loc[i, 'naics_title'] = naics_df.loc[naics_ix[i], 'Title']
-            
+    def rank_similarity_scores(self, df, cosine_scores, product_ix, naics_df, k=20):
+        sorted_product_cs, naics_ix = torch.topk(cosine_scores[product_ix], k)
+        sorted_product_cs = sorted_product_cs.cpu().numpy()
+        naics_ix = naics_ix.cpu().numpy()
+
+        similarity_scores = pd.DataFrame({
+            'cosine_score': [float("{:.8f}".format(x)) for x in sorted_product_cs],
+            'naics_code': naics_df['naics_code'].to_numpy()[naics_ix].astype(float),
+            'naics_desc': naics_df['naics_desc'].to_numpy()[naics_ix],
+            'naics_title': naics_df['Title'].to_numpy()[naics_ix],
+        })
         similarity_scores['product_code'] = df.iloc[product_ix].product_code
         similarity_scores['product_text'] = df.iloc[product_ix].text_clean
         
         return similarity_scores
 
+    # Top-k NAICS description indices and scores for all products at once
+    def topk_similarity_scores(self, cosine_scores, k=20):
+        topk_cs, topk_ix = torch.topk(cosine_scores, k, dim=1)
+        return topk_cs.cpu().numpy(), topk_ix.cpu().numpy()
+
+    # Batch version of rank_similarity_scores followed by the per NAICS code aggregation used for evaluation:
+    # the top-k NAICS descriptions of every product are grouped by NAICS code, each code keeps the score of
+    # its best ranked description and the number of descriptions (votes) it got within the top-k.
+    # Returns one row per (product, NAICS code), ordered by score and votes within each product.
+    def aggregate_similarity_scores(self, df, cosine_scores, naics_df, k=20, top_n=None):
+        topk_cs, topk_ix = self.topk_similarity_scores(cosine_scores, k)
+        n_products = topk_ix.shape[0]
+
+        code_ids, codes = pd.factorize(naics_df['naics_code'])
+        product_ix = np.repeat(np.arange(n_products), topk_ix.shape[1])
+        flat_ix = topk_ix.ravel()
+        segment = product_ix * len(codes) + code_ids[flat_ix]
+
+        # Rows are laid out product by product in descending score order, so the first row of each
+        # (product, code) segment is the best ranked description of that code
+        _, first, votes = np.unique(segment, return_index=True, return_counts=True)
+        first_ix = flat_ix[first]
+
+        aggregated_scores = pd.DataFrame({
+            'product_ix': product_ix[first],
+            'naics_code': naics_df['naics_code'].to_numpy()[first_ix].astype(float),
+            'cosine_score': [float("{:.8f}".format(x)) for x in topk_cs.ravel()[first]],
+            'naics_desc': naics_df['naics_desc'].to_numpy()[first_ix],
+            'naics_title': naics_df['Title'].to_numpy()[first_ix],
+            'votes': votes,
+        })
+        order = np.lexsort((
+            aggregated_scores['naics_code'].to_numpy(),
+            -aggregated_scores['votes'].to_numpy(),
+            -aggregated_scores['cosine_score'].to_numpy(),
+            aggregated_scores['product_ix'].to_numpy(),
+        ))
+        aggregated_scores = aggregated_scores.iloc[order].reset_index(drop=True)
+        aggregated_scores['rank'] = aggregated_scores.groupby('product_ix').cumcount()
+        if top_n is not None:
+            aggregated_scores = aggregated_scores[aggregated_scores['rank'] < top_n].reset_index(drop=True)
+
+        aggregated_scores['product_code'] = df['product_code'].to_numpy()[aggregated_scores['product_ix']]
+        aggregated_scores['product_text'] = df['text_clean'].to_numpy()[aggregated_scores['product_ix']]
+        return aggregated_scores
+
     def fine_tune(self, train_df, batch_size=16, epochs=5, warmup_steps=100):
+        if self.backend != 'torch':
+            raise ValueError("Only the torch backend can be fine-tuned, export the tuned model to ONNX afterwards")
         #Define your train dataset, the dataloader and the train loss
         train_examples = [InputExample(texts=[row.naics_desc, row.product_text], label=row.label) for i, row in train_df.iterrows()]
         train_dataloader = DataLoader(train_examples, shuffle=True, batch_size=batch_size)
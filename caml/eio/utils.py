@@ -1,19 +1,26 @@
 import re
+from functools import lru_cache
+
 import nltk
-nltk.download('stopwords')
-nltk.download('wordnet')
+
+
+@lru_cache(maxsize=None)
+def english_stopwords():
+    # Read from the local NLTK data directories, without any download at import time.
+    # Fetch the corpora once with: python -m nltk.downloader stopwords wordnet
+    return frozenset(nltk.corpus.stopwords.words("english"))
 
 
 def utils_preprocess_text(
     text, 
     flg_stemm=False, 
     flg_lemm=True, 
-    lst_stopwords=nltk.corpus.stopwords.words("english")):
+    lst_stopwords=None):
     '''
     Preprocess a string.
     :parameter
         :param text: string - name of column containing text
-        :param lst_stopwords: list - list of stopwords to remove
+        :param lst_stopwords: list - list of stopwords to remove, None for the NLTK English stopwords and an empty list to keep them all
         :param flg_stemm: bool - whether stemming is to be applied
         :param flg_lemm: bool - whether lemmitisation is to be applied
     :return
@@ -25,7 +32,12 @@ def utils_preprocess_text(
     ## Tokenize (convert from string to list)
     lst_text = text.split()    
     ## remove Stopwords
-    if lst_stopwords is not None:
+    if lst_stopwords is None:
+        lst_stopwords = english_stopwords()
+    elif isinstance(lst_stopwords, str):
+        error_message = f"lst_stopwords must be a list of stopwords, not the string {lst_stopwords!r}"
+        raise ValueError(error_message)
+    if lst_stopwords:
         lst_text = [word for word in lst_text if word not in 
                     lst_stopwords]
                 
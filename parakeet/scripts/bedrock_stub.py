@@ -0,0 +1,192 @@
+"""Local stand-in for the Bedrock runtime InvokeModel API that injects throttling errors.
+
+Run it, then point generate_ranked_preds at it with dummy credentials:
+
+    python bedrock_stub.py --port 8099 --max_concurrency 4 --throttle_rate 0.1
+    AWS_ACCESS_KEY_ID=x AWS_SECRET_ACCESS_KEY=x AWS_REGION=us-east-1 \
+        python ../src/generate_ranked_preds.py --bedrock_endpoint_url http://localhost:8099 ...
+
+InvokeModelWithResponseStream is served too, as an event stream of `--stream_chunk_size` characters per delta,
+and so are the Cohere embedding models (requests with "texts"), with deterministic pseudo-random embeddings.
+"""
+import base64
+import hashlib
+import json
+import random
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+
+
+def event_message(chunk):
+    """Encode a Bedrock response stream chunk as an application/vnd.amazon.eventstream message."""
+    payload = json.dumps({"bytes": base64.b64encode(json.dumps(chunk).encode()).decode()}).encode()
+    headers = b""
+    for name, value in [(":event-type", "chunk"), (":content-type", "application/json"), (":message-type", "event")]:
+        headers += bytes([len(name)]) + name.encode() + b"\x07" + struct.pack(">H", len(value)) + value.encode()
+    prelude = struct.pack(">II", 16 + len(headers) + len(payload), len(headers))
+    message = prelude + struct.pack(">I", zlib.crc32(prelude)) + headers + payload
+    return message + struct.pack(">I", zlib.crc32(message))
+
+
+class StubState:
+    def __init__(self, max_concurrency, requests_per_minute, throttle_rate, latency, reply, stream_chunk_size=8, stream_delay=0.01, embedding_dim=1024):
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.throttle_rate = throttle_rate
+        self.latency = latency
+        self.reply = reply
+        self.stream_chunk_size = stream_chunk_size
+        self.stream_delay = stream_delay
+        self.embedding_dim = embedding_dim
+        self.in_flight = 0
+        self.recent = deque()
+        self.lock = threading.Lock()
+        self.counts = {"ok": 0, "throttled": 0, "streams_closed_early": 0, "embedded_texts": 0}
+
+    def admit(self):
+        with self.lock:
+            now = time.monotonic()
+            while self.recent and self.recent[0] < now - 60:
+                self.recent.popleft()
+            throttled = (
+                (self.max_concurrency and self.in_flight >= self.max_concurrency)
+                or (self.requests_per_minute and len(self.recent) >= self.requests_per_minute)
+                or random.random() < self.throttle_rate
+            )
+            if throttled:
+                self.counts["throttled"] += 1
+                return False
+            self.in_flight += 1
+            self.recent.append(now)
+            return True
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+            self.counts["ok"] += 1
+
+
+# Most texts per request accepted by the Cohere embed models
+MAX_EMBED_TEXTS = 96
+
+
+def fake_embedding(text, dim):
+    rng = random.Random(hashlib.md5(text.encode()).hexdigest())
+    return [rng.gauss(0, 1) for _ in range(dim)]
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        # Chunked transfer encoding, so that the client gets every event of a stream as soon as it is sent
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, status, payload, headers=()):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in headers:
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if not state.admit():
+                self._send(429, {"message": "Too many requests, please wait before trying again."}, [("x-amzn-ErrorType", "ThrottlingException")])
+                return
+            try:
+                time.sleep(random.uniform(0.5, 1.5) * state.latency)
+                if "texts" in request:
+                    self._embed(request["texts"])
+                    return
+                input_tokens = len(json.dumps(request.get("messages", []))) // 4
+                if self.path.endswith("/invoke-with-response-stream"):
+                    self._stream(input_tokens)
+                    return
+                self._send(
+                    200,
+                    {
+                        "id": "stub",
+                        "type": "message",
+                        "role": "assistant",
+                        "content": [{"type": "text", "text": state.reply}],
+                        "stop_reason": "end_turn",
+                        "usage": {"input_tokens": input_tokens, "output_tokens": len(state.reply) // 4},
+                    },
+                )
+            finally:
+                state.release()
+
+        def _embed(self, texts):
+            if len(texts) > MAX_EMBED_TEXTS:
+                message = f"texts must contain at most {MAX_EMBED_TEXTS} items, got {len(texts)}"
+                self._send(400, {"message": message}, [("x-amzn-ErrorType", "ValidationException")])
+                return
+            with state.lock:
+                state.counts["embedded_texts"] += len(texts)
+            self._send(200, {"id": "stub", "texts": texts, "embeddings": [fake_embedding(x, state.embedding_dim) for x in texts]})
+
+        def _stream(self, input_tokens):
+            reply = state.reply
+            chunks = [
+                {"type": "message_start", "message": {"id": "stub", "type": "message", "role": "assistant", "content": [], "usage": {"input_tokens": input_tokens, "output_tokens": 0}}},
+                {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+                *[
+                    {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": reply[i : i + state.stream_chunk_size]}}
+                    for i in range(0, len(reply), state.stream_chunk_size)
+                ],
+                {"type": "content_block_stop", "index": 0},
+                {"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": len(reply) // 4}},
+                {"type": "message_stop"},
+            ]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/vnd.amazon.eventstream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for chunk in chunks:
+                    message = event_message(chunk)
+                    self.wfile.write(f"{len(message):x}\r\n".encode() + message + b"\r\n")
+                    self.wfile.flush()
+                    time.sleep(state.stream_delay)
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # The client stopped reading, like a caller that got what it needed
+                with state.lock:
+                    state.counts["streams_closed_early"] += 1
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+@click.command()
+@click.option("--port", type=int, default=8099)
+@click.option("--max_concurrency", help="Throttle requests beyond this many in flight, 0 for no limit.", type=int, default=4)
+@click.option("--requests_per_minute", help="Throttle requests beyond this many per minute, 0 for no limit.", type=int, default=0)
+@click.option("--throttle_rate", help="Fraction of the requests throttled at random.", type=float, default=0.0)
+@click.option("--latency", help="Mean latency of a successful request in seconds.", type=float, default=0.2)
+@click.option("--reply", help="Text returned by every successful request.", default="[]")
+@click.option("--stream_chunk_size", help="Characters per delta of a streamed response.", type=int, default=8)
+@click.option("--stream_delay", help="Seconds between the events of a streamed response.", type=float, default=0.01)
+@click.option("--embedding_dim", help="Dimension of the embeddings returned to the Cohere embedding requests.", type=int, default=1024)
+def main(port, max_concurrency, requests_per_minute, throttle_rate, latency, reply, stream_chunk_size, stream_delay, embedding_dim):
+    state = StubState(max_concurrency, requests_per_minute, throttle_rate, latency, reply, stream_chunk_size, stream_delay, embedding_dim)
+    server = ThreadingHTTPServer(("localhost", port), make_handler(state))
+    print(f"Bedrock stub listening on http://localhost:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(state.counts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Startup-time budget check of generate_ranked_preds.py.
+
+Starts the CLI in fresh processes and fails if the median wall time exceeds the budget, or if one of the heavy
+dependencies that only the model stages need gets imported. Without arguments it times `--help`; pass the
+arguments of a run whose output is already complete to time the cold start of a fully cached resume:
+
+    python check_startup_time.py --budget 5 -- --lca_type eio --activity_file acts.csv \
+        --activity_col "['COMMODITY_DESCRIPTION']" --output_file out/eio --offline
+"""
+import logging
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+
+logger = logging.getLogger("eifmap")
+logging.basicConfig(level=logging.INFO)
+
+SCRIPT = os.path.join(os.path.dirname(__file__), "..", "src", "generate_ranked_preds.py")
+# Imported lazily by the stages that need them, a cached run must not pay for them
+HEAVY_MODULES = ["torch", "sentence_transformers", "transformers", "cohere_aws", "langchain", "langchain_community", "nltk", "spacy"]
+
+
+def run_once(args):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", SCRIPT, *args], capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        error_message = f"generate_ranked_preds.py {' '.join(args)} failed:\n{result.stderr[-2000:]}"
+        raise RuntimeError(error_message)
+    imported = set(re.findall(r"^import time:\s+\d+ \|\s+\d+ \|\s+(\w+)$", result.stderr, re.M))
+    return elapsed, sorted(imported.intersection(HEAVY_MODULES))
+
+
+@click.command(context_settings={"ignore_unknown_options": True})
+@click.option("--budget", help="Maximum median startup time in seconds.", type=float, default=3.0)
+@click.option("--repeat", help="Number of timed runs.", type=int, default=3)
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+def main(budget, repeat, args):
+    args = list(args) or ["--help"]
+    timings, heavy = [], set()
+    for _ in range(repeat):
+        elapsed, imported = run_once(args)
+        timings.append(elapsed)
+        heavy.update(imported)
+    median = statistics.median(timings)
+    logger.info(f"Startup of generate_ranked_preds.py {' '.join(args)}: median {median:.2f}s over {repeat} runs ({', '.join(f'{x:.2f}' for x in timings)})")
+    failures = []
+    if heavy:
+        failures.append(f"heavy modules imported: {sorted(heavy)}")
+    if median > budget:
+        failures.append(f"median startup time {median:.2f}s is over the budget of {budget:.2f}s")
+    if failures:
+        logger.error("Startup check failed: " + "; ".join(failures))
+        sys.exit(1)
+    logger.info("Startup check passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Parity and throughput of an ONNX Runtime encoder backend against the fp32 SentenceTransformer model on CPU.
+
+Ranks a sample of reference texts for a sample of queries with both encoders and compares the top-k lists,
+then times the encoding of the references with each one:
+
+    python compare_encoders.py --embedding thenlper/gte-large --backend onnx-int8 --catalog naics \
+        --queries_file ../data/GroundTruth/parakeet_austin_GT.csv --queries_col COMMODITY_DESCRIPTION
+
+Exits with an error when the top-1 agreement or the recall@k of the backend is below the given minimums.
+"""
+import logging
+import os
+import sys
+import time
+
+import click
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+from catalog import DEFAULT_CATALOG_DIR, load_catalog
+from encoders import ENCODER_BACKENDS, OnnxEncoder
+
+logger = logging.getLogger("eifmap")
+logging.basicConfig(level=logging.INFO)
+
+# Reference texts of each catalog
+CATALOG_COLUMNS = {"naics": "naics_desc", "ecoinvent": "reference_product"}
+
+
+def normalize(embeddings):
+    return embeddings / np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+
+
+def top_k(queries, corpus, k):
+    return np.argsort(-(normalize(queries) @ normalize(corpus).T), axis=1, kind="stable")[:, :k]
+
+
+def timed_encode(encoder, texts, batch_size):
+    # The first batch pays for the lazy loading and the allocations, it is not timed
+    encoder.encode(texts[:batch_size], batch_size=batch_size)
+    start = time.perf_counter()
+    embeddings = encoder.encode(texts, batch_size=batch_size)
+    return embeddings, len(texts) / (time.perf_counter() - start)
+
+
+def compare(reference, candidate, queries, corpus, k=10, batch_size=32):
+    """Ranking parity of `candidate` against `reference` and the throughput of both, in texts per second."""
+    reference_corpus, reference_speed = timed_encode(reference, corpus, batch_size)
+    candidate_corpus, candidate_speed = timed_encode(candidate, corpus, batch_size)
+    reference_queries = reference.encode(queries, batch_size=batch_size)
+    candidate_queries = candidate.encode(queries, batch_size=batch_size)
+    reference_top = top_k(reference_queries, reference_corpus, k)
+    candidate_top = top_k(candidate_queries, candidate_corpus, k)
+    cosine = (normalize(reference_corpus) * normalize(candidate_corpus)).sum(axis=1)
+    return {
+        "queries": len(queries),
+        "corpus": len(corpus),
+        "embedding_cosine_mean": float(cosine.mean()),
+        "embedding_cosine_min": float(cosine.min()),
+        "top1_agreement": float((reference_top[:, 0] == candidate_top[:, 0]).mean()),
+        f"recall_at_{k}": float(np.mean([len(set(a) & set(b)) / k for a, b in zip(reference_top, candidate_top)])),
+        "reference_texts_per_second": reference_speed,
+        "candidate_texts_per_second": candidate_speed,
+        "speedup": candidate_speed / reference_speed,
+    }
+
+
+@click.command()
+@click.option("--embedding", help="SentenceTransformer model.", default="thenlper/gte-large")
+@click.option("--backend", help="Backend compared to the fp32 torch model.", type=click.Choice([x for x in ENCODER_BACKENDS if x != "torch"]), default="onnx-int8")
+@click.option("--intra_op_threads", help="Threads per operator, of both the torch model and ONNX Runtime.", type=int, default=None)
+@click.option("--catalog", help="Catalog snapshot whose reference texts are ranked.", type=click.Choice(list(CATALOG_COLUMNS)), default="naics")
+@click.option("--catalog_dir", help="Directory of the catalog snapshots.", default=DEFAULT_CATALOG_DIR)
+@click.option("--corpus_file", help="CSV of reference texts to rank instead of a catalog.", default=None)
+@click.option("--corpus_col", help="Text column of --corpus_file.", default=None)
+@click.option("--queries_file", help="CSV of query texts, e.g. activities. Defaults to a sample of the references.", default=None)
+@click.option("--queries_col", help="Text column of --queries_file.", default=None)
+@click.option("--corpus_size", help="Number of reference texts sampled.", type=int, default=2000)
+@click.option("--n_queries", help="Number of query texts sampled.", type=int, default=200)
+@click.option("--k", help="Length of the compared rankings.", type=int, default=10)
+@click.option("--batch_size", type=int, default=32)
+@click.option("--min_top1_agreement", type=float, default=0.95)
+@click.option("--min_recall", help="Minimum recall@k of the backend's top-k against the fp32 top-k.", type=float, default=0.95)
+def main(
+    embedding,
+    backend,
+    intra_op_threads,
+    catalog,
+    catalog_dir,
+    corpus_file,
+    corpus_col,
+    queries_file,
+    queries_col,
+    corpus_size,
+    n_queries,
+    k,
+    batch_size,
+    min_top1_agreement,
+    min_recall,
+):
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    if corpus_file:
+        corpus = pd.read_csv(corpus_file)[corpus_col]
+    else:
+        corpus = load_catalog(catalog, catalog_dir)[CATALOG_COLUMNS[catalog]]
+    corpus = corpus.dropna().astype(str).drop_duplicates()
+    corpus = corpus.sample(min(len(corpus), corpus_size), random_state=0).to_list()
+    if queries_file:
+        queries = pd.read_csv(queries_file)[queries_col].dropna().astype(str).drop_duplicates()
+        queries = queries.sample(min(len(queries), n_queries), random_state=0).to_list()
+    else:
+        queries = corpus[:n_queries]
+
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    reference = SentenceTransformer(embedding, device="cpu")
+    candidate = OnnxEncoder(embedding, quantize=backend == "onnx-int8", intra_op_threads=intra_op_threads)
+    results = compare(reference, candidate, queries, corpus, k=k, batch_size=batch_size)
+    print(pd.Series(results).to_string(float_format="{:.4f}".format))
+
+    failures = []
+    if results["top1_agreement"] < min_top1_agreement:
+        failures.append(f"top-1 agreement {results['top1_agreement']:.4f} < {min_top1_agreement}")
+    if results[f"recall_at_{k}"] < min_recall:
+        failures.append(f"recall@{k} {results[f'recall_at_{k}']:.4f} < {min_recall}")
+    if failures:
+        logger.error(f"{backend} doesn't match the fp32 rankings of {embedding}: " + "; ".join(failures))
+        sys.exit(1)
+    logger.info(f"{backend} matches the fp32 rankings of {embedding}")
+
+
+if __name__ == "__main__":
+    main()
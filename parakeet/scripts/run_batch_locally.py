@@ -0,0 +1,56 @@
+"""Local stand-in for a Bedrock batch-inference job, for small exports or to test the batch file mode.
+
+It calls InvokeModel on every record of a file written by `generate_ranked_preds.py --batch_export` and writes
+the responses in the batch-inference output format, ready for `--batch_ingest`:
+
+    python run_batch_locally.py --input_file prompts.jsonl --output_file prompts.jsonl.out
+"""
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+from assistant import get_bedrock_client
+from rate_limiter import AdaptiveRateLimiter
+
+logger = logging.getLogger("eifmap")
+logging.basicConfig(level=logging.INFO)
+
+
+@click.command()
+@click.option("--input_file", help="Batch-inference input JSONL.", required=True)
+@click.option("--output_file", help="Batch-inference output JSONL.", required=True)
+@click.option("--llm_model", default="anthropic.claude-3-sonnet-20240229-v1:0")
+@click.option("--concurrency", help="Number of concurrent Bedrock calls.", type=int, default=8)
+@click.option("--bedrock_endpoint_url", help="Call this Bedrock runtime endpoint instead of the regional one.", default=None)
+def main(input_file, output_file, llm_model, concurrency, bedrock_endpoint_url):
+    with open(input_file, "r") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    client = get_bedrock_client(max_pool_connections=concurrency, max_attempts=1, endpoint_url=bedrock_endpoint_url)
+    rate_limiter = AdaptiveRateLimiter(max_concurrency=concurrency)
+
+    def run(record):
+        def invoke():
+            response = client.invoke_model(body=json.dumps(record["modelInput"]), modelId=llm_model)
+            return json.loads(response.get("body").read())
+
+        try:
+            return {**record, "modelOutput": rate_limiter.call(invoke)}
+        except Exception as e:
+            logger.warning(f"Record {record['recordId']} failed: {e}")
+            return {**record, "error": {"errorMessage": str(e)}}
+
+    n_failed = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, open(output_file, "w") as f:
+        for result in executor.map(run, records):
+            n_failed += "error" in result
+            f.write(json.dumps(result) + "\n")
+    logger.info(f"Wrote {len(records)} responses to {output_file}, {n_failed} failed")
+
+
+if __name__ == "__main__":
+    main()
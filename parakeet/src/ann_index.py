@@ -0,0 +1,290 @@
+import hashlib
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger("eifmap")
+
+
+def normalize(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+def topk_rows(scores, k, ids=None):
+    # Best k columns of every row, ordered by descending score and then by id like a stable sort
+    k = min(k, scores.shape[1])
+    ids = np.broadcast_to(np.arange(scores.shape[1]), scores.shape) if ids is None else ids
+    # One more than k, to tell whether the k-th score is tied with columns that were left out
+    n = min(k + 1, scores.shape[1])
+    top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    top_ids = np.take_along_axis(ids, top, axis=1)
+    order = np.lexsort((top_ids, -top_scores), axis=1)
+    top_scores, top_ids = np.take_along_axis(top_scores, order, axis=1), np.take_along_axis(top_ids, order, axis=1)
+    tied = top_scores[:, k] == top_scores[:, k - 1] if 0 < k < n else np.zeros(len(scores), dtype=bool)
+    top_scores, top_ids = top_scores[:, :k], top_ids[:, :k]
+    # The partition kept any of the columns tied with the k-th score, a stable sort keeps those of the first ids
+    for row in np.flatnonzero(tied):
+        order = np.lexsort((ids[row], -scores[row]))[:k]
+        top_scores[row], top_ids[row] = scores[row, order], ids[row, order]
+    return top_scores, top_ids
+
+
+class ExactIndex:
+    """Brute-force cosine search, the reference the approximate indexes are checked against."""
+
+    kind = "exact"
+
+    def __init__(self, embeddings, block_size=1024):
+        self.embeddings = normalize(embeddings)
+        self.block_size = block_size
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def search(self, query_embedding, k):
+        query_embedding = normalize(query_embedding)
+        top_scores, top_indices = [], []
+        for i in range(0, len(query_embedding), self.block_size):
+            scores, indices = topk_rows(query_embedding[i : i + self.block_size] @ self.embeddings.T, k)
+            top_scores.append(scores)
+            top_indices.append(indices)
+        return np.concatenate(top_scores), np.concatenate(top_indices)
+
+    def save(self, path):
+        pass
+
+
+class QuantizedIndex:
+    """Exact search over a float16 or int8 copy of the references, 2x/4x smaller than float32.
+
+    int8 rows are scaled by their own maximum absolute value. With `full_embeddings` (typically memory-mapped),
+    the `rescore_factor * k` best references of the quantized search are re-scored at full precision.
+    """
+
+    kind = "quantized"
+
+    def __init__(self, embeddings=None, dtype="int8", full_embeddings=None, rescore_factor=4, block_size=256, quantized=None, scales=None):
+        if dtype not in ("float16", "int8"):
+            error_message = f"Unsupported quantization: {dtype}"
+            raise ValueError(error_message)
+        self.dtype = dtype
+        if quantized is None:
+            quantized, scales = self.quantize(normalize(embeddings), dtype)
+        self.quantized = quantized
+        self.scales = scales
+        self.full_embeddings = full_embeddings
+        self.rescore_factor = rescore_factor
+        self.block_size = block_size
+
+    @staticmethod
+    def quantize(embeddings, dtype):
+        if dtype == "float16":
+            return embeddings.astype(np.float16), None
+        scales = np.maximum(np.abs(embeddings).max(axis=1), 1e-12) / 127
+        return np.round(embeddings / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+    def __len__(self):
+        return len(self.quantized)
+
+    def _topk(self, query_embedding, k, ref_block_size=2048):
+        # References are dequantized a small block at a time and merged into a running top-k, so neither a
+        # float32 copy of the matrix nor a full (queries x references) score matrix is ever built
+        top_scores = np.empty((len(query_embedding), 0), dtype=np.float32)
+        top_indices = np.empty((len(query_embedding), 0), dtype=np.int64)
+        buffer = np.empty((min(ref_block_size, len(self.quantized)), self.quantized.shape[1]), dtype=np.float32)
+        for i in range(0, len(self.quantized), ref_block_size):
+            block = buffer[: len(self.quantized[i : i + ref_block_size])]
+            block[...] = self.quantized[i : i + ref_block_size]
+            scores = query_embedding @ block.T
+            if self.scales is not None:
+                scores *= self.scales[i : i + ref_block_size]
+            ids = np.broadcast_to(np.arange(i, i + len(block)), scores.shape)
+            top_scores, top_indices = topk_rows(
+                np.concatenate([top_scores, scores], axis=1), k, ids=np.concatenate([top_indices, ids], axis=1)
+            )
+        return top_scores, top_indices
+
+    def search(self, query_embedding, k):
+        query_embedding = normalize(query_embedding)
+        rescore = self.full_embeddings is not None and self.rescore_factor
+        top_scores, top_indices = [], []
+        for i in range(0, len(query_embedding), self.block_size):
+            queries = query_embedding[i : i + self.block_size]
+            scores, indices = self._topk(queries, k * self.rescore_factor if rescore else k)
+            if rescore:
+                shortlist = np.asarray(self.full_embeddings[np.unique(indices)])
+                position = np.searchsorted(np.unique(indices), indices)
+                exact = np.einsum("qd,qsd->qs", queries, shortlist[position])
+                scores, indices = topk_rows(exact, k, ids=indices)
+            top_scores.append(scores)
+            top_indices.append(indices)
+        return np.concatenate(top_scores), np.concatenate(top_indices)
+
+    def save(self, path):
+        np.savez(path, quantized=self.quantized, scales=self.scales if self.scales is not None else np.empty(0, dtype=np.float32))
+
+    @classmethod
+    def load(cls, path, dtype, full_embeddings=None, rescore_factor=4):
+        with np.load(path) as data:
+            scales = data["scales"] if data["scales"].size else None
+            return cls(dtype=dtype, full_embeddings=full_embeddings, rescore_factor=rescore_factor, quantized=data["quantized"], scales=scales)
+
+
+class IVFIndex:
+    """Inverted-file index: references are clustered with spherical k-means, a query only scores the
+    references of its `n_probe` closest clusters."""
+
+    kind = "ivf"
+
+    def __init__(self, embeddings, n_lists=None, n_probe=16, n_iter=10, seed=0, centroids=None, assignments=None):
+        self.embeddings = normalize(embeddings)
+        self.n_probe = n_probe
+        if centroids is None:
+            n_lists = n_lists or max(1, int(4 * np.sqrt(len(self.embeddings))))
+            centroids, assignments = self._kmeans(n_lists, n_iter, seed)
+        self.centroids = centroids
+        self.assignments = assignments
+        self.order = np.argsort(assignments, kind="stable")
+        self.offsets = np.searchsorted(assignments[self.order], np.arange(len(centroids) + 1))
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def _assign(self, centroids, block_size=4096):
+        return np.concatenate(
+            [np.argmax(self.embeddings[i : i + block_size] @ centroids.T, axis=1) for i in range(0, len(self.embeddings), block_size)]
+        )
+
+    def _kmeans(self, n_lists, n_iter, seed):
+        rng = np.random.default_rng(seed)
+        n_lists = min(n_lists, len(self.embeddings))
+        centroids = self.embeddings[rng.choice(len(self.embeddings), n_lists, replace=False)]
+        for _ in range(n_iter):
+            assignments = self._assign(centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, self.embeddings)
+            empty = np.bincount(assignments, minlength=n_lists) == 0
+            sums[empty] = self.embeddings[rng.choice(len(self.embeddings), int(empty.sum()), replace=False)]
+            centroids = normalize(sums)
+        return centroids, self._assign(centroids)
+
+    def search(self, query_embedding, k):
+        query_embedding = normalize(query_embedding)
+        n_probe = min(self.n_probe, len(self.centroids))
+        probes = np.argpartition(-(query_embedding @ self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+        top_scores = np.full((len(query_embedding), k), -np.inf, dtype=np.float32)
+        top_indices = np.full((len(query_embedding), k), -1, dtype=np.int64)
+        for i, query in enumerate(query_embedding):
+            candidates = np.concatenate([self.order[self.offsets[x] : self.offsets[x + 1]] for x in probes[i]])
+            if not len(candidates):
+                # Every probed list is empty, the row stays padded with -1
+                continue
+            scores, indices = topk_rows((self.embeddings[candidates] @ query)[None, :], k, ids=candidates[None, :])
+            top_scores[i, : scores.shape[1]] = scores[0]
+            top_indices[i, : indices.shape[1]] = indices[0]
+        return top_scores, top_indices
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, assignments=self.assignments)
+
+    @classmethod
+    def load(cls, path, embeddings, n_probe=16):
+        with np.load(path) as data:
+            return cls(embeddings, n_probe=n_probe, centroids=data["centroids"], assignments=data["assignments"])
+
+
+class HNSWIndex:
+    """Graph index backed by the optional `hnswlib` package."""
+
+    kind = "hnsw"
+
+    def __init__(self, embeddings, ef_search=64, M=16, ef_construction=200, index=None):
+        import hnswlib
+
+        embeddings = normalize(embeddings)
+        self.n_items = len(embeddings)
+        if index is None:
+            index = hnswlib.Index(space="ip", dim=embeddings.shape[1])
+            index.init_index(max_elements=len(embeddings), M=M, ef_construction=ef_construction, random_seed=0)
+            index.add_items(embeddings, np.arange(len(embeddings)))
+        index.set_ef(max(ef_search, 1))
+        self.index = index
+
+    def __len__(self):
+        return self.n_items
+
+    def search(self, query_embedding, k):
+        k = min(k, self.n_items)
+        self.index.set_ef(max(self.index.ef, k))
+        labels, distances = self.index.knn_query(normalize(query_embedding), k=k)
+        return topk_rows(1 - distances.astype(np.float32), k, ids=labels.astype(np.int64))
+
+    def save(self, path):
+        self.index.save_index(path)
+
+    @classmethod
+    def load(cls, path, embeddings, ef_search=64):
+        import hnswlib
+
+        index = hnswlib.Index(space="ip", dim=np.asarray(embeddings).shape[1])
+        index.load_index(path, max_elements=len(embeddings))
+        return cls(embeddings, ef_search=ef_search, index=index)
+
+
+def get_ann_index(kind, embeddings, index_dir, n_lists=None, n_probe=16, ef_search=64, quantization=None, rescore_factor=4):
+    """Load the `kind` index of `embeddings` from `index_dir`, or build and persist it there."""
+    if kind not in ("exact", "ivf", "hnsw"):
+        error_message = f"Unsupported ANN index: {kind}"
+        raise ValueError(error_message)
+    if quantization and kind != "exact":
+        error_message = f"Quantized references are only supported with exact search, not {kind}."
+        raise ValueError(error_message)
+    if kind == "exact" and not quantization:
+        return ExactIndex(embeddings)
+
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    fingerprint = hashlib.md5(embeddings.tobytes()).hexdigest()
+    os.makedirs(index_dir, exist_ok=True)
+    if quantization:
+        full_embeddings = None
+        if rescore_factor:
+            # The full precision references are memory-mapped, only the re-scored shortlists are read
+            full_path = os.path.join(index_dir, f"normalized-{fingerprint}.npy")
+            if not os.path.exists(full_path):
+                np.save(full_path + ".tmp.npy", normalize(embeddings))
+                os.replace(full_path + ".tmp.npy", full_path)
+            full_embeddings = np.load(full_path, mmap_mode="r")
+        path = os.path.join(index_dir, f"{quantization}-{fingerprint}.npz")
+        if os.path.exists(path):
+            logger.info(f"Loading {quantization} references from {path}")
+            return QuantizedIndex.load(path, quantization, full_embeddings=full_embeddings, rescore_factor=rescore_factor)
+        logger.info(f"Quantizing {len(embeddings)} references to {quantization}")
+        index = QuantizedIndex(embeddings, quantization, full_embeddings=full_embeddings, rescore_factor=rescore_factor)
+    elif kind == "ivf":
+        path = os.path.join(index_dir, f"ivf-{n_lists or 'auto'}-{fingerprint}.npz")
+        if os.path.exists(path):
+            logger.info(f"Loading IVF index from {path}")
+            return IVFIndex.load(path, embeddings, n_probe=n_probe)
+        logger.info(f"Building IVF index over {len(embeddings)} references")
+        index = IVFIndex(embeddings, n_lists=n_lists, n_probe=n_probe)
+    else:
+        path = os.path.join(index_dir, f"hnsw-{fingerprint}.bin")
+        if os.path.exists(path):
+            logger.info(f"Loading HNSW index from {path}")
+            return HNSWIndex.load(path, embeddings, ef_search=ef_search)
+        logger.info(f"Building HNSW index over {len(embeddings)} references")
+        index = HNSWIndex(embeddings, ef_search=ef_search)
+    index.save(path)
+    return index
+
+
+def recall_at_k(index, embeddings, query_embedding, k):
+    """Fraction of the exact top-k references that `index` also returns in its top-k."""
+    _, exact = ExactIndex(embeddings).search(query_embedding, k)
+    _, approx = index.search(query_embedding, k)
+    hits = sum(len(set(x) & set(y)) for x, y in zip(exact.tolist(), approx.tolist()))
+    return hits / exact.size
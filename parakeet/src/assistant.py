@@ -1,31 +1,39 @@
-import ast
 import json
 import logging
 import os
 from typing import Any, Dict, Optional
 
-import boto3
 import numpy as np
 import rich.traceback
-from botocore.config import Config
-from langchain.chains import ConversationChain
-from langchain.memory import ConversationBufferMemory
-from langchain_community.llms import Bedrock
-from langchain_core.prompts import PromptTemplate
+from batch_inference import DeferredCall
+from client_pool import bedrock_clients
+from output_repair import parse_literal
 from prompts import lca_assistant_prompt, system_lca_assistant_prompt
+from stream_parser import IncrementalLiteralParser, StreamAborted, StreamParseError
 
 rich.traceback.install(show_locals=False)
 
 logger = logging.getLogger("eifmap")
 
 
+class BedrockCallError(Exception):
+    """Raised when a Bedrock call still fails after its retries, the activity is left unmapped for a later run."""
+
+
 # taken from https://github.com/ClickHouse/bedrock_rag/blob/main/bedrock.py
 def get_bedrock_client(
     assumed_role: Optional[str] = None,
     region: Optional[str] = None,
     runtime: Optional[bool] = True,
+    max_pool_connections: Optional[int] = 10,
+    max_attempts: Optional[int] = 10,
+    endpoint_url: Optional[str] = None,
+    tcp_keepalive: Optional[bool] = True,
 ):
-    """Create a boto3 client for Amazon Bedrock, with optional configuration overrides.
+    """Get a boto3 client for Amazon Bedrock, with optional configuration overrides.
+
+    Clients come from the process-wide `bedrock_clients` pool: callers with the same region, profile, role and
+    configuration share one client, its session and its connections.
 
     Parameters
     ----------
@@ -37,6 +45,15 @@ def get_bedrock_client(
         If not specified, AWS_REGION or AWS_DEFAULT_REGION environment variable will be used.
     runtime : bool, optional
         Optional choice of getting different client to perform operations with the Amazon Bedrock service.
+    max_pool_connections : int, optional
+        Maximum number of connections kept in the client's connection pool. Raise it when the client is
+        shared by more concurrent callers than the botocore default of 10.
+    max_attempts : int, optional
+        Total attempts of botocore's own retries. Use 1 when an AdaptiveRateLimiter retries the calls instead.
+    endpoint_url : str, optional
+        Optional URL of the service, e.g. a local stub that injects throttling errors.
+    tcp_keepalive : bool, optional
+        Send TCP keep-alive probes on the pooled connections, so idle ones aren't dropped between calls.
     """
 
     if region is None:
@@ -44,56 +61,66 @@ def get_bedrock_client(
     else:
         target_region = region
 
-    logger.info(f"Create new client\n  Using region: {target_region}")
-    session_kwargs = {"region_name": target_region}
-    client_kwargs = {**session_kwargs}
-
-    profile_name = os.environ.get("AWS_PROFILE")
-    if profile_name:
-        logger.info(f"  Using profile: {profile_name}")
-        session_kwargs["profile_name"] = profile_name
-
-    retry_config = Config(
-        region_name=target_region,
-        retries={
-            "max_attempts": 10,
-            "mode": "standard",
-        },
+    return bedrock_clients.client(
+        region=target_region,
+        profile=os.environ.get("AWS_PROFILE") or None,
+        role=assumed_role,
+        service_name="bedrock-runtime" if runtime else "bedrock",
+        max_pool_connections=max_pool_connections,
+        max_attempts=max_attempts,
+        endpoint_url=endpoint_url,
+        tcp_keepalive=tcp_keepalive,
     )
-    session = boto3.Session(**session_kwargs)
-
-    if assumed_role:
-        logger.info(f"  Using role: {assumed_role}", end="")
-        sts = session.client("sts")
-        response = sts.assume_role(RoleArn=str(assumed_role), RoleSessionName="langchain-llm-1")
-        logger.info(" ... successful!")
-        client_kwargs["aws_access_key_id"] = response["Credentials"]["AccessKeyId"]
-        client_kwargs["aws_secret_access_key"] = response["Credentials"]["SecretAccessKey"]
-        client_kwargs["aws_session_token"] = response["Credentials"]["SessionToken"]
-
-    if runtime:
-        service_name = "bedrock-runtime"
-    else:
-        service_name = "bedrock"
-
-    bedrock_client = session.client(service_name=service_name, config=retry_config, **client_kwargs)
-
-    logger.info("boto3 Bedrock client successfully created!")
-    logger.info(bedrock_client._endpoint)
-    return bedrock_client
 
 
 class LCAAssistant:
-    def __init__(self, llm_model="anthropic.claude-3-sonnet-20240229-v1:0"):
+    def __init__(
+        self,
+        llm_model="anthropic.claude-3-sonnet-20240229-v1:0",
+        boto3_bedrock=None,
+        max_pool_connections=10,
+        cache=None,
+        rate_limiter=None,
+        endpoint_url=None,
+        batch_exporter=None,
+        streaming=False,
+        assumed_role=None,
+        tcp_keepalive=True,
+    ):
         self.model_list = [
             "anthropic.claude-3-sonnet-20240229-v1:0"
         ]
 
         self.llm_model = llm_model
-        self.boto3_bedrock = get_bedrock_client()
+        # Optional ResponseCache, only used for the models called through the messages API
+        self.cache = cache
+        # Optional AdaptiveRateLimiter shared by every assistant of the process, it takes over botocore's retries
+        self.rate_limiter = rate_limiter
+        # Optional BatchExporter: cache misses are exported for batch inference instead of being called
+        if batch_exporter is not None and cache is None:
+            error_message = "Batch inference hands the responses over through the response cache, a batch_exporter needs a cache."
+            raise ValueError(error_message)
+        self.batch_exporter = batch_exporter
+        # Stream the responses of format="python" calls, parsing and validating them as they arrive
+        self.streaming = streaming
+        if boto3_bedrock is None:
+            boto3_bedrock = get_bedrock_client(
+                max_pool_connections=max_pool_connections,
+                max_attempts=1 if rate_limiter is not None else 10,
+                endpoint_url=endpoint_url,
+                assumed_role=assumed_role,
+                tcp_keepalive=tcp_keepalive,
+            )
+        self.boto3_bedrock = boto3_bedrock
         if self.llm_model in self.model_list:
             self.history = []
         else:
+            # langchain is only needed for the models without the messages API, and takes seconds to import
+            from langchain.chains import ConversationChain
+            from langchain.memory import ConversationBufferMemory
+            from langchain_community.llms import Bedrock
+            from langchain_core.prompts import PromptTemplate
+
             assistant_model = Bedrock(
                 model_id=llm_model,
                 client=self.boto3_bedrock,
@@ -104,39 +131,112 @@ class LCAAssistant:
             self.conversation.prompt = PromptTemplate.from_template(lca_assistant_prompt)
         logger.info("LCA Assistant initialized")
 
+    def fork(self):
+        # boto3 clients are thread-safe, the conversation history is not: every concurrent worker
+        # gets its own assistant on top of the shared client.
+        return LCAAssistant(
+            llm_model=self.llm_model,
+            boto3_bedrock=self.boto3_bedrock,
+            cache=self.cache,
+            rate_limiter=self.rate_limiter,
+            batch_exporter=self.batch_exporter,
+            streaming=self.streaming,
+        )
+
     def reset_mem(self):
         if self.llm_model in self.model_list:
             self.history = []
         else:
+            from langchain_core.prompts import PromptTemplate
+
             self.memory.clear()
             self.conversation.prompt = PromptTemplate.from_template(lca_assistant_prompt)
     
-    def chat(self, text, temperature=0.0):
+    def chat(self, text, temperature=0.0, parser=None):
         if self.llm_model in self.model_list:
             input_body = dict()
             input_body["messages"] = [{"role": "user", "content": text}]
             self.history += input_body["messages"]
 
+            # Exported calls are always keyed, their batch responses come back through the cache
+            use_cache = self.cache is not None and (self.batch_exporter is not None or self.cache.caches(temperature))
+            if use_cache:
+                cache_key = self.cache.make_key(self.llm_model, system_lca_assistant_prompt, self.history, temperature)
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    self.history.append({"role": "assistant", "content": [{"type": "text", "text": cached}]})
+                    return cached
+
+            model_input = {
+                "anthropic_version": "bedrock-2023-05-31",
+                "temperature": temperature,
+                "max_tokens": 4096,
+                "system": system_lca_assistant_prompt,
+                "messages": self.history,
+            }
+            if self.batch_exporter is not None:
+                self.batch_exporter.add(cache_key, model_input)
+                raise DeferredCall(cache_key)
+            body = json.dumps(model_input)
+
+            def invoke():
+                response = self.boto3_bedrock.invoke_model(body=body, modelId=self.llm_model)
+                return json.loads(response.get("body").read())
+
+            def invoke_stream():
+                # A retried attempt starts over from an empty response
+                parser.reset()
+                stream = self.boto3_bedrock.invoke_model_with_response_stream(body=body, modelId=self.llm_model).get("body")
+                usage = {}
+                try:
+                    for event in stream:
+                        chunk = json.loads(event["chunk"]["bytes"])
+                        if chunk["type"] == "message_start":
+                            usage.update(chunk["message"].get("usage", {}))
+                        elif chunk["type"] == "message_delta":
+                            usage.update(chunk.get("usage", {}))
+                        elif chunk["type"] == "content_block_delta":
+                            try:
+                                # Stop reading, and generating, once the literal is closed
+                                if parser.feed(chunk["delta"].get("text", "")):
+                                    break
+                            except Exception as e:
+                                raise StreamAborted(parser.text, e) from e
+                finally:
+                    stream.close()
+                if not parser.done:
+                    raise StreamAborted(parser.text, StreamParseError("The response ended before its python literal was closed."))
+                response_body = {"role": "assistant", "content": [{"type": "text", "text": parser.text[: parser.end]}]}
+                if usage:
+                    response_body["usage"] = usage
+                return response_body
+
+            if parser is not None and self.streaming:
+                invoke = invoke_stream
+
             try:
-                response = self.boto3_bedrock.invoke_model(
-                    body=json.dumps(
-                        {
-                            "anthropic_version": "bedrock-2023-05-31",
-                            "temperature": temperature,
-                            "max_tokens": 4096,
-                            "system": system_lca_assistant_prompt,
-                            "messages": self.history,
-                        }
-                    ),
-                    modelId=self.llm_model,
-                )
+                if self.rate_limiter is None:
+                    response_body = invoke()
+                else:
+                    # Bedrock reserves max_tokens up front, the usage of the response settles the estimate
+                    response_body = self.rate_limiter.call(
+                        invoke,
+                        tokens=len(body) // 4 + 4096,
+                        usage_fn=lambda x: sum(x.get("usage", {}).values()) if "usage" in x else None,
+                    )
+            except StreamAborted as e:
+                logger.warning(f"Aborted the response stream after {len(e.text)} characters: {e.error!r}")
+                # The retry prompt refers to this partial response
+                self.history.append({"role": "assistant", "content": [{"type": "text", "text": e.text or " "}]})
+                raise e.error
             except Exception as e:
-                logger.exception(e)
-                logger.exception("Returning empty string")
-                return ""
-            response_body = json.loads(response.get("body").read())
+                error_message = f"Bedrock call to {self.llm_model} failed: {e!r}"
+                raise BedrockCallError(error_message) from e
             self.history.append({key: response_body[key] for key in ["role", "content"]})
-            return response_body.get("content")[0]["text"]
+            response_text = response_body.get("content")[0]["text"]
+            if use_cache:
+                self.cache.put(cache_key, self.llm_model, response_text)
+            return response_text
 
         return self.conversation.invoke(text)["response"].strip()
 
@@ -154,10 +254,13 @@ class LCAAssistant:
         if format == "python":
             while retries > 0:
                 try:  
-                    response = self.chat(text, temperature=temperature)
-                    parsed = ast.literal_eval(response)
+                    parser = IncrementalLiteralParser(validation_fn) if self.streaming else None
+                    response = self.chat(text, temperature=temperature, parser=parser)
+                    parsed = parser.value if parser is not None and parser.done else parse_literal(response)
                     if validation_fn:
                         validation_fn(parsed)
+                except (DeferredCall, BedrockCallError):
+                    raise
                 except Exception as e:  
                     logger.exception(e)
                     logger.warning("Retrying again")
@@ -165,5 +268,5 @@ class LCAAssistant:
                     retries -= 1
                 else:
                     return parsed
-            return ast.literal_eval(self.chat(text, temperature=temperature))
+            return parse_literal(self.chat(text, temperature=temperature))
         return self.chat(text, temperature=temperature) 
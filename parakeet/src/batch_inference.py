@@ -0,0 +1,56 @@
+import json
+import logging
+import threading
+
+logger = logging.getLogger("eifmap")
+
+
+class DeferredCall(Exception):
+    """Raised instead of calling Bedrock when the prompt is exported to a batch-inference file."""
+
+
+class BatchExporter:
+    """Collects the LLM calls missing from the response cache into a Bedrock batch-inference JSONL.
+
+    Each record is `{"recordId": <cache key>, "modelInput": <InvokeModel body>}`, so the responses of the
+    batch job can be ingested into the cache under the key the assistant will look up on the next run.
+    """
+
+    def __init__(self, path, model_id):
+        self.path = path
+        self.model_id = model_id
+        self.record_ids = set()
+        self.lock = threading.Lock()
+        self.file = open(path, "w")
+
+    def add(self, record_id, model_input):
+        with self.lock:
+            if record_id in self.record_ids:
+                return
+            self.record_ids.add(record_id)
+            self.file.write(json.dumps({"recordId": record_id, "modelInput": model_input}) + "\n")
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+        logger.info(f"Exported {len(self.record_ids)} prompts for {self.model_id} to {self.path}")
+
+
+def ingest_responses(path, cache, model_id):
+    """Store the responses of a batch-inference output JSONL in the response cache, returns how many were stored."""
+    n_ingested, n_failed = 0, 0
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            model_output = record.get("modelOutput")
+            if not model_output or "error" in record:
+                n_failed += 1
+                continue
+            cache.put(record["recordId"], model_id, model_output["content"][0]["text"])
+            n_ingested += 1
+    if n_failed:
+        logger.warning(f"{n_failed} records of {path} have no response, their prompts will be exported again")
+    logger.info(f"Ingested {n_ingested} responses from {path}")
+    return n_ingested
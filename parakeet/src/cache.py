@@ -0,0 +1,107 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+from time import time
+
+logger = logging.getLogger("eifmap")
+
+
+class ResponseCache:
+    """Disk-backed cache of LLM responses, shared by every assistant (and thread) of a process.
+
+    Entries are keyed by a hash of the model id, system prompt, full message history and temperature,
+    so a hit can only replay a response to exactly the same conversation. The oldest entries are evicted
+    once the cache holds more than `max_entries`, and entries older than `max_age_days` are dropped.
+    With `refresh=True` lookups always miss, and the fresh responses overwrite the stored ones.
+    Only greedy (temperature 0) calls are cached unless `cache_sampled`: replaying a sampled response would
+    silently make every later call return the same sample.
+    """
+
+    def __init__(self, path, max_entries=1_000_000, max_age_days=None, refresh=False, cache_sampled=False):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.refresh = refresh
+        self.cache_sampled = cache_sampled
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model_id TEXT, response TEXT, created REAL, last_used REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.conn.commit()
+        self.evict()
+
+    def caches(self, temperature):
+        return temperature == 0 or self.cache_sampled
+
+    @staticmethod
+    def make_key(model_id, system, messages, temperature):
+        payload = json.dumps(
+            {"model_id": model_id, "system": system, "messages": messages, "temperature": temperature},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            min_created = time() - self.max_age_days * 86400 if self.max_age_days is not None else 0
+            row = None if self.refresh else self.conn.execute("SELECT response FROM responses WHERE key = ? AND created >= ?", (key, min_created)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time(), key))
+            self.conn.commit()
+            return row[0]
+
+    def put(self, key, model_id, response):
+        now = time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model_id, response, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, model_id, response, now, now),
+            )
+            self.conn.commit()
+            self.puts += 1
+            if self.puts % 1000 == 0:
+                self._evict()
+
+    def evict(self):
+        with self.lock:
+            self._evict()
+
+    def _evict(self):
+        if self.max_age_days is not None:
+            self.conn.execute("DELETE FROM responses WHERE created < ?", (time() - self.max_age_days * 86400,))
+        if self.max_entries:
+            self.conn.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+        self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            (size,) = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": size,
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,135 @@
+import logging
+import threading
+
+import numpy as np
+import pandas as pd
+
+from evaluate_preds import LABEL_COLUMNS, normalize_labels
+from utils import get_ranked_lists, md5_hash, render_activities
+
+logger = logging.getLogger("eifmap")
+
+# Candidate field that is the answer of the embedding match
+ANSWER_KEYS = {"eio": "naics_code", "process": "reference_product"}
+
+
+def confidence(ranked_list, scores, lca_type):
+    """Cosine score of the top candidate and its margin over the best candidate with a different answer."""
+    if len(ranked_list) == 0:
+        return 0.0, 0.0
+    key = ANSWER_KEYS[lca_type]
+    # NAICS descriptions of the same code are not competing answers
+    runner_up = next((score for x, score in zip(ranked_list[1:], scores[1:]) if x[key] != ranked_list[0][key]), scores[-1])
+    return float(scores[0]), float(scores[0] - runner_up)
+
+
+class CascadePolicy:
+    """Accepts the top embedding match without an LLM rerank when its cosine score is at least `min_score` and
+    its margin over the runner-up at least `min_margin`.
+
+    A deterministic `audit_rate` fraction of the confident activities still goes through the LLM, and the
+    agreement of the LLM with the top embedding match is tracked for them and for the other reranked
+    activities, as an estimate of the precision of the accepted ones.
+    """
+
+    def __init__(self, lca_type, min_score, min_margin=0.0, audit_rate=0.0):
+        self.key = ANSWER_KEYS[lca_type]
+        self.lca_type = lca_type
+        self.min_score = min_score
+        self.min_margin = min_margin
+        self.audit_rate = audit_rate
+        self.lock = threading.Lock()
+        self.counts = {"activities": 0, "accepted": 0, "audited": 0, "audit_agreed": 0, "reranked": 0, "rerank_agreed": 0}
+
+    def decide(self, ranked_list, scores, uniq_id):
+        """Returns "accept", "audit" or "rerank" with the confidence of the top embedding match."""
+        score, margin = confidence(ranked_list, scores, self.lca_type)
+        decision = "rerank"
+        if len(ranked_list) > 0 and score >= self.min_score and margin >= self.min_margin:
+            audited = int(md5_hash(uniq_id), 16) % 10_000 < self.audit_rate * 10_000
+            decision = "audit" if audited else "accept"
+        with self.lock:
+            self.counts["activities"] += 1
+            self.counts["accepted"] += decision == "accept"
+        return decision, score, margin
+
+    def record(self, decision, ranked_list, impact_factor_details):
+        """Track whether the LLM picked the top embedding match of an activity that went through the LLM."""
+        if decision == "accept" or len(ranked_list) == 0:
+            return
+        agreed = str(impact_factor_details.get(self.key)) == str(ranked_list[0][self.key])
+        with self.lock:
+            if decision == "audit":
+                self.counts["audited"] += 1
+                self.counts["audit_agreed"] += agreed
+            else:
+                self.counts["reranked"] += 1
+                self.counts["rerank_agreed"] += agreed
+
+    def stats(self):
+        with self.lock:
+            counts = dict(self.counts)
+
+        def ratio(a, b):
+            return round(counts[a] / counts[b], 4) if counts[b] else None
+
+        return {
+            **counts,
+            "skipped_fraction": ratio("accepted", "activities"),
+            "audit_agreement": ratio("audit_agreed", "audited"),
+            "rerank_agreement": ratio("rerank_agreed", "reranked"),
+        }
+
+
+def calibrate(scores, margins, correct, target_precision=0.95, min_support=20):
+    """Thresholds accepting the most activities with a precision of at least `target_precision`, searched over
+    a grid of quantiles. Returns (min_score, min_margin, n_accepted, precision), or None if no threshold pair
+    accepts `min_support` activities at that precision."""
+    scores, margins, correct = np.asarray(scores), np.asarray(margins), np.asarray(correct, dtype=bool)
+    quantiles = np.linspace(0, 1, 41)
+    best = None
+    for min_score in np.unique(np.quantile(scores, quantiles)):
+        for min_margin in np.unique(np.quantile(margins, quantiles)):
+            accepted = (scores >= min_score) & (margins >= min_margin)
+            n_accepted = int(accepted.sum())
+            if n_accepted < min_support:
+                continue
+            precision = float(correct[accepted].mean())
+            if precision >= target_precision and (best is None or n_accepted > best[2]):
+                best = (float(min_score), float(min_margin), n_accepted, precision)
+    return best
+
+
+def calibrate_on_ground_truth(ground_truth, activity_col, lca_type, semantic_text_model, eco_df, eco_ref, eco_ref_embedding, k=None, target_precision=0.95):
+    """Calibrate the cascade thresholds on the labeled activities of a ground truth file."""
+    gt_col, _ = LABEL_COLUMNS[lca_type]
+    gt_df = pd.read_csv(ground_truth).fillna("")
+    gt_df = gt_df[normalize_labels(gt_df[gt_col], lca_type) != ""].reset_index(drop=True)
+    labels = normalize_labels(gt_df[gt_col], lca_type)
+    if lca_type == "process":
+        # The embedding match is a reference product, the ground truth an impact factor
+        reference_products = eco_df.drop_duplicates("impact_factor_name").set_index("impact_factor_name")["reference_product"]
+        labels = labels.map(reference_products).fillna("")
+    logger.info(f"Calibrating the cascade on {len(gt_df)} labeled activities of {ground_truth}")
+
+    ranked_lists = get_ranked_lists(render_activities(gt_df[activity_col]), semantic_text_model, eco_df, eco_ref, eco_ref_embedding, lca_type, k=k)
+    key = ANSWER_KEYS[lca_type]
+    scores, margins, correct = [], [], []
+    for (ranked_list, topK_df), label in zip(ranked_lists, labels):
+        score, margin = confidence(ranked_list, topK_df["cosine_score"].to_numpy(), lca_type)
+        scores.append(score)
+        margins.append(margin)
+        top = normalize_labels(pd.Series([ranked_list[0][key]]), lca_type)[0] if ranked_list else ""
+        correct.append(top != "" and top == label)
+    logger.info(f"Top embedding match accuracy: {np.mean(correct):.3f}")
+
+    best = calibrate(scores, margins, correct, target_precision)
+    if best is None:
+        logger.warning(f"No thresholds reach a precision of {target_precision} on {ground_truth}, the cascade would accept nothing")
+        return None
+    min_score, min_margin, n_accepted, precision = best
+    logger.info(
+        f"Cascade thresholds: --cascade_min_score {min_score:.4f} --cascade_min_margin {min_margin:.4f} "
+        f"accept {n_accepted}/{len(gt_df)} activities ({n_accepted / len(gt_df):.1%}) with a precision of {precision:.3f}"
+    )
+    return best
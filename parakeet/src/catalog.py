@@ -0,0 +1,230 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+from datetime import datetime, timezone
+
+import click
+import numpy as np
+import pandas as pd
+
+from utils import parse_ecoinvent_data, parse_naics_data, read_source, setup_logging
+
+logger = logging.getLogger("eifmap")
+
+SNAPSHOT_FORMAT = 1
+
+DEFAULT_CATALOG_DIR = os.path.join(os.path.expanduser("~"), ".cache", "parakeet", "catalogs")
+
+DEFAULT_SOURCES = {
+    "ecoinvent": {
+        "ecoinvent_file": "https://19913970.fs1.hubspotusercontent-na1.net/hubfs/19913970/Database-Overview-for-ecoinvent-v3.9.1-9.xlsx",
+    },
+    "naics": {
+        "useeio_file": "https://pasteur.epa.gov/uploads/10.23719/1528686/SupplyChainGHGEmissionFactors_v1.2_NAICS_CO2e_USD2021.csv",
+        "naics_file": "https://www.census.gov/naics/2017NAICS/2017_NAICS_Index_File.xlsx",
+    },
+}
+
+
+class ReferenceCatalog:
+    """A loaded reference frame with hash indexes from the values of its key columns to their rows.
+
+    `lookup` returns the same rows, in the same order and with the same index labels, as concatenating
+    `df[df[column] == value]` over the values, without scanning the frame.
+    """
+
+    index_columns = ("reference_product", "naics_code")
+
+    def __init__(self, df, index_columns=None):
+        self.df = df
+        self.positions = {}
+        for col in index_columns or self.index_columns:
+            if col in df.columns:
+                self.positions[col] = df.groupby(col, sort=False).indices
+
+    def __len__(self):
+        return len(self.df)
+
+    def rows(self, column, value):
+        """Positions of the rows whose `column` equals `value`."""
+        if column not in self.positions:
+            error_message = f"Column {column} is not indexed, indexed columns: {list(self.positions)}"
+            raise KeyError(error_message)
+        try:
+            return self.positions[column].get(value, np.empty(0, dtype=np.int64))
+        except TypeError:
+            # Unhashable values can't match any row
+            return np.empty(0, dtype=np.int64)
+
+    def lookup(self, column, values):
+        positions = [self.rows(column, value) for value in values]
+        return self.df.iloc[np.concatenate(positions) if positions else []]
+
+
+def parse_catalog(name, contents):
+    if name == "ecoinvent":
+        return parse_ecoinvent_data(contents["ecoinvent_file"])
+    if name == "naics":
+        return parse_naics_data(contents["useeio_file"], contents["naics_file"])
+    error_message = f"Unknown catalog: {name}"
+    raise ValueError(error_message)
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _arrow_compatible(df):
+    # Spreadsheet columns can mix numbers and strings, which Parquet can't store in one column
+    df = df.copy()
+    for col in df.columns[df.dtypes == object]:
+        if pd.api.types.infer_dtype(df[col], skipna=True) not in ("string", "empty"):
+            df[col] = df[col].map(lambda x: x if pd.isna(x) else str(x))
+    return df
+
+
+def _latest_file(name, catalog_dir):
+    return os.path.join(catalog_dir, name, "latest.json")
+
+
+def _read_manifest(name, catalog_dir, version):
+    path = os.path.join(catalog_dir, name, version, "manifest.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def changed_sources(manifest, sources):
+    """Local files of `sources` whose content differs from the one the snapshot of `manifest` was built from.
+    URLs are not fetched to check them, they are only read again on a rebuild."""
+    checksums = {x["key"]: x["sha256"] for x in manifest["sources"]}
+    return [path for key, path in sources.items() if os.path.exists(path) and sha256_file(path) != checksums.get(key)]
+
+
+def build_catalog(name, sources=None, catalog_dir=DEFAULT_CATALOG_DIR):
+    """Fetch the sources of catalog `name` and write them as a Parquet snapshot with a manifest.
+
+    The version of a snapshot is derived from the checksums of its sources, so rebuilding from unchanged
+    sources reuses the existing snapshot. The new version becomes the latest one of the catalog.
+    """
+    sources = sources or DEFAULT_SOURCES[name]
+    contents = {}
+    for key, path in sources.items():
+        logger.info(f"Fetching {path}")
+        contents[key] = read_source(path)
+    checksums = {key: hashlib.sha256(content).hexdigest() for key, content in contents.items()}
+    version = hashlib.sha256(json.dumps({"name": name, "format": SNAPSHOT_FORMAT, "sources": checksums}, sort_keys=True).encode()).hexdigest()[:12]
+
+    snapshot_dir = os.path.join(catalog_dir, name, version)
+    os.makedirs(os.path.dirname(snapshot_dir), exist_ok=True)
+    manifest = _read_manifest(name, catalog_dir, version)
+    if manifest is None:
+        df = _arrow_compatible(parse_catalog(name, contents))
+        tmp_dir = f"{snapshot_dir}.tmp{os.getpid()}"
+        os.makedirs(tmp_dir, exist_ok=True)
+        df.to_parquet(os.path.join(tmp_dir, "data.parquet"), index=False)
+        manifest = {
+            "name": name,
+            "version": version,
+            "format": SNAPSHOT_FORMAT,
+            "created": datetime.now(timezone.utc).isoformat(),
+            "sources": [{"key": key, "path": sources[key], "sha256": checksums[key], "bytes": len(contents[key])} for key in sources],
+            "rows": len(df),
+            "columns": {col: str(dtype) for col, dtype in df.dtypes.items()},
+            "data_sha256": sha256_file(os.path.join(tmp_dir, "data.parquet")),
+        }
+        with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+        try:
+            os.rename(tmp_dir, snapshot_dir)
+        except OSError:
+            # Another process built the same version first
+            shutil.rmtree(tmp_dir)
+        logger.info(f"Built {name} catalog {version} with {manifest['rows']} rows in {snapshot_dir}")
+    else:
+        logger.info(f"Sources of {name} are unchanged, reusing catalog {version}")
+
+    latest_file = _latest_file(name, catalog_dir)
+    with open(latest_file + ".tmp", "w") as f:
+        json.dump({"version": version, "sources": sources}, f, indent=2)
+    os.replace(latest_file + ".tmp", latest_file)
+    return manifest
+
+
+def load_catalog(name, catalog_dir=DEFAULT_CATALOG_DIR, version=None):
+    """Load a snapshot of catalog `name`, the latest one unless `version` is given."""
+    if version is None:
+        latest_file = _latest_file(name, catalog_dir)
+        if not os.path.exists(latest_file):
+            error_message = f"No {name} catalog in {catalog_dir}, build it with `python catalog.py --catalog {name}`."
+            raise FileNotFoundError(error_message)
+        with open(latest_file, "r") as f:
+            version = json.load(f)["version"]
+    manifest = _read_manifest(name, catalog_dir, version)
+    if manifest is None:
+        error_message = f"No {name} catalog version {version} in {catalog_dir}."
+        raise FileNotFoundError(error_message)
+    data_file = os.path.join(catalog_dir, name, version, "data.parquet")
+    if sha256_file(data_file) != manifest["data_sha256"]:
+        error_message = f"{data_file} does not match the checksum of its manifest, rebuild the catalog."
+        raise ValueError(error_message)
+    logger.info(f"Loaded {name} catalog {version} ({manifest['rows']} rows, built {manifest['created']})")
+    return pd.read_parquet(data_file)
+
+
+def get_catalog(name, sources=None, catalog_dir=DEFAULT_CATALOG_DIR, version=None, offline=False, rebuild=False):
+    """Catalog `name` from its local snapshot, building the snapshot first when there is none for `sources`."""
+    sources = sources or DEFAULT_SOURCES[name]
+    if version is not None:
+        return load_catalog(name, catalog_dir, version)
+    latest_file = _latest_file(name, catalog_dir)
+    if not rebuild and os.path.exists(latest_file):
+        with open(latest_file, "r") as f:
+            latest = json.load(f)
+        manifest = _read_manifest(name, catalog_dir, latest["version"]) if latest["sources"] == sources else None
+        changed = changed_sources(manifest, sources) if manifest is not None else None
+        if changed == []:
+            return load_catalog(name, catalog_dir, latest["version"])
+        if changed:
+            logger.info(f"{changed} changed since the latest {name} catalog was built")
+        else:
+            logger.info(f"The latest {name} catalog was built from other sources")
+    if offline:
+        error_message = f"No {name} catalog built from {sources} in {catalog_dir} and running offline."
+        raise FileNotFoundError(error_message)
+    manifest = build_catalog(name, sources, catalog_dir)
+    return load_catalog(name, catalog_dir, manifest["version"])
+
+
+@click.command()
+@click.option(
+    "--catalog",
+    help="Catalog to build.",
+    type=click.Choice(["ecoinvent", "naics", "all"]),
+    default="all",
+)
+@click.option("--catalog_dir", help="Directory of the catalog snapshots.", default=DEFAULT_CATALOG_DIR)
+@click.option("--reference_file", help="ecoinvent database overview.", default=DEFAULT_SOURCES["ecoinvent"]["ecoinvent_file"])
+@click.option("--useeio_file", help="NAICS to CO2e mapping file.", default=DEFAULT_SOURCES["naics"]["useeio_file"])
+@click.option("--naics_file", help="List of NAICS", default=DEFAULT_SOURCES["naics"]["naics_file"])
+def main(catalog, catalog_dir, reference_file, useeio_file, naics_file):
+    os.makedirs(catalog_dir, exist_ok=True)
+    setup_logging(os.path.join(catalog_dir, "build.log"))
+    sources = {
+        "ecoinvent": {"ecoinvent_file": reference_file},
+        "naics": {"useeio_file": useeio_file, "naics_file": naics_file},
+    }
+    for name in ["ecoinvent", "naics"] if catalog == "all" else [catalog]:
+        manifest = build_catalog(name, sources[name], catalog_dir)
+        logger.info(f"{name}: version {manifest['version']}, {manifest['rows']} rows")
+
+
+if __name__ == "__main__":
+    main()
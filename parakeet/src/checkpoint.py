@@ -0,0 +1,113 @@
+import json
+import logging
+import os
+import sqlite3
+
+import pandas as pd
+
+logger = logging.getLogger("eifmap")
+
+
+def _to_builtin(value):
+    return value.item() if hasattr(value, "item") else str(value)
+
+
+class CheckpointStore:
+    """SQLite sidecar that tracks which activities of `<output_file>.jsonl`/`.csv` are complete.
+
+    Every activity is committed after its .jsonl form and .csv rows have been written and synced: the
+    commit records the number of CSV rows of the activity, its mapping (to fan it out to later duplicates)
+    and the byte size of both output files. On startup the output files are truncated back to the last
+    committed sizes, so an interrupted write never leaves a partial or unaccounted row behind.
+    """
+
+    def __init__(self, output_file):
+        self.jsonl_file = output_file + ".jsonl"
+        self.csv_file = output_file + ".csv"
+        self.path = output_file + ".checkpoint.sqlite"
+        is_new = not os.path.exists(self.path)
+
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS activities (id TEXT PRIMARY KEY, n_rows INTEGER, result TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS offsets (file TEXT PRIMARY KEY, size INTEGER)")
+        self.conn.commit()
+
+        if is_new:
+            self._index_existing_outputs()
+        else:
+            self._truncate_to_committed()
+        self.n_rows = dict(self.conn.execute("SELECT id, n_rows FROM activities"))
+        logger.info(f"Checkpoint {self.path}: {len(self.n_rows)} activities already processed")
+
+    def _size(self, file):
+        return os.path.getsize(file) if os.path.exists(file) else 0
+
+    def _truncate_to_committed(self):
+        for file in [self.jsonl_file, self.csv_file]:
+            row = self.conn.execute("SELECT size FROM offsets WHERE file = ?", (file,)).fetchone()
+            committed = row[0] if row else 0
+            size = self._size(file)
+            if size < committed:
+                error_message = f"{file} is shorter ({size} bytes) than its last checkpoint ({committed} bytes)."
+                raise AssertionError(error_message)
+            if size > committed:
+                logger.warning(f"Discarding {size - committed} uncommitted bytes at the end of {file}")
+                with open(file, "r+b") as f:
+                    f.truncate(committed)
+
+    def _index_existing_outputs(self):
+        # Outputs written before the checkpoint store existed: index them once
+        jsonl_ids = set()
+        if os.path.exists(self.jsonl_file):
+            with open(self.jsonl_file, "r") as jsonfile:
+                jsonl_ids = {json.loads(line)["formConfig"]["fields"][0]["id"] for line in jsonfile if line.strip()}
+        activity_maps = pd.read_csv(self.csv_file) if self._size(self.csv_file) > 0 else pd.DataFrame(columns=["id"])
+
+        csv_ids = set(activity_maps["id"])
+        if len(jsonl_ids) != len(csv_ids):
+            error_message = "Number of forms in the .jsonl is not equal to the number of ids in the .csv."
+            raise AssertionError(error_message)
+        if not csv_ids <= jsonl_ids:
+            error_message = "Activity maps do not contain all the ids from gt_json_list."
+            raise AssertionError(error_message)
+
+        counts = activity_maps["id"].value_counts()
+        first_rows = activity_maps.drop_duplicates(subset=["id"]).to_dict("records")
+        self.conn.executemany(
+            "INSERT INTO activities (id, n_rows, result) VALUES (?, ?, ?)",
+            ((row["id"], int(counts[row["id"]]), json.dumps(row, default=_to_builtin)) for row in first_rows),
+        )
+        self._record_sizes()
+        self.conn.commit()
+        if len(csv_ids) > 0:
+            logger.info(f"Indexed {len(csv_ids)} activities from existing {self.csv_file}")
+
+    def _record_sizes(self):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO offsets (file, size) VALUES (?, ?)",
+            [(file, self._size(file)) for file in [self.jsonl_file, self.csv_file]],
+        )
+
+    @property
+    def csv_has_header(self):
+        return self._size(self.csv_file) > 0
+
+    def result(self, uniq_id):
+        (result,) = self.conn.execute("SELECT result FROM activities WHERE id = ?", (uniq_id,)).fetchone()
+        return json.loads(result)
+
+    def commit(self, uniq_id, n_rows, result=None, files=()):
+        for f in files:
+            f.flush()
+            os.fsync(f.fileno())
+        self.n_rows[uniq_id] = self.n_rows.get(uniq_id, 0) + n_rows
+        self.conn.execute(
+            "INSERT INTO activities (id, n_rows, result) VALUES (?, ?, ?) ON CONFLICT(id) DO UPDATE SET n_rows = excluded.n_rows",
+            (uniq_id, self.n_rows[uniq_id], json.dumps(result, default=_to_builtin)),
+        )
+        self._record_sizes()
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
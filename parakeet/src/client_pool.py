@@ -0,0 +1,114 @@
+import logging
+import threading
+
+import boto3
+import botocore.session
+from botocore.config import Config
+from botocore.credentials import CredentialProvider, DeferredRefreshableCredentials
+
+logger = logging.getLogger("eifmap")
+
+ROLE_SESSION_NAME = "langchain-llm-1"
+# botocore refreshes the assumed-role credentials 15 minutes before they expire
+ROLE_DURATION_SECONDS = 3600
+
+
+class RoleCredentialProvider(CredentialProvider):
+    """Deferred, refreshable credentials of an assumed role, first in the credential chain of a session."""
+
+    METHOD = "sts-assume-role"
+    CANONICAL_NAME = "parakeet-assume-role"
+
+    def __init__(self, refresh):
+        self.refresh = refresh
+
+    def load(self):
+        return DeferredRefreshableCredentials(refresh_using=self.refresh, method=self.METHOD)
+
+
+class BedrockClientPool:
+    """Process-wide cache of boto3 sessions and clients.
+
+    There is one session per (region, profile, role): the role is assumed once, when its credentials are first
+    needed, and botocore refreshes them before they expire instead of every client calling STS again. Clients
+    are shared per session and configuration, boto3 clients are thread-safe so every worker of the process can
+    call through the same one. A client is only rebuilt when a caller needs a larger connection pool than the
+    cached one has.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.clients = {}
+        self.stats = {"sessions": 0, "clients": 0, "reused": 0, "role_refreshes": 0}
+
+    def _role_credentials(self, region, profile, role):
+        sts = boto3.Session(region_name=region, profile_name=profile).client("sts")
+
+        def refresh():
+            logger.info(f"Assuming role {role}")
+            credentials = sts.assume_role(RoleArn=str(role), RoleSessionName=ROLE_SESSION_NAME, DurationSeconds=ROLE_DURATION_SECONDS)["Credentials"]
+            self.stats["role_refreshes"] += 1
+            return {
+                "access_key": credentials["AccessKeyId"],
+                "secret_key": credentials["SecretAccessKey"],
+                "token": credentials["SessionToken"],
+                "expiry_time": credentials["Expiration"].isoformat(),
+            }
+
+        return RoleCredentialProvider(refresh)
+
+    def _session(self, region, profile, role):
+        key = (region, profile, role)
+        if key not in self.sessions:
+            botocore_session = botocore.session.Session(profile=profile)
+            if role:
+                credential_chain = botocore_session.get_component("credential_provider")
+                credential_chain.insert_before("env", self._role_credentials(region, profile, role))
+            self.sessions[key] = boto3.Session(botocore_session=botocore_session, region_name=region)
+            self.stats["sessions"] += 1
+        return self.sessions[key]
+
+    def client(
+        self,
+        region=None,
+        profile=None,
+        role=None,
+        service_name="bedrock-runtime",
+        max_pool_connections=10,
+        max_attempts=10,
+        endpoint_url=None,
+        tcp_keepalive=True,
+    ):
+        key = (region, profile, role, service_name, max_attempts, endpoint_url, tcp_keepalive)
+        # Held while a client is built: boto3 sessions are not thread-safe, and concurrent workers asking for
+        # the same client wait for the first one instead of each setting up their own.
+        with self.lock:
+            cached = self.clients.get(key)
+            if cached is not None and cached[1] >= max_pool_connections:
+                self.stats["reused"] += 1
+                return cached[0]
+            logger.info(f"Create new {service_name} client\n  Using region: {region}")
+            if profile:
+                logger.info(f"  Using profile: {profile}")
+            if role:
+                logger.info(f"  Using role: {role}")
+            if endpoint_url:
+                logger.info(f"  Using endpoint: {endpoint_url}")
+            config = Config(
+                region_name=region,
+                # botocore's "max_attempts" doesn't count the first attempt
+                retries={
+                    "total_max_attempts": max_attempts,
+                    "mode": "standard",
+                },
+                max_pool_connections=max_pool_connections,
+                tcp_keepalive=tcp_keepalive,
+            )
+            client = self._session(region, profile, role).client(service_name=service_name, config=config, endpoint_url=endpoint_url)
+            self.clients[key] = (client, max_pool_connections)
+            self.stats["clients"] += 1
+            return client
+
+
+bedrock_clients = BedrockClientPool()
@@ -0,0 +1,118 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+
+logger = logging.getLogger("eifmap")
+
+
+class EmbeddingService:
+    """In-process front of an embedding model for the query texts of concurrent workers.
+
+    Requests smaller than `max_batch_size` are queued: the first worker to find the queue empty leads, waits up
+    to `max_wait` seconds for other workers' texts (or until a batch is full), encodes the batch in one model
+    call and hands every worker its rows, then keeps serving whatever queued up meanwhile. Recent query
+    embeddings are kept in an LRU cache of `cache_size` texts, and only one model call runs at a time.
+    """
+
+    def __init__(self, model, max_batch_size=64, max_wait=0.005, cache_size=10_000):
+        self.model = model
+        self.max_batch_size = max(max_batch_size, 1)
+        self.max_wait = max_wait
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.queue = []
+        self.leading = False
+        self.condition = threading.Condition()
+        self.model_lock = threading.Lock()
+        self.counts = {"requests": 0, "texts": 0, "cache_hits": 0, "batches": 0, "batched_texts": 0, "max_batch_size": 0, "wait_seconds": 0.0, "waits": 0}
+
+    def _encode(self, texts, batch_size, show_progress_bar=False):
+        with self.model_lock:
+            embeddings = np.asarray(self.model.encode(texts, show_progress_bar=show_progress_bar, batch_size=batch_size))
+        with self.condition:
+            self.counts["batches"] += 1
+            self.counts["batched_texts"] += len(texts)
+            self.counts["max_batch_size"] = max(self.counts["max_batch_size"], len(texts))
+            if self.cache_size:
+                for text, embedding in zip(texts, embeddings):
+                    self.cache[text] = embedding
+                    self.cache.move_to_end(text)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return embeddings
+
+    def _lead(self):
+        while True:
+            with self.condition:
+                deadline = time.monotonic() + self.max_wait
+                while len(self.queue) < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch, self.queue = self.queue[: self.max_batch_size], self.queue[self.max_batch_size :]
+                now = time.monotonic()
+                self.counts["wait_seconds"] += sum(now - queued for _, _, queued in batch)
+                self.counts["waits"] += len(batch)
+            texts = list(dict.fromkeys(text for text, _, _ in batch))
+            try:
+                rows = dict(zip(texts, self._encode(texts, self.max_batch_size)))
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+            else:
+                for text, future, _ in batch:
+                    future.set_result(rows[text])
+            with self.condition:
+                if not self.queue:
+                    self.leading = False
+                    return
+
+    def encode(self, texts, show_progress_bar=False, batch_size=None):
+        texts = [str(x) for x in texts]
+        found = {}
+        with self.condition:
+            self.counts["requests"] += 1
+            self.counts["texts"] += len(texts)
+            for text in dict.fromkeys(texts):
+                if text in self.cache:
+                    self.cache.move_to_end(text)
+                    found[text] = self.cache[text]
+            self.counts["cache_hits"] += sum(x in found for x in texts)
+        missing = [x for x in dict.fromkeys(texts) if x not in found]
+        if len(missing) >= self.max_batch_size:
+            # Already a full batch, e.g. a retrieval window
+            found.update(zip(missing, self._encode(missing, batch_size or self.max_batch_size, show_progress_bar)))
+        elif missing:
+            futures = [Future() for _ in missing]
+            with self.condition:
+                now = time.monotonic()
+                self.queue.extend((text, future, now) for text, future in zip(missing, futures))
+                lead = not self.leading
+                self.leading = True
+                self.condition.notify_all()
+            if lead:
+                self._lead()
+            found.update((text, future.result()) for text, future in zip(missing, futures))
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack([found[x] for x in texts])
+
+    def stats(self):
+        with self.condition:
+            counts = dict(self.counts)
+            cache_entries = len(self.cache)
+        return {
+            "requests": counts["requests"],
+            "texts": counts["texts"],
+            "cache_hit_rate": round(counts["cache_hits"] / counts["texts"], 4) if counts["texts"] else None,
+            "cache_entries": cache_entries,
+            "batches": counts["batches"],
+            "mean_batch_size": round(counts["batched_texts"] / counts["batches"], 2) if counts["batches"] else None,
+            "max_batch_size": counts["max_batch_size"],
+            "mean_wait_ms": round(1000 * counts["wait_seconds"] / counts["waits"], 2) if counts["waits"] else None,
+        }
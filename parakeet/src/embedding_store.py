@@ -0,0 +1,169 @@
+import fcntl
+import hashlib
+import logging
+import os
+import sqlite3
+from contextlib import contextmanager
+from time import time
+
+import numpy as np
+
+logger = logging.getLogger("eifmap")
+
+
+class EmbeddingStore:
+    """Persistent embeddings of texts for one embedding model, shared by every reference catalog.
+
+    Vectors are appended to a raw float32 matrix that is read back through a memory map, and a SQLite
+    index maps the md5 of each text to its row. Only texts missing from the index are sent to the model.
+    When the store holds more than `max_entries` vectors, the least recently used ones are dropped by
+    rewriting the matrix into a new generation file and switching the index over in one transaction.
+    Writers take an exclusive file lock, so several processes can share one store.
+    """
+
+    def __init__(self, directory, model_id, max_entries=1_000_000):
+        self.directory = self.model_directory(directory, model_id)
+        os.makedirs(self.directory, exist_ok=True)
+        self.model_id = model_id
+        self.max_entries = max_entries
+        # Callers sharing a store across threads serialize their calls, e.g. CohereEmbedding
+        self.conn = sqlite3.connect(os.path.join(self.directory, "index.sqlite"), timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (text_hash TEXT PRIMARY KEY, row INTEGER, last_used REAL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('model_id', ?)", (model_id,))
+        self.conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', '0')")
+        self.conn.commit()
+
+    @staticmethod
+    def model_directory(directory, model_id):
+        return os.path.join(directory, hashlib.md5(model_id.encode()).hexdigest())
+
+    @staticmethod
+    def text_hash(text):
+        return hashlib.md5(str(text).encode()).hexdigest()
+
+    @contextmanager
+    def _lock(self, operation=fcntl.LOCK_EX):
+        with open(os.path.join(self.directory, "lock"), "w") as lock_file:
+            fcntl.flock(lock_file, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _vectors_file(self, generation=None):
+        generation = self._meta("generation") if generation is None else generation
+        return os.path.join(self.directory, f"vectors.{generation}.f32")
+
+    def _n_rows(self):
+        (n_rows,) = self.conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM embeddings").fetchone()
+        return n_rows
+
+    def _matrix(self):
+        dim = self._meta("dim")
+        n_rows = self._n_rows()
+        if dim is None or n_rows == 0:
+            return np.empty((0, 0 if dim is None else int(dim)), dtype=np.float32)
+        return np.memmap(self._vectors_file(), dtype=np.float32, mode="r", shape=(n_rows, int(dim)))
+
+    def __len__(self):
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        return count
+
+    def lookup(self, texts):
+        """Rows of the given texts in the matrix, -1 for the texts that are not stored yet."""
+        hashes = [self.text_hash(x) for x in texts]
+        rows = {}
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i : i + 500]
+            query = f"SELECT text_hash, row FROM embeddings WHERE text_hash IN ({','.join('?' * len(chunk))})"
+            rows.update(self.conn.execute(query, chunk))
+        return np.array([rows.get(x, -1) for x in hashes], dtype=np.int64)
+
+    def add(self, texts, embeddings):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        with self._lock():
+            rows = self.lookup(texts)
+            new = [i for i, row in enumerate(rows) if row < 0]
+            if not new:
+                return
+            if self._meta("dim") is None:
+                self.conn.execute("INSERT INTO meta (key, value) VALUES ('dim', ?)", (str(embeddings.shape[1]),))
+            n_rows = self._n_rows()
+            vectors_file = self._vectors_file()
+            # Drop rows appended by a writer that crashed before committing them to the index
+            with open(vectors_file, "ab") as f:
+                f.truncate(n_rows * embeddings.shape[1] * 4)
+                f.write(embeddings[new].tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            now = time()
+            self.conn.executemany(
+                "INSERT INTO embeddings (text_hash, row, last_used) VALUES (?, ?, ?)",
+                [(self.text_hash(texts[i]), n_rows + j, now) for j, i in enumerate(new)],
+            )
+            self.conn.commit()
+            if self.max_entries and n_rows + len(new) > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        keep = self.conn.execute("SELECT text_hash, row FROM embeddings ORDER BY last_used DESC LIMIT ?", (self.max_entries,)).fetchall()
+        keep_rows = np.array(sorted(row for _, row in keep), dtype=np.int64)
+        new_row = {int(row): i for i, row in enumerate(keep_rows)}
+        generation = int(self._meta("generation"))
+        matrix = self._matrix()
+        with open(self._vectors_file(generation + 1), "wb") as f:
+            for i in range(0, len(keep_rows), 10_000):
+                f.write(np.ascontiguousarray(matrix[keep_rows[i : i + 10_000]]).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        del matrix
+        self.conn.execute("CREATE TEMP TABLE keep (text_hash TEXT PRIMARY KEY)")
+        self.conn.executemany("INSERT INTO keep (text_hash) VALUES (?)", [(text_hash,) for text_hash, _ in keep])
+        self.conn.execute("DELETE FROM embeddings WHERE text_hash NOT IN (SELECT text_hash FROM keep)")
+        self.conn.execute("DROP TABLE keep")
+        self.conn.executemany("UPDATE embeddings SET row = ? WHERE text_hash = ?", [(new_row[int(row)], text_hash) for text_hash, row in keep])
+        self.conn.execute("UPDATE meta SET value = ? WHERE key = 'generation'", (str(generation + 1),))
+        self.conn.commit()
+        os.remove(self._vectors_file(generation))
+        logger.info(f"Evicted embeddings down to {len(keep_rows)} entries")
+
+    def get(self, texts):
+        # A shared lock keeps an eviction in another process from renumbering the rows while they are read
+        with self._lock(fcntl.LOCK_SH):
+            rows = self.lookup(texts)
+            if (rows < 0).any():
+                error_message = f"{int((rows < 0).sum())} texts are missing from the embedding store."
+                raise KeyError(error_message)
+            embeddings = np.asarray(self._matrix()[rows])
+        self._touch(texts)
+        return embeddings
+
+    def _touch(self, texts):
+        now = time()
+        self.conn.executemany("UPDATE embeddings SET last_used = ? WHERE text_hash = ?", [(now, self.text_hash(x)) for x in set(texts)])
+        self.conn.commit()
+
+    def encode(self, texts, semantic_text_model, batch_size=32, show_progress_bar=True):
+        """Embeddings of `texts`, only the texts that are not in the store yet are encoded."""
+        texts = [str(x) for x in texts]
+        if self.max_entries and len(set(texts)) > self.max_entries:
+            error_message = f"{len(set(texts))} distinct texts do not fit in an embedding store of {self.max_entries} entries."
+            raise ValueError(error_message)
+        rows = self.lookup(texts)
+        missing = list(dict.fromkeys(x for x, row in zip(texts, rows) if row < 0))
+        logger.info(f"{int((rows >= 0).sum())}/{len(texts)} embeddings found in {self.directory}, encoding {len(missing)} texts")
+        if missing:
+            # Mark the stored texts as used first so that adding the missing ones can't evict them
+            self._touch([x for x, row in zip(texts, rows) if row >= 0])
+            embeddings = semantic_text_model.encode(missing, show_progress_bar=show_progress_bar, batch_size=batch_size)
+            self.add(missing, np.asarray(embeddings))
+        return self.get(texts)
+
+    def close(self):
+        self.conn.close()
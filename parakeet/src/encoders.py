@@ -0,0 +1,162 @@
+"""ONNX Runtime backends of the SentenceTransformer encoders.
+
+This is the canonical implementation: caml/eio/onnx_encoder.py is a port of it for the caml package, which
+can't import parakeet's scripts. Fixes to the export, the pooling or the cache locking are made here first
+and ported there.
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+logger = logging.getLogger("eifmap")
+
+# "torch" runs the SentenceTransformer itself, the others an ONNX export of it with ONNX Runtime on CPU
+ENCODER_BACKENDS = ["torch", "onnx", "onnx-int8"]
+DEFAULT_ENCODER_DIR = os.path.join(os.path.expanduser("~"), ".cache", "parakeet", "encoders")
+POOLING_MODES = ["mean", "cls", "max"]
+
+
+def pooling_mode(pooling):
+    # sentence-transformers >= 3.1 keeps the mode as a string, earlier versions as one flag per mode
+    mode = getattr(pooling, "pooling_mode", None) or pooling.get_pooling_mode_str()
+    if mode not in POOLING_MODES:
+        error_message = f"Pooling mode {mode!r} can't be exported, only {POOLING_MODES} are supported."
+        raise ValueError(error_message)
+    return mode
+
+
+def export_onnx(model_id, directory, quantize=True):
+    """Export the transformer of SentenceTransformer `model_id` to ONNX in `directory`, with its tokenizer and
+    pooling config, and a dynamically int8-quantized copy of the weights if `quantize`."""
+    import torch
+    from sentence_transformers import SentenceTransformer, models
+
+    model = SentenceTransformer(model_id, device="cpu")
+    transformer, pooling = model[0], model[1]
+    tokenizer = model.tokenizer
+    input_names = [x for x in ["input_ids", "attention_mask", "token_type_ids"] if x in tokenizer.model_input_names]
+    config = {
+        "model_id": model_id,
+        "input_names": input_names,
+        "pooling": pooling_mode(pooling),
+        "normalize": any(isinstance(x, models.Normalize) for x in model),
+        "max_seq_length": model.max_seq_length,
+        "pad_id": tokenizer.pad_token_id,
+        "pad_token": tokenizer.pad_token,
+    }
+
+    class TokenEmbeddings(torch.nn.Module):
+        def __init__(self, auto_model):
+            super().__init__()
+            self.auto_model = auto_model
+
+        def forward(self, *inputs):
+            return self.auto_model(**dict(zip(input_names, inputs))).last_hidden_state
+
+    os.makedirs(directory, exist_ok=True)
+    # Files are written under names of this process and renamed, so a reader never sees a partial file
+    tmp_suffix = f".tmp{os.getpid()}"
+    sample = tokenizer(["an activity description", "a reference product"], padding=True, return_tensors="pt")
+    with torch.no_grad():
+        torch.onnx.export(
+            TokenEmbeddings(transformer.auto_model.eval()),
+            tuple(sample[x] for x in input_names),
+            os.path.join(directory, "model.onnx" + tmp_suffix),
+            input_names=input_names,
+            output_names=["token_embeddings"],
+            dynamic_axes={**{x: {0: "batch", 1: "sequence"} for x in input_names}, "token_embeddings": {0: "batch", 1: "sequence"}},
+            opset_version=17,
+            dynamo=False,
+        )
+    os.replace(os.path.join(directory, "model.onnx" + tmp_suffix), os.path.join(directory, "model.onnx"))
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantize_dynamic(os.path.join(directory, "model.onnx"), os.path.join(directory, "model.int8.onnx" + tmp_suffix), weight_type=QuantType.QInt8)
+        os.replace(os.path.join(directory, "model.int8.onnx" + tmp_suffix), os.path.join(directory, "model.int8.onnx"))
+    tokenizer.backend_tokenizer.save(os.path.join(directory, "tokenizer.json" + tmp_suffix))
+    os.replace(os.path.join(directory, "tokenizer.json" + tmp_suffix), os.path.join(directory, "tokenizer.json"))
+    # Written last: a directory with a config is a complete export
+    with open(os.path.join(directory, "config.json" + tmp_suffix), "w") as f:
+        json.dump(config, f, indent=2)
+    os.replace(os.path.join(directory, "config.json" + tmp_suffix), os.path.join(directory, "config.json"))
+    logger.info(f"Exported {model_id} to ONNX in {directory}")
+
+
+class OnnxEncoder:
+    """SentenceTransformer model exported to ONNX and run with ONNX Runtime on CPU.
+
+    The export is made on the first `encode` and kept in `cache_dir`, so later runs load it without importing
+    torch. With `quantize`, the weights of the matrix multiplications are int8 (dynamic quantization).
+    `intra_op_threads` sets the number of threads of each ONNX Runtime operator, all cores by default.
+    """
+
+    def __init__(self, model_id, quantize=True, cache_dir=None, intra_op_threads=None):
+        self.model_id = model_id
+        self.quantize = quantize
+        self.directory = os.path.join(cache_dir or DEFAULT_ENCODER_DIR, hashlib.md5(model_id.encode()).hexdigest(), "onnx")
+        self.intra_op_threads = intra_op_threads
+        self.session = None
+        self.lock = threading.Lock()
+
+    def _load(self):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        model_file = os.path.join(self.directory, "model.int8.onnx" if self.quantize else "model.onnx")
+        os.makedirs(self.directory, exist_ok=True)
+        # Shard workers starting on a cold cache wait for the first one's export instead of exporting again
+        with open(os.path.join(self.directory, "lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if not os.path.exists(os.path.join(self.directory, "config.json")) or not os.path.exists(model_file):
+                    export_onnx(self.model_id, self.directory, quantize=self.quantize)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        with open(os.path.join(self.directory, "config.json"), "r") as f:
+            self.config = json.load(f)
+        self.tokenizer = Tokenizer.from_file(os.path.join(self.directory, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=self.config["max_seq_length"])
+        self.tokenizer.enable_padding(pad_id=self.config["pad_id"], pad_token=self.config["pad_token"])
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if self.intra_op_threads:
+            options.intra_op_num_threads = self.intra_op_threads
+        self.session = onnxruntime.InferenceSession(model_file, options, providers=["CPUExecutionProvider"])
+        logger.info(f"Loaded {model_file} with ONNX Runtime, {self.intra_op_threads or 'default'} intra-op threads")
+
+    def _encode_batch(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        inputs = {
+            "input_ids": np.array([x.ids for x in encodings], dtype=np.int64),
+            "attention_mask": np.array([x.attention_mask for x in encodings], dtype=np.int64),
+            "token_type_ids": np.array([x.type_ids for x in encodings], dtype=np.int64),
+        }
+        token_embeddings = self.session.run(None, {x: inputs[x] for x in self.config["input_names"]})[0]
+        mask = inputs["attention_mask"][:, :, None].astype(np.float32)
+        if self.config["pooling"] == "cls":
+            embeddings = token_embeddings[:, 0]
+        elif self.config["pooling"] == "max":
+            embeddings = np.where(mask > 0, token_embeddings, -1e9).max(axis=1)
+        else:
+            embeddings = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.config["normalize"]:
+            embeddings = embeddings / np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings
+
+    def encode(self, texts, show_progress_bar=False, batch_size=32, **kwargs):
+        with self.lock:
+            if self.session is None:
+                self._load()
+        texts = [str(x) for x in ([texts] if isinstance(texts, str) else texts)]
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        # Batches of similar lengths need less padding, like SentenceTransformer.encode
+        order = np.argsort([-len(x) for x in texts], kind="stable")
+        embeddings = np.concatenate([self._encode_batch([texts[i] for i in order[j : j + batch_size]]) for j in range(0, len(texts), batch_size)])
+        return embeddings[np.argsort(order, kind="stable")]
@@ -0,0 +1,79 @@
+"""Compare the predictions of generate_ranked_preds.py runs against a ground truth file, e.g. the staged and
+fused pipelines:
+
+    python evaluate_preds.py --lca_type eio --ground_truth ../data/GroundTruth/parakeet_austin_GT.csv \
+        --activity_col "['COMMODITY_DESCRIPTION']" --predictions staged.csv --predictions fused.csv
+
+The runs must use the same --activity_col, predictions are matched to the ground truth by activity id.
+"""
+import ast
+import logging
+
+import click
+import pandas as pd
+
+from utils import activity_ids
+
+logger = logging.getLogger("eifmap")
+
+# Ground truth column and prediction column compared for each LCA type
+LABEL_COLUMNS = {
+    "eio": ("naics_code_final", "naics_code"),
+    "process": ("impact_factor_name_final", "impact_factor_name"),
+}
+
+
+def normalize_labels(labels, lca_type):
+    if lca_type == "eio":
+        return pd.to_numeric(labels, errors="coerce").map(lambda x: "" if pd.isna(x) else str(int(x)))
+    return labels.fillna("").astype(str).str.strip()
+
+
+def read_predictions(path, label_col, lca_type):
+    preds_df = pd.read_csv(path, dtype={"id": str}).drop_duplicates(subset=["id"])
+    return preds_df.set_index("id")[label_col].pipe(normalize_labels, lca_type)
+
+
+def evaluate(gt_labels, predictions, lca_type):
+    """Accuracy of `predictions` over the labeled activities, `gt_labels` and `predictions` are indexed by id."""
+    labeled = gt_labels[gt_labels != ""]
+    predicted = predictions.reindex(labeled.index).fillna("")
+    metrics = {
+        "activities": len(labeled),
+        "coverage": (predicted != "").mean(),
+        "accuracy": (predicted == labeled).mean(),
+    }
+    if lca_type == "eio":
+        # Partial credit at the NAICS industry group (4 digits) and sector (2 digits) levels
+        for digits in [4, 2]:
+            metrics[f"accuracy_{digits}_digits"] = ((predicted != "") & (predicted.str[:digits] == labeled.str[:digits])).mean()
+    return metrics
+
+
+@click.command()
+@click.option("--lca_type", type=click.Choice(list(LABEL_COLUMNS)), required=True)
+@click.option("--ground_truth", help="Ground truth file, e.g. from data/GroundTruth.", required=True)
+@click.option("--activity_col", help="The activity columns of the prediction runs.", required=True)
+@click.option("--predictions", help="CSV output of a generate_ranked_preds.py run. Can be repeated.", multiple=True, required=True)
+def main(lca_type, ground_truth, activity_col, predictions):
+    logging.basicConfig(level=logging.INFO)
+    gt_col, label_col = LABEL_COLUMNS[lca_type]
+    gt_df = pd.read_csv(ground_truth).fillna("")
+    gt_labels = pd.Series(normalize_labels(gt_df[gt_col], lca_type).to_list(), index=activity_ids(gt_df[ast.literal_eval(activity_col)]))
+
+    all_predictions = {path: read_predictions(path, label_col, lca_type) for path in predictions}
+    summary = pd.DataFrame({path: evaluate(gt_labels, preds, lca_type) for path, preds in all_predictions.items()}).T
+    summary["activities"] = summary["activities"].astype(int)
+    print(summary.to_string(float_format="{:.3f}".format))
+
+    if len(predictions) > 1:
+        # How often the other runs pick the same reference as the first one, on the activities both mapped
+        first = all_predictions[predictions[0]]
+        for path in predictions[1:]:
+            common = first.index.intersection(all_predictions[path].index)
+            agreement = (first[common] == all_predictions[path][common]).mean()
+            logger.info(f"{path} agrees with {predictions[0]} on {agreement:.1%} of {len(common)} activities")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,38 +2,229 @@ import ast
 import json
 import logging
 import os
-from copy import deepcopy
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime, timezone
 
 import click
-import nltk
 import pandas as pd
 import prompts
 import rich
 import rich.traceback
-from assistant import LCAAssistant
+from assistant import BedrockCallError, LCAAssistant
+from ann_index import get_ann_index, recall_at_k
+from batch_inference import BatchExporter, DeferredCall, ingest_responses
+from cache import ResponseCache
+from cascade import CascadePolicy, calibrate_on_ground_truth, confidence
+from catalog import DEFAULT_CATALOG_DIR, ReferenceCatalog, get_catalog
+from checkpoint import CheckpointStore
+from client_pool import bedrock_clients
+from embedding_service import EmbeddingService
+from embedding_store import EmbeddingStore
+from encoders import ENCODER_BACKENDS
+from output_repair import repair_counts
+from prompt_builder import DEFAULT_MAX_FIELD_TOKENS, PROMPT_FORMATS, PromptBuilder
+from rate_limiter import AdaptiveRateLimiter
+from shards import assign_shards, check_merge_target, merge_batch_exports, merge_shards, run_shards
 
 from utils import (
     RichProgress,
     get_cached_embedding,
-    get_naics_data,
-    get_ecoinvent_data,
     get_ranked_list,
-    md5_hash_base64,
+    get_ranked_lists,
     prepare_eio_json,
     prepare_process_json,
-    preprocess_texts,
+    activity_ids,
+    activity_records,
+    embedding_store_id,
+    iter_activity_chunks,
     read_activities,
+    render_activities,
     setup_logging,
 )
 from functools import partial
 
 rich.traceback.install(show_locals=False)
-nltk.download("stopwords", quiet=True)
 
 logger = logging.getLogger("eifmap")
 
 
+def paraphrase_activity(lca_assistant, activity_item, lca_type, paraphrasing, prompt_builder):
+    logger.info(f"Item description:\n{activity_item}")
+    if not paraphrasing:
+        return activity_item
+    clean_text_prompt = prompts.text_clean_prompt if lca_type == "process" else prompts.text_clean_prompt_eio
+    clean_text = lca_assistant(
+        text=prompt_builder.build("text_clean", clean_text_prompt, activity_item),
+        format="text",
+        reset_mem=True,
+    )
+    logger.info(f"Cleaned text: {clean_text}")
+    return clean_text
+
+
+def fused_rerank(lca_assistant, activity_item, ranked_list, lca_type, prompt_builder):
+    """Paraphrase and rerank in a single call, returns the plain-language description and the ranked candidates."""
+    ranking_key = "reference_products" if lca_type == "process" else "naics"
+
+    def validation_fn(response):
+        if not isinstance(response, dict) or set(response.keys()) != {"description", ranking_key}:
+            error_message = f"Return a python dictionary with exactly two keys: 'description' and '{ranking_key}'."
+            raise ValueError(error_message)
+        if not isinstance(response[ranking_key], list) or len(response[ranking_key]) < 1:
+            error_message = f"'{ranking_key}' must be a non-empty python list of dictionaries."
+            raise ValueError(error_message)
+
+    if lca_type == "process":
+        prompt = prompt_builder.build("fused_reference_prods", prompts.fused_reference_prods_prompt, activity_item, ranked_list, keep=["reference_product"])
+    else:
+        prompt = prompt_builder.build("fused_eio_reranker", prompts.fused_eio_reranker_prompt, activity_item, ranked_list, keep=["naics_code"])
+    response = lca_assistant(text=prompt, reset_mem=True, format="python", validation_fn=validation_fn)
+    logger.info(f"Cleaned text: {response['description']}")
+    return response["description"], response[ranking_key]
+
+
+def map_process_activity(lca_assistant, activity_item, full_text, ranked_list, reference_catalog, impact_factor_keys, uniq_id, prompt_builder):
+    logger.info(f"Top reference products ({len(ranked_list)}): {ranked_list}")
+
+    ref_prod_response = lca_assistant(
+        text=prompt_builder.build("reference_prods", prompts.reference_prods_prompt, full_text, ranked_list, keep=["reference_product"]),
+        reset_mem=True,
+        format="python",
+    )
+    return select_process_eif(lca_assistant, activity_item, full_text, ref_prod_response, reference_catalog, impact_factor_keys, uniq_id, prompt_builder)
+
+
+def map_fused_process_activity(lca_assistant, activity_item, full_text, ranked_list, reference_catalog, impact_factor_keys, uniq_id, prompt_builder):
+    logger.info(f"Top reference products ({len(ranked_list)}): {ranked_list}")
+    full_text, ref_prod_response = fused_rerank(lca_assistant, activity_item, ranked_list, "process", prompt_builder)
+    return select_process_eif(lca_assistant, activity_item, full_text, ref_prod_response, reference_catalog, impact_factor_keys, uniq_id, prompt_builder)
+
+
+def select_process_eif(lca_assistant, activity_item, full_text, ref_prod_response, reference_catalog, impact_factor_keys, uniq_id, prompt_builder):
+    logger.info(f"LLM re-ranked ({len(ref_prod_response)}): {ref_prod_response}")
+    top_ref_prods = pd.DataFrame(ref_prod_response)
+
+    # NOTE: In the licenced Ecoinvent dataset, use "process_technology" and "process_description" instead of "product_info"
+    # ref_cols = ["impact_factor_name", "reference_product", "process_technology", "process_description"]
+    ref_cols = ["impact_factor_name", "reference_product", "product_info"]
+
+    # This ensures that top impact_factors from top reference products comes first
+    sel_eco = reference_catalog.lookup("reference_product", top_ref_prods["reference_product"].to_list())
+
+    sel_eco = sel_eco.drop_duplicates(subset=["impact_factor_name"])
+    sel_eco_list = sel_eco[ref_cols].to_dict("index")
+
+    def validation_fn(response, sel_eco):
+        index_check = pd.Series([x["index"] for x in response if x["index"] is not None]).isin(sel_eco.index).all()
+        error_message = f"One of the indices is not in range. Returned indices: {[x['index'] for x in response]}. Valid indices: {[*sel_eco.index.to_list(), None]}"
+        if response == "":
+            raise ValueError("Returned an empty message, try again to return a response in the format of a list of python dictionaries as I told you.")
+        if not index_check:
+            raise ValueError(error_message)
+        if not all(set(x.keys()) == {"index", "justification", "impact_factor_name"} for x in response):
+            error_message = "Each dictionary in the list must have all three keys: 'index', 'justification', 'impact_factor_name'"
+            raise ValueError(error_message)
+
+    # For the licenced Ecoinvent dataset wich includes "process_technology" and "process_description", use best_eif_prompt
+    best_eif_response = lca_assistant(
+        text=prompt_builder.build(
+            "best_eif",
+            prompts.best_eif_in_unlicensed_ecoinvent_prompt,
+            full_text,
+            sel_eco_list,
+            keep=["impact_factor_name", "reference_product"],
+        ),
+        reset_mem=True,
+        format="python",
+        validation_fn=partial(validation_fn, sel_eco=sel_eco),
+    )
+
+    candidates = sel_eco[["impact_factor_name", "reference_product"]].to_dict("records")
+    logger.info(f"Candidate Impact factors ({len(candidates)}): {sel_eco_list}")
+    logger.info(f"LLM Response for EIF ({len(best_eif_response)}): {best_eif_response}")
+
+    eif_id = best_eif_response[0]["index"]
+
+    if eif_id is None:
+        impact_factor_details = {k: None for k in impact_factor_keys}
+    else:
+        best_eif = sel_eco.loc[eif_id]
+        impact_factor_details = best_eif[impact_factor_keys].to_dict()
+
+    gt_json = prepare_process_json(activity_item, best_eif_response, sel_eco, uniq_id)
+    return impact_factor_details, best_eif_response[0]["justification"], gt_json
+
+
+def map_eio_activity(lca_assistant, activity_item, full_text, ranked_list, reference_catalog, impact_factor_keys, uniq_id, prompt_builder):
+    logger.info(f"Top {len(ranked_list)} NAICS: {ranked_list}")
+
+    try:
+        naics_response = lca_assistant(
+            text=prompt_builder.build("eio_reranker", prompts.eio_reranker_prompt, full_text, ranked_list, keep=["naics_code"]),
+            reset_mem=True,
+            format="python",
+        )
+    except (DeferredCall, BedrockCallError):
+        raise
+    except:
+        logger.warning(f"No NAICS found for {activity_item}")
+        return None
+    return select_naics(activity_item, full_text, naics_response, reference_catalog, impact_factor_keys, uniq_id)
+
+
+def map_fused_eio_activity(lca_assistant, activity_item, full_text, ranked_list, reference_catalog, impact_factor_keys, uniq_id, prompt_builder):
+    logger.info(f"Top {len(ranked_list)} NAICS: {ranked_list}")
+
+    try:
+        full_text, naics_response = fused_rerank(lca_assistant, activity_item, ranked_list, "eio", prompt_builder)
+    except (DeferredCall, BedrockCallError):
+        raise
+    except:
+        logger.warning(f"No NAICS found for {activity_item}")
+        return None
+    return select_naics(activity_item, full_text, naics_response, reference_catalog, impact_factor_keys, uniq_id)
+
+
+def accept_embedding_match(lca_assistant, activity_item, ranked_list, scores, reference_catalog, impact_factor_keys, uniq_id, prompt_builder, lca_type):
+    """Map an activity to its confident top embedding match, without the paraphrase and rerank calls."""
+    margin = confidence(ranked_list, scores, lca_type)[1]
+    justification = f"Top embedding match accepted without LLM reranking (cosine {scores[0]:.3f}, margin {margin:.3f})"
+    logger.info(justification)
+    if lca_type == "process":
+        ref_prod_response = [{"justification": justification, "reference_product": ranked_list[0]["reference_product"], "index": ranked_list[0]["index"]}]
+        impact_factor_details, eif_justification, gt_json = select_process_eif(
+            lca_assistant, activity_item, activity_item, ref_prod_response, reference_catalog, impact_factor_keys, uniq_id, prompt_builder
+        )
+        return impact_factor_details, f"{justification}. {eif_justification}", gt_json
+
+    # The runner-up with another code is the second choice of the review form
+    naics_response = [{"naics_code": ranked_list[0]["naics_code"], "justification": justification, "naics_title": ranked_list[0]["naics_title"]}]
+    for candidate, score in zip(ranked_list[1:], scores[1:]):
+        if candidate["naics_code"] != ranked_list[0]["naics_code"]:
+            naics_response.append(
+                {"naics_code": candidate["naics_code"], "justification": f"Second best embedding match (cosine {score:.3f})", "naics_title": candidate["naics_title"]}
+            )
+            break
+    return select_naics(activity_item, activity_item, naics_response, reference_catalog, impact_factor_keys, uniq_id)
+
+
+def select_naics(activity_item, full_text, naics_response, reference_catalog, impact_factor_keys, uniq_id):
+    logger.info(f"LLM re-ranked ({len(naics_response)}): {naics_response}")
+    best_naics_code = naics_response[0]["naics_code"]
+
+    best_naics = reference_catalog.lookup("naics_code", [best_naics_code])
+    if best_naics.empty:
+        logger.warning(f"No NAICS found for {best_naics_code}")
+        return None
+
+    impact_factor_details = best_naics[impact_factor_keys].drop_duplicates().to_dict("records")[0]
+    gt_json = prepare_eio_json(activity_item, full_text, naics_response, uniq_id)
+    return impact_factor_details, naics_response[0]["justification"], gt_json
+
+
 @click.command()
 @click.option(
     "--llm_model",
@@ -89,11 +280,15 @@ logger = logging.getLogger("eifmap")
     help="List of NAICS",
     default="https://www.census.gov/naics/2017NAICS/2017_NAICS_Index_File.xlsx",
 )
+@click.option("--catalog_dir", help="Directory of the local reference catalog snapshots.", default=DEFAULT_CATALOG_DIR)
+@click.option("--catalog_version", help="Pin the reference catalog snapshot to this version instead of the latest.", default=None)
+@click.option("--offline", help="Only use local catalog snapshots, never download the reference files.", is_flag=True, default=False)
+@click.option("--rebuild_catalog", help="Download the reference files again and rebuild the catalog snapshot.", is_flag=True, default=False)
 @click.option(
     "--sheet_name",
-    help="Sheet name from the input file",
+    help="Sheet of an .xlsx activity file, the first one by default.",
     type=str,
-    default="Sheet1",
+    default=None,
 )
 @click.option(
     "--reference_filter",
@@ -105,6 +300,191 @@ logger = logging.getLogger("eifmap")
     help="Needs paraphrasing",
     default=True,
 )
+@click.option(
+    "--fused",
+    help="Paraphrase and rerank in a single LLM call, retrieving the candidates with the raw activity text.",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--fused_top_k",
+    help="Number of candidates retrieved for the fused call. Defaults to twice the staged pipeline's (20 for process, 40 for EIO).",
+    type=int,
+    default=None,
+)
+@click.option(
+    "--cascade_min_score",
+    help="Accept the top embedding match of the raw activity text without LLM reranking when its cosine score "
+    "is at least this, and its margin over the runner-up at least --cascade_min_margin. Calibrate both with --calibrate_cascade.",
+    type=float,
+    default=None,
+)
+@click.option("--cascade_min_margin", help="See --cascade_min_score.", type=float, default=0.0)
+@click.option(
+    "--cascade_audit_rate",
+    help="Fraction of the confident activities still sent through the LLM to measure its agreement with the embedding match.",
+    type=float,
+    default=0.0,
+)
+@click.option(
+    "--calibrate_cascade",
+    help="Ground truth file (e.g. from data/GroundTruth) to calibrate the cascade thresholds on, instead of mapping activities.",
+    default=None,
+)
+@click.option("--cascade_precision", help="Precision of the accepted matches targeted by --calibrate_cascade.", type=float, default=0.95)
+@click.option(
+    "--prompt_format",
+    help="Serialize the reranking candidates as a compact table, or as the python repr of their dicts.",
+    type=click.Choice(PROMPT_FORMATS),
+    default="repr",
+)
+@click.option(
+    "--max_field_tokens",
+    help="Cut the descriptive fields of the reranking candidates to about this many tokens. Defaults to 64 with the compact format, no limit with repr.",
+    type=int,
+    default=None,
+)
+@click.option(
+    "--prompt_token_budget",
+    help="Leave the lowest-ranked candidates out of a reranking prompt until it fits in about this many tokens.",
+    type=int,
+    default=None,
+)
+@click.option(
+    "--retrieval_batch_size",
+    help="Number of activities whose texts are encoded and ranked together against the reference embeddings. 0 ranks one activity at a time.",
+    type=int,
+    default=0,
+)
+@click.option(
+    "--encode_batch_size",
+    help="Batch size used by the embedding model, for --retrieval_batch_size windows and the query texts of concurrent workers.",
+    type=int,
+    default=64,
+)
+@click.option(
+    "--chunk_size",
+    help="Stream the activity file (.csv, .parquet, .jsonl) in chunks of this many rows instead of loading it whole. "
+    "start_idx/end_idx then count the rows of the file, and identical rows are not de-duplicated.",
+    type=int,
+    default=0,
+)
+@click.option(
+    "--num_shards",
+    help="Split the activities across this many worker processes and merge their outputs into --output_file.",
+    type=int,
+    default=1,
+)
+@click.option(
+    "--shard_by",
+    help="Assign activities to shards by a hash of their id (duplicates stay in one shard) or by contiguous index ranges.",
+    type=click.Choice(["hash", "range"]),
+    default="hash",
+)
+@click.option("--shard_index", help="Shard processed by a worker process.", type=int, default=None, hidden=True)
+@click.option(
+    "--concurrency",
+    help="Number of activities sent through the LLM stages concurrently.",
+    type=int,
+    default=1,
+)
+@click.option("--requests_per_minute", help="Bedrock requests per minute allowed for this process.", type=float, default=None)
+@click.option("--tokens_per_minute", help="Bedrock input and output tokens per minute allowed for this process.", type=float, default=None)
+@click.option(
+    "--latency_target",
+    help="Lower the Bedrock concurrency when a call takes longer than this many seconds.",
+    type=float,
+    default=None,
+)
+@click.option("--bedrock_endpoint_url", help="Call Bedrock through this endpoint, e.g. a local stub.", default=None)
+@click.option("--assumed_role", help="ARN of an IAM role to assume for the Bedrock calls, its credentials are refreshed before they expire.", default=None)
+@click.option(
+    "--max_pool_connections",
+    help="Connections kept open to Bedrock by the client shared by the workers, defaults to max(10, concurrency).",
+    type=int,
+    default=None,
+)
+@click.option("--no_tcp_keepalive", help="Don't send TCP keep-alive probes on the pooled Bedrock connections.", is_flag=True, default=False)
+@click.option(
+    "--stream_responses",
+    help="Stream the rerank responses, parsing and validating them as they arrive: an invalid response is retried "
+    "without waiting for the rest of it, and a complete one is used as soon as it is closed.",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--batch_export",
+    help="Write the LLM calls missing from the response cache to this Bedrock batch-inference JSONL instead of "
+    "calling Bedrock. The activities waiting for them are mapped by a later run.",
+    default=None,
+)
+@click.option(
+    "--batch_ingest",
+    help="Store the responses of a batch-inference output JSONL in the response cache before running. Can be repeated.",
+    multiple=True,
+)
+@click.option(
+    "--cache_file",
+    help="SQLite file caching the LLM responses across runs.",
+    default=os.path.join(os.path.expanduser("~"), ".cache", "parakeet", "llm_responses.sqlite"),
+)
+@click.option("--no_cache", help="Don't read or write the LLM response cache.", is_flag=True, default=False)
+@click.option("--refresh_cache", help="Ignore cached LLM responses and overwrite them with fresh ones.", is_flag=True, default=False)
+@click.option("--cache_max_entries", help="Maximum number of cached LLM responses, least recently used are evicted first.", type=int, default=1_000_000)
+@click.option(
+    "--embedding_cache_dir",
+    help="Directory of the persistent reference embedding store.",
+    default=os.path.join(os.path.expanduser("~"), ".cache", "parakeet", "embeddings"),
+)
+@click.option(
+    "--encoder_backend",
+    help="Run the SentenceTransformer embedding model with torch, or exported to ONNX Runtime in fp32 or with dynamically int8-quantized weights (CPU).",
+    type=click.Choice(ENCODER_BACKENDS),
+    default="torch",
+)
+@click.option("--intra_op_threads", help="Threads per operator of the ONNX Runtime encoder backends, defaults to all cores.", type=int, default=None)
+@click.option(
+    "--embedding_concurrency",
+    help="Number of concurrent embedding requests of the Bedrock (Cohere) embedding models.",
+    type=int,
+    default=8,
+)
+@click.option(
+    "--query_batch_wait_ms",
+    help="Milliseconds a worker's query text waits for other workers' texts to be encoded in the same batch.",
+    type=float,
+    default=5.0,
+)
+@click.option("--query_cache_size", help="Number of recent query embeddings kept in memory, 0 to disable.", type=int, default=10_000)
+@click.option("--embedding_cache_max_entries", help="Maximum number of stored embeddings per model, least recently used are evicted first.", type=int, default=1_000_000)
+@click.option(
+    "--ann_index",
+    help="Index used to search the reference embeddings: exact search, or an approximate IVF (NumPy) or HNSW (requires hnswlib) index.",
+    type=click.Choice(["exact", "ivf", "hnsw"]),
+    default="exact",
+)
+@click.option("--ann_nlist", help="Number of IVF clusters, defaults to 4 * sqrt(number of references).", type=int, default=None)
+@click.option("--ann_nprobe", help="Number of IVF clusters searched per query.", type=int, default=16)
+@click.option("--ann_ef_search", help="HNSW search breadth.", type=int, default=64)
+@click.option(
+    "--ref_quantization",
+    help="Store and search the reference embeddings as float16 or per-row scaled int8 (exact search only).",
+    type=click.Choice(["none", "float16", "int8"]),
+    default="none",
+)
+@click.option(
+    "--rescore_factor",
+    help="Re-score the best rescore_factor * k quantized matches at full precision, 0 to disable.",
+    type=int,
+    default=4,
+)
+@click.option(
+    "--check_ann_recall",
+    help="Log the recall of the ANN index or quantized references against exact search on a sample of the activities.",
+    is_flag=True,
+    default=False,
+)
+@click.option("--cache_max_age_days", help="Drop cached LLM responses older than this many days.", type=float, default=None)
 
 def main(
     llm_model,
@@ -121,8 +501,58 @@ def main(
     no_progress_bar,
     useeio_file,
     naics_file,
+    catalog_dir,
+    catalog_version,
+    offline,
+    rebuild_catalog,
     sheet_name,
-    paraphrasing
+    paraphrasing,
+    fused,
+    fused_top_k,
+    cascade_min_score,
+    cascade_min_margin,
+    cascade_audit_rate,
+    calibrate_cascade,
+    cascade_precision,
+    prompt_format,
+    max_field_tokens,
+    prompt_token_budget,
+    retrieval_batch_size,
+    encode_batch_size,
+    chunk_size,
+    num_shards,
+    shard_by,
+    shard_index,
+    concurrency,
+    requests_per_minute,
+    tokens_per_minute,
+    latency_target,
+    bedrock_endpoint_url,
+    assumed_role,
+    max_pool_connections,
+    no_tcp_keepalive,
+    stream_responses,
+    batch_export,
+    batch_ingest,
+    cache_file,
+    no_cache,
+    refresh_cache,
+    cache_max_entries,
+    cache_max_age_days,
+    embedding_cache_dir,
+    encoder_backend,
+    intra_op_threads,
+    embedding_concurrency,
+    query_batch_wait_ms,
+    query_cache_size,
+    embedding_cache_max_entries,
+    ann_index,
+    ann_nlist,
+    ann_nprobe,
+    ann_ef_search,
+    ref_quantization,
+    rescore_factor,
+    check_ann_recall,
 ):
     setup_logging(output_file + ".log")
 
@@ -132,11 +562,27 @@ def main(
         no_progress_bar = True
 
     # same logic for process and eio
-    activity_df, full_df = read_activities(activity_file, activity_col, start_idx, end_idx, sheet_name)
+    if sheet_name is None:
+        sheet_name = 0
+    if chunk_size > 0:
+        n_activities = None if end_idx is None else end_idx - start_idx
+    else:
+        activity_df, full_df = read_activities(activity_file, activity_col, start_idx, end_idx, sheet_name)
+        n_activities = len(activity_df)
+
+    def activity_chunks():
+        if chunk_size > 0:
+            return iter_activity_chunks(activity_file, activity_col, start_idx, end_idx, chunk_size, sheet_name)
+        return [(activity_df, full_df)]
+
+    def chunk_shards(activity_df, first_ix):
+        uniq_ids = activity_ids(activity_df)
+        positions = range(first_ix, first_ix + len(activity_df))
+        return uniq_ids, positions, assign_shards(uniq_ids, positions, num_shards, shard_by, n_activities)
 
     if lca_type == "process":
         logger.info(f"Reading reference data from {reference_file}")
-        eco_df = get_ecoinvent_data(reference_file)
+        eco_df = get_catalog("ecoinvent", {"ecoinvent_file": reference_file}, catalog_dir, catalog_version, offline, rebuild_catalog)
         if len(eco_df) != len(eco_df["impact_factor_id"].unique()):
             error_message = "The length of 'df' is not equal to the length of 'impact_factor_id' unique values."
             raise AssertionError(error_message)
@@ -148,28 +594,142 @@ def main(
             f"Unique reference products: {len(eco_df['reference_product'].unique())}\nUnique impact factors: {len(eco_df['impact_factor_name'].unique())}"
         )
     else:
-        eco_df = get_naics_data(useeio_file, naics_file)
+        eco_df = get_catalog("naics", {"useeio_file": useeio_file, "naics_file": naics_file}, catalog_dir, catalog_version, offline, rebuild_catalog)
         eco_ref = eco_df["naics_desc"].unique() 
         logger.info(f"Number of NAICS descriptions: {len(eco_ref)}")
 
-    semantic_text_model, eco_ref_embedding = get_cached_embedding(eco_ref, embedding)
-
-
-    lca_assistant = LCAAssistant(llm_model=llm_model)
-
-    gt_json_list = []
-    if os.path.exists(output_file + ".jsonl"):
-        with open(output_file + ".jsonl", "r") as jsonfile:
-            gt_json_list = [json.loads(line) for line in jsonfile]
+    reference_catalog = ReferenceCatalog(eco_df)
+    # One limiter for every Bedrock call of the process, the LLM calls and those of a Bedrock embedding model
+    rate_limiter = AdaptiveRateLimiter(
+        max_concurrency=max(concurrency, embedding_concurrency) if embedding.startswith("cohere") else concurrency,
+        requests_per_minute=requests_per_minute,
+        tokens_per_minute=tokens_per_minute,
+        latency_target=latency_target,
+    )
+    semantic_text_model, eco_ref_embedding = get_cached_embedding(
+        eco_ref,
+        embedding,
+        embedding_cache_dir,
+        embedding_cache_max_entries,
+        concurrency=embedding_concurrency,
+        endpoint_url=bedrock_endpoint_url,
+        rate_limiter=rate_limiter,
+        backend=encoder_backend,
+        intra_op_threads=intra_op_threads,
+    )
+    # Coalesces the query texts of concurrent workers into batches and caches repeated ones
+    semantic_text_model = EmbeddingService(semantic_text_model, max_batch_size=encode_batch_size, max_wait=query_batch_wait_ms / 1000, cache_size=query_cache_size)
+    ref_quantization = None if ref_quantization == "none" else ref_quantization
+    if ann_index != "exact" or ref_quantization:
+        index_dir = os.path.join(EmbeddingStore.model_directory(embedding_cache_dir, embedding_store_id(embedding, encoder_backend)), "ann")
+        ref_index = get_ann_index(
+            ann_index,
+            eco_ref_embedding,
+            index_dir,
+            n_lists=ann_nlist,
+            n_probe=ann_nprobe,
+            ef_search=ann_ef_search,
+            quantization=ref_quantization,
+            rescore_factor=rescore_factor,
+        )
+        if check_ann_recall:
+            sample_df = activity_df if chunk_size <= 0 else next(iter_activity_chunks(activity_file, activity_col, start_idx, end_idx, 1024, sheet_name))[0]
+            sample = sample_df.astype(str).agg(" ".join, axis=1).sample(min(len(sample_df), 256), random_state=0)
+            k = 10 if lca_type == "process" else 20
+            recall = recall_at_k(ref_index, eco_ref_embedding, semantic_text_model.encode(sample.to_list(), show_progress_bar=False), k)
+            logger.info(f"{ref_quantization or ann_index} index recall@{k} against exact search on {len(sample)} activities: {recall:.4f}")
+        eco_ref_embedding = ref_index
+
+    if fused:
+        map_activity = map_fused_process_activity if lca_type == "process" else map_fused_eio_activity
+        # The raw text is less precise than a paraphrase, the candidate set is widened to keep the recall
+        top_k = fused_top_k if fused_top_k is not None else (20 if lca_type == "process" else 40)
+    else:
+        map_activity = map_process_activity if lca_type == "process" else map_eio_activity
+        top_k = None
+
+    if calibrate_cascade:
+        calibrate_on_ground_truth(
+            calibrate_cascade,
+            ast.literal_eval(activity_col),
+            lca_type,
+            semantic_text_model,
+            eco_df,
+            eco_ref,
+            eco_ref_embedding,
+            k=top_k,
+            target_precision=cascade_precision,
+        )
+        return
+
+    if num_shards > 1 and shard_index is None:
+        if shard_by == "range" and n_activities is None:
+            error_message = "Sharding a streamed file by range needs the number of activities, pass --end_idx or use --shard_by hash."
+            raise ValueError(error_message)
+        check_merge_target(output_file)
+        # The catalog snapshot and the reference embeddings are cached on disk by now, each worker loads them once
+        del semantic_text_model, eco_ref_embedding
+        ctx = click.get_current_context()
+        command = [sys.executable, os.path.abspath(__file__), "--no_progress_bar"]
+        for param in ctx.command.params:
+            value = ctx.params[param.name]
+            # Every shard exports its prompts to its own file, they are merged into --batch_export after the run
+            if param.name in ("output_file", "shard_index", "no_progress_bar", "batch_export") or value is None:
+                continue
+            if param.is_flag:
+                command += [param.opts[0]] if value else []
+            elif param.multiple:
+                command += [x for item in value for x in (param.opts[0], str(item))]
+            else:
+                command += [param.opts[0], str(value)]
+        run_shards(command, output_file, num_shards, batch_export)
+
+        def activity_shards():
+            first_ix = 0
+            for activity_df, _ in activity_chunks():
+                uniq_ids, _, shards = chunk_shards(activity_df, first_ix)
+                first_ix += len(activity_df)
+                yield from zip(uniq_ids, shards)
+
+        merge_shards(output_file, num_shards, activity_shards())
+        if batch_export and merge_batch_exports(batch_export, num_shards):
+            logger.info(f"Run the batch-inference job on {batch_export}, then rerun with --batch_ingest <its output> to continue")
+        return
+
+    response_cache = None
+    if not no_cache:
+        # Batch inference hands every response over through the cache, sampled ones included
+        response_cache = ResponseCache(
+            cache_file,
+            max_entries=cache_max_entries,
+            max_age_days=cache_max_age_days,
+            refresh=refresh_cache,
+            cache_sampled=bool(batch_export or batch_ingest),
+        )
+        logger.info(f"Caching LLM responses in {cache_file}")
+    if (batch_export or batch_ingest) and response_cache is None:
+        error_message = "Batch inference goes through the response cache, it can't be used with --no_cache."
+        raise ValueError(error_message)
+    for responses_file in batch_ingest:
+        ingest_responses(responses_file, response_cache, llm_model)
+    batch_exporter = BatchExporter(batch_export, llm_model) if batch_export else None
+    cascade = CascadePolicy(lca_type, cascade_min_score, cascade_min_margin, cascade_audit_rate) if cascade_min_score is not None else None
+    if max_field_tokens is None and prompt_format == "compact":
+        max_field_tokens = DEFAULT_MAX_FIELD_TOKENS
+    prompt_builder = PromptBuilder(prompt_format, max_field_tokens=max_field_tokens, token_budget=prompt_token_budget)
+    lca_assistant = LCAAssistant(
+        llm_model=llm_model,
+        max_pool_connections=max_pool_connections or max(10, concurrency),
+        cache=response_cache,
+        rate_limiter=rate_limiter,
+        endpoint_url=bedrock_endpoint_url,
+        assumed_role=assumed_role,
+        tcp_keepalive=not no_tcp_keepalive,
+        batch_exporter=batch_exporter,
+        streaming=stream_responses,
+    )
 
-    activity_maps = pd.read_csv(output_file + ".csv") if os.path.exists(output_file + ".csv") and os.path.getsize(output_file + ".csv") > 0 else pd.DataFrame()
-    
-    if len(gt_json_list) != len(activity_maps):
-        error_message = "Length of gt_json_list is not equal to the length of activity_maps."
-        raise AssertionError(error_message)
-    if gt_json_list and not activity_maps["id"].isin([x["formConfig"]["fields"][0]["id"] for x in gt_json_list]).all():
-        error_message = "Activity maps do not contain all the ids from gt_json_list."
-        raise AssertionError(error_message)
+    checkpoint = CheckpointStore(output_file)
 
     impact_factor_keys = (
         [
@@ -185,194 +745,239 @@ def main(
             "bea_code",
         ]
     )
-    activity_range = range(0, len(activity_df))
-
-    activity_col = ast.literal_eval(activity_col)
 
     with open(output_file + ".jsonl", "a") as jsonfile, open(output_file + ".csv", "a") as csvfile, RichProgress(
-        activity_range,
+        None if n_activities is None else range(n_activities),
         disable_progress=no_progress_bar,
         description="Processing activities:",
     ) as progress:
-        for activity_ix in activity_range:
-            with pd.option_context("display.max_colwidth", None):
-                entry = activity_df.iloc[activity_ix]
-                entry_full = full_df.iloc[activity_ix]
-                activity_item = entry.to_string()
-
-            uniq_id = md5_hash_base64(json.dumps(entry.to_dict()))
-            logger.info(f"({activity_ix}/{len(activity_df)}) {uniq_id}")
-            if len(activity_maps) > 0 and len(gt_json_list) > 0 and len(activity_maps[activity_maps["id"] == uniq_id]) > 0 and uniq_id in [x["formConfig"]["fields"][0]["id"] for x in gt_json_list]:
-                logger.info("Skipping already processed activity")
-                if not no_progress_bar:
-                    progress.update()
-                continue
-
-            if lca_type == "process":
-                full_text = activity_item
-                logger.info(f"Item description:\n{activity_item}")
-                if paraphrasing:
-                    clean_text = lca_assistant(
-                        text=prompts.text_clean_prompt.format(activity_item),
-                        format="text",
-                        reset_mem=True,
-                    )
-                    
-                    logger.info(f"Cleaned text: {clean_text}")
-                    full_text = clean_text
-                    
-
-                ranked_list, topK_df = get_ranked_list(
-                    full_text,
-                    semantic_text_model,
-                    eco_df,
-                    eco_ref,
-                    eco_ref_embedding,
-                    lca_type,
-                )
-
-                logger.info(f"Top reference products ({len(ranked_list)}): {ranked_list}")
-                
-                ref_prod_response = lca_assistant(
-                    text=prompts.reference_prods_prompt.format(full_text, ranked_list),
-                    reset_mem=True,
-                    format="python",
-                )
-                logger.info(f"LLM re-ranked ({len(ref_prod_response)}): {ref_prod_response}")
-                top_ref_prods = pd.DataFrame(ref_prod_response)
-
-                # NOTE: In the licenced Ecoinvent dataset, use "process_technology" and "process_description" instead of "product_info"
-                # ref_cols = ["impact_factor_name", "reference_product", "process_technology", "process_description"] 
-                ref_cols = ["impact_factor_name", "reference_product", "product_info"] 
-
-                # This ensures that top impact_factors from top reference products comes first
-                sel_eco = []
-
-                for x in top_ref_prods["reference_product"].to_list():
-                    sel_eco.append(eco_df[eco_df["reference_product"] == x]) 
-                sel_eco = pd.concat(sel_eco)
-
-                sel_eco = sel_eco.drop_duplicates(subset=["impact_factor_name"]) 
-                sel_eco_list = sel_eco[ref_cols].to_dict("index")
-
-                def validation_fn(response, sel_eco):
-                    index_check = pd.Series([x["index"] for x in response if x["index"] is not None]).isin(sel_eco.index).all()
-                    error_message = f"One of the indices is not in range. Returned indices: {[x['index'] for x in response]}. Valid indices: {[*sel_eco.index.to_list(), None]}"
-                    if response == "":
-                        raise ValueError("Returned an empty message, try again to return a response in the format of a list of python dictionaries as I told you.")
-                    if not index_check:
-                        raise ValueError(error_message)
-                    if not all(set(x.keys()) == {"index", "justification", "impact_factor_name"} for x in response):
-                        error_message = "Each dictionary in the list must have all three keys: 'index', 'justification', 'impact_factor_name'"
-                        raise ValueError(error_message)                
-                
-                # For the licenced Ecoinvent dataset wich includes "process_technology" and "process_description", use best_eif_prompt 
-                best_eif_response = lca_assistant(
-                    text=prompts.best_eif_in_unlicensed_ecoinvent_prompt.format(full_text, sel_eco_list),
-                    reset_mem=True,
-                    format="python",
-                    validation_fn=partial(validation_fn, sel_eco=sel_eco),
-                )
-                
-
-                candidates = sel_eco[["impact_factor_name", "reference_product"]].to_dict("records")
-                logger.info(f"Candidate Impact factors ({len(candidates)}): {sel_eco_list}")
-                logger.info(f"LLM Response for EIF ({len(best_eif_response)}): {best_eif_response}")
-
-                
-                eif_id = best_eif_response[0]["index"]
-                
-                if eif_id is None:
-                    impact_factor_details = {k: None for k in impact_factor_keys}
-                else:
-                    best_eif = sel_eco.loc[eif_id]
-                    impact_factor_details = best_eif[impact_factor_keys].to_dict()
-                
-                gt_json = prepare_process_json(activity_item, best_eif_response, sel_eco, uniq_id)
-                
-
-            else:
-                logger.info(f"Item description:\n{activity_item}")
-                full_text = activity_item
-                if paraphrasing:
-                    clean_text = lca_assistant(
-                        text=prompts.text_clean_prompt_eio.format(activity_item),
-                        format="text",
-                        reset_mem=True,
-                    )
-                
-                    logger.info(f"Cleaned text: {clean_text}")
-                    full_text = clean_text
-
-                ranked_list, topK_df = get_ranked_list(
-                    full_text,
-                    semantic_text_model,
-                    eco_df,
-                    eco_ref,
-                    eco_ref_embedding,
-                    lca_type,
-                )
-                
-                logger.info(f"Top {len(ranked_list)} NAICS: {ranked_list}")
-               
-                try:
-                    naics_response = lca_assistant(
-                        text=prompts.eio_reranker_prompt.format(full_text, ranked_list),
-                        reset_mem=True,
-                        format="python",
-                    )
-                    logger.info(f"LLM re-ranked ({len(naics_response)}): {naics_response}")
-                except:
-                    logger.warning(f"No NAICS found for {activity_item}")
-                    continue
-                
-                best_naics_code = naics_response[0]["naics_code"]
-
-                best_naics = eco_df[eco_df["naics_code"] == best_naics_code]
-                if best_naics.empty:
-                    logger.warning(f"No NAICS found for {best_naics_code}")
+        total = n_activities if n_activities is not None else "?"
+
+        def queue_activities(activity_df, full_df, uniq_ids, positions, committed_rows, resumed_rows):
+            # Rows whose selected activity columns are identical hash to the same uniq_id, they only differ in
+            # the unselected columns. The model stages run once per uniq_id and the result is written for every row.
+            pending, queued_ids = [], {}
+            activity_items = render_activities(activity_df)
+            for activity_ix, activity_item, uniq_id, entry_full in zip(positions, activity_items, uniq_ids, activity_records(full_df)):
+                if uniq_id in checkpoint.n_rows:
+                    logger.info(f"({activity_ix}/{total}) {uniq_id}")
+                    resumed_rows[uniq_id] = resumed_rows.get(uniq_id, 0) + 1
+                    if resumed_rows[uniq_id] <= committed_rows.get(uniq_id, 0):
+                        logger.info("Skipping already processed activity")
+                    else:
+                        # A duplicate of an activity mapped by an earlier run (e.g. over another index range)
+                        logger.info("Reusing the mapping of an already processed activity")
+                        summary_df = pd.DataFrame([{**checkpoint.result(uniq_id), **entry_full}])
+                        summary_df.to_csv(csvfile, header=False, index=False, mode="a")
+                        checkpoint.commit(uniq_id, 1, files=[csvfile])
                     if not no_progress_bar:
                         progress.update()
                     continue
-
-                impact_factor_details = best_naics[impact_factor_keys].drop_duplicates().to_dict("records")[0]
-                gt_json = prepare_eio_json(activity_item, full_text, naics_response, uniq_id)
-
-            summary_df = pd.DataFrame(
-                [
-                    {
-                        **entry_full.to_dict(),
-                        **{
-                            "id": uniq_id,
-                            "activity": activity_item,
-                            **impact_factor_details,
-                            "justification": (best_eif_response[0]["justification"] if lca_type == "process" else naics_response[0]["justification"]),
-                            "EIF dataset": (reference_filter if lca_type == "process" else "USEEIO v2.0, SupplyChainGHGEmissionFactors_v1.2"),
-                            "mapping_strategy": "Parakeet",
-                            "datetime": datetime.now(timezone.utc).strftime("%Y-%m-%d"),  
-                        },
-                    }
-                ]
+                if uniq_id in queued_ids:
+                    queued_ids[uniq_id].append(entry_full)
+                    continue
+                queued_ids[uniq_id] = [entry_full]
+                pending.append((activity_ix, queued_ids[uniq_id], activity_item, uniq_id))
+
+            n_rows = sum(len(x[1]) for x in pending)
+            # Upper bound with a cascade, which skips the calls of confident activities
+            llm_calls_per_activity = int(bool(paraphrasing) and not fused) + (2 if lca_type == "process" else 1)
+            logger.info(
+                f"Collapsed {n_rows} activities into {len(pending)} distinct ones, "
+                f"saving {(n_rows - len(pending)) * llm_calls_per_activity} LLM calls"
             )
-
-            json.dump(gt_json, jsonfile)
-            jsonfile.write("\n")
-
-            summary_df.to_csv(
-                csvfile,
-                header=activity_maps.empty,
-                index=False,
-                mode="a",
+            return pending
+
+        assistants = threading.local()
+        # The embedding service serializes the model calls, the lock only guards the index search (HNSW's ef is
+        # set per query)
+        retrieval_lock = threading.Lock()
+
+        def get_assistant():
+            # Each worker thread keeps its own conversation history on top of the shared Bedrock client
+            if concurrency <= 1:
+                return lca_assistant
+            if not hasattr(assistants, "lca_assistant"):
+                assistants.lca_assistant = lca_assistant.fork()
+            return assistants.lca_assistant
+
+        def paraphrase(item):
+            activity_ix, _, activity_item, uniq_id = item
+            logger.info(f"({activity_ix}/{total}) {uniq_id}")
+            # In fused mode the paraphrase comes with the rerank call
+            return paraphrase_activity(get_assistant(), activity_item, lca_type, paraphrasing and not fused, prompt_builder)
+
+        def exported_paraphrase(item):
+            # map_item tries a failed paraphrase again, and leaves the activity for a later run if it fails again
+            try:
+                return paraphrase(item)
+            except (DeferredCall, BedrockCallError):
+                return None
+
+        def cascade_gates(items):
+            # The gate ranks the raw activity text, so confident activities skip the paraphrase as well
+            ranked_lists = get_ranked_lists(
+                [x[2] for x in items],
+                semantic_text_model,
+                eco_df,
+                eco_ref,
+                eco_ref_embedding,
+                lca_type,
+                batch_size=encode_batch_size,
+                k=top_k,
+                search_lock=retrieval_lock,
             )
+            gates = []
+            for (_, _, _, uniq_id), (ranked_list, topK_df) in zip(items, ranked_lists):
+                scores = topK_df["cosine_score"].to_numpy()
+                gates.append((cascade.decide(ranked_list, scores, uniq_id)[0], ranked_list, scores))
+            return gates
+
+        def map_item(item, full_text=None, ranked_list=None, gate=None):
+            _, _, activity_item, uniq_id = item
+            try:
+                if cascade is not None and gate is None:
+                    gate = cascade_gates([item])[0]
+                if gate is not None:
+                    decision, gate_list, scores = gate
+                    if decision == "accept":
+                        logger.info(f"({item[0]}/{total}) {uniq_id}")
+                        logger.info(f"Item description:\n{activity_item}")
+                        return accept_embedding_match(
+                            get_assistant(), activity_item, gate_list, scores, reference_catalog, impact_factor_keys, uniq_id, prompt_builder, lca_type
+                        )
+                    if ranked_list is None and (fused or not paraphrasing):
+                        # Without a paraphrase the candidates are those of the gate
+                        ranked_list = gate_list
+                if full_text is None:
+                    full_text = paraphrase(item)
+                if ranked_list is None:
+                    ranked_list, _ = get_ranked_list(
+                        full_text,
+                        semantic_text_model,
+                        eco_df,
+                        eco_ref,
+                        eco_ref_embedding,
+                        lca_type,
+                        k=top_k,
+                        search_lock=retrieval_lock,
+                    )
+                mapping = map_activity(get_assistant(), activity_item, full_text, ranked_list, reference_catalog, impact_factor_keys, uniq_id, prompt_builder)
+                if gate is not None and mapping is not None:
+                    cascade.record(gate[0], gate[1], mapping[0])
+                return mapping
+            except DeferredCall:
+                # The prompt was exported for batch inference, the activity is mapped once its response is ingested
+                return None
+            except BedrockCallError as e:
+                # Not committed, a rerun maps the activity again
+                logger.error(f"{e}, {uniq_id} is left for a later run")
+                return None
+
+        def mapped_activities(executor, pending):
+            run = executor.map if executor is not None else map
+            if retrieval_batch_size <= 1:
+                yield from zip(pending, run(map_item, pending))
+                return
+            # The paraphrased texts of a whole window are encoded and ranked in one go,
+            # the LLM stages before and after retrieval run per activity.
+            for window_start in range(0, len(pending), retrieval_batch_size):
+                window = pending[window_start : window_start + retrieval_batch_size]
+                gates = cascade_gates(window) if cascade is not None else [None] * len(window)
+                to_paraphrase = [i for i, gate in enumerate(gates) if gate is None or gate[0] != "accept"]
+                full_texts = [None] * len(window)
+                for i, full_text in zip(to_paraphrase, run(exported_paraphrase, [window[i] for i in to_paraphrase])):
+                    full_texts[i] = full_text
+                ready = [i for i, x in enumerate(full_texts) if x is not None]
+                logger.info(f"Retrieving reference candidates for {len(ready)} activities")
+                ranked_lists = [None] * len(window)
+                if ready:
+                    window_lists = get_ranked_lists(
+                        [full_texts[i] for i in ready],
+                        semantic_text_model,
+                        eco_df,
+                        eco_ref,
+                        eco_ref_embedding,
+                        lca_type,
+                        batch_size=encode_batch_size,
+                        k=top_k,
+                        search_lock=retrieval_lock,
+                    )
+                    for i, (ranked_list, _) in zip(ready, window_lists):
+                        ranked_lists[i] = ranked_list
+                yield from zip(window, run(map_item, window, full_texts, ranked_lists, gates))
+
+        # Results come back in input order whatever the concurrency, so rows are written in input order
+        with ThreadPoolExecutor(max_workers=concurrency) if concurrency > 1 else nullcontext() as executor:
+            # Only activities committed before this run are skipped on resume, an id committed by an
+            # earlier chunk of this run is a duplicate that reuses its mapping
+            committed_rows = dict(checkpoint.n_rows)
+            resumed_rows = {}
+            first_ix = 0
+            for activity_df, full_df in activity_chunks():
+                uniq_ids, positions, shards = chunk_shards(activity_df, first_ix)
+                first_ix += len(activity_df)
+                if shard_index is not None:
+                    keep = [x == shard_index for x in shards]
+                    activity_df, full_df = activity_df[keep], full_df[keep]
+                    uniq_ids = [x for x, k in zip(uniq_ids, keep) if k]
+                    positions = [x for x, k in zip(positions, keep) if k]
+                pending = queue_activities(activity_df, full_df, uniq_ids, positions, committed_rows, resumed_rows)
+                for (_, entries_full, activity_item, uniq_id), mapping in mapped_activities(executor, pending):
+                    if mapping is None:
+                        if not no_progress_bar:
+                            progress.update(len(entries_full))
+                        continue
+                    impact_factor_details, justification, gt_json = mapping
+
+                    summary_df = pd.DataFrame(
+                        [
+                            {
+                                **entry_full,
+                                **{
+                                    "id": uniq_id,
+                                    "activity": activity_item,
+                                    **impact_factor_details,
+                                    "justification": justification,
+                                    "EIF dataset": (reference_filter if lca_type == "process" else "USEEIO v2.0, SupplyChainGHGEmissionFactors_v1.2"),
+                                    "mapping_strategy": "Parakeet",
+                                    "datetime": datetime.now(timezone.utc).strftime("%Y-%m-%d"),
+                                },
+                            }
+                            for entry_full in entries_full
+                        ]
+                    )
 
-            gt_json_list += [deepcopy(gt_json)]
-            activity_maps = pd.concat([activity_maps, summary_df], ignore_index=True)
-            logger.info("-" * 96)
-            if activity_ix % 10 == 0:
-                jsonfile.flush()
-                csvfile.flush()
-            if not no_progress_bar:
-                progress.update()
+                    json.dump(gt_json, jsonfile)
+                    jsonfile.write("\n")
+
+                    summary_df.to_csv(
+                        csvfile,
+                        header=not checkpoint.csv_has_header,
+                        index=False,
+                        mode="a",
+                    )
+                    # Both files are synced before the activity is marked as done
+                    checkpoint.commit(uniq_id, len(summary_df), result=summary_df.iloc[0].to_dict(), files=[jsonfile, csvfile])
+                    logger.info("-" * 96)
+                    if not no_progress_bar:
+                        progress.update(len(entries_full))
+
+    if batch_exporter is not None:
+        batch_exporter.close()
+        if batch_exporter.record_ids:
+            logger.info(f"Run the batch-inference job on {batch_export}, then rerun with --batch_ingest <its output> to continue")
+    logger.info(f"Estimated prompt tokens: {prompt_builder.stats}")
+    logger.info(f"Query embedding service: {semantic_text_model.stats()}")
+    logger.info(f"LLM output repaired locally: {dict(repair_counts)}")
+    if cascade is not None:
+        logger.info(f"Cascade: {cascade.stats()}")
+    logger.info(f"Bedrock rate limiter: {rate_limiter.stats}, final concurrency {int(rate_limiter.limit)}")
+    logger.info(f"Bedrock clients: {bedrock_clients.stats}")
+    if response_cache is not None:
+        logger.info(f"LLM response cache: {response_cache.stats()}")
+        response_cache.close()
+    checkpoint.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,121 @@
+import ast
+import logging
+import re
+import threading
+from collections import Counter
+
+logger = logging.getLogger("eifmap")
+
+# How many times each repair was needed to parse a response, for the whole process
+repair_counts = Counter()
+repair_lock = threading.Lock()
+
+# Curly quotes between two letters are apostrophes and are left alone
+SMART_QUOTES = [(r"[“”]", '"'), (r"‘|(?<![^\W\d_])’|’(?![^\W\d_])", "'")]
+JSON_LITERALS = {"null": "None", "true": "True", "false": "False"}
+
+
+def split_strings(text):
+    """Split `text` into (is_string, segment) pairs, following python and JSON quoting with backslash escapes."""
+    segments, start, quote, escaped = [], 0, None, False
+    for i, c in enumerate(text):
+        if quote is None:
+            if c in "'\"":
+                segments.append((False, text[start:i]))
+                start, quote = i, c
+        elif escaped:
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif c == quote:
+            segments.append((True, text[start : i + 1]))
+            start, quote = i + 1, None
+    segments.append((quote is not None, text[start:]))
+    return [x for x in segments if x[1]]
+
+
+def replace_outside_strings(text, pattern, repl):
+    return "".join(segment if is_string else re.sub(pattern, repl, segment) for is_string, segment in split_strings(text))
+
+
+def extract_literal(text):
+    """The first bracketed literal of `text`, without the sentences or code fences around it."""
+    start = min((i for i in (text.find("["), text.find("{")) if i >= 0), default=-1)
+    if start < 0:
+        return text
+    depth, position = 0, start
+    for is_string, segment in split_strings(text[start:]):
+        if not is_string:
+            for i, c in enumerate(segment):
+                if c in "[{(":
+                    depth += 1
+                elif c in "]})":
+                    depth -= 1
+                    if depth == 0:
+                        return text[start : position + i + 1]
+        position += len(segment)
+    # Never closed, the response was probably cut short
+    return text[start:]
+
+
+def normalize_smart_quotes(text):
+    for pattern, repl in SMART_QUOTES:
+        text = re.sub(pattern, repl, text)
+    return text
+
+
+def python_literals(text):
+    return replace_outside_strings(text, r"\b(null|true|false)\b", lambda m: JSON_LITERALS[m.group(1)])
+
+
+def remove_trailing_commas(text):
+    return replace_outside_strings(text, r",(\s*)(?=[\]}])", r"\1")
+
+
+# Applied in this order, each one on top of the previous ones, until the response parses
+REPAIRS = [
+    ("extract_literal", extract_literal),
+    ("smart_quotes", normalize_smart_quotes),
+    ("json_literals", python_literals),
+    ("trailing_commas", remove_trailing_commas),
+]
+
+
+def repair_literal(text):
+    """`ast.literal_eval(text)`, repairing the usual formatting slips of LLM output first if it doesn't parse.
+
+    Returns the value and the repairs it needed. Raises the error of the unrepaired text if no repair makes it
+    parseable.
+    """
+    try:
+        return ast.literal_eval(text), []
+    except (SyntaxError, ValueError) as e:
+        error = e
+    repaired, applied = text.strip(), []
+    for name, repair in REPAIRS:
+        candidate = repair(repaired)
+        if candidate == repaired:
+            continue
+        repaired = candidate
+        applied.append(name)
+        try:
+            return ast.literal_eval(repaired), applied
+        except (SyntaxError, ValueError):
+            continue
+    raise error
+
+
+def parse_literal(text):
+    """`repair_literal` of a whole response, recording the repairs in `repair_counts`."""
+    try:
+        value, applied = repair_literal(text)
+    except (SyntaxError, ValueError):
+        with repair_lock:
+            repair_counts["unrepairable_responses"] += 1
+        raise
+    if applied:
+        logger.info(f"Repaired the response locally: {applied}")
+        with repair_lock:
+            repair_counts.update(applied)
+            repair_counts["repaired_responses"] += 1
+    return value
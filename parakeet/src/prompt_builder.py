@@ -0,0 +1,103 @@
+import json
+import logging
+import threading
+
+logger = logging.getLogger("eifmap")
+
+CHARS_PER_TOKEN = 4
+PROMPT_FORMATS = ("compact", "repr")
+# Cut of the descriptive fields in the compact format, about 256 characters
+DEFAULT_MAX_FIELD_TOKENS = 64
+
+
+def estimate_tokens(text):
+    """Rough token count of `text`, about 4 characters per token for English text."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def truncate_text(text, max_tokens):
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    return text[: max_chars - 3].rstrip() + "..."
+
+
+def format_value(value):
+    text = str(value)
+    # Quote the values that would break the table layout
+    if "|" in text or "\n" in text:
+        return json.dumps(text, ensure_ascii=False)
+    return text
+
+
+def candidate_table(rows, columns):
+    lines = [" | ".join(columns)]
+    lines += [" | ".join(format_value(row.get(column, "")) for column in columns) for row in rows]
+    return "\n".join(lines)
+
+
+class PromptBuilder:
+    """Fills the prompt templates, serializing the reranking candidates.
+
+    With `prompt_format="compact"` the candidates are written as a table with a single header row, instead of
+    the python repr of their dicts that repeats every key for every candidate. String fields are cut to
+    `max_field_tokens`, except the `keep` columns that are matched against the catalog once the model answers.
+    With `token_budget`, the lowest-ranked candidates are left out until the prompt fits. The estimated size
+    of every prompt is logged and summed per prompt in `stats`.
+    """
+
+    def __init__(self, prompt_format="repr", max_field_tokens=None, token_budget=None):
+        if prompt_format not in PROMPT_FORMATS:
+            error_message = f"Unknown prompt format {prompt_format}, expected one of {PROMPT_FORMATS}"
+            raise ValueError(error_message)
+        self.prompt_format = prompt_format
+        self.max_field_tokens = max_field_tokens
+        self.token_budget = token_budget
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def _truncate(self, candidate, keep):
+        if self.max_field_tokens is None:
+            return candidate
+        return {
+            key: truncate_text(value, self.max_field_tokens) if isinstance(value, str) and key not in keep else value
+            for key, value in candidate.items()
+        }
+
+    def serialize(self, candidates, keep=()):
+        """Serialize a list of candidate dicts, or a dict of candidate dicts keyed by their index."""
+        if isinstance(candidates, dict):
+            candidates = {ix: self._truncate(candidate, keep) for ix, candidate in candidates.items()}
+            if self.prompt_format == "repr":
+                return str(candidates)
+            rows = [{"index": ix, **candidate} for ix, candidate in candidates.items()]
+        else:
+            candidates = [self._truncate(candidate, keep) for candidate in candidates]
+            if self.prompt_format == "repr":
+                return str(candidates)
+            rows = candidates
+        columns = list(dict.fromkeys(column for row in rows for column in row))
+        return "\n" + candidate_table(rows, columns)
+
+    def build(self, name, template, text, candidates=None, keep=()):
+        """Fill `template` with `text` and the serialized `candidates`, which are ordered best first."""
+        if candidates is None:
+            prompt = template.format(text)
+            n_shown = 0
+        else:
+            n_shown = len(candidates)
+            while True:
+                shown = dict(list(candidates.items())[:n_shown]) if isinstance(candidates, dict) else candidates[:n_shown]
+                prompt = template.format(text, self.serialize(shown, keep))
+                if self.token_budget is None or estimate_tokens(prompt) <= self.token_budget or n_shown <= 1:
+                    break
+                n_shown -= 1
+            if n_shown < len(candidates):
+                logger.warning(f"The {name} prompt is over {self.token_budget} tokens, left out its {len(candidates) - n_shown} lowest-ranked candidates")
+        tokens = estimate_tokens(prompt)
+        logger.info(f"Prompt {name}: {n_shown} candidates, ~{tokens} tokens")
+        with self.lock:
+            stats = self.stats.setdefault(name, {"prompts": 0, "tokens": 0})
+            stats["prompts"] += 1
+            stats["tokens"] += tokens
+        return prompt
@@ -109,6 +109,44 @@ Activity description: {}
 NAICS titles, descriptions and codes: {}
 """
 
+fused_eio_reranker_prompt = """
+### Instructions ###
+You want to perform economic input-output life-cycle assessment, or EIO-LCA.
+You have the raw description of a business activity, e.g. a line of a purchase order, and a few North American Industry Classification System (NAICS) titles, their descriptions and codes that may be relevant to it.
+First, describe the activity in plain language. Keep its specifics, focus on the materials and products involved and avoid filler words. Make the most of the given information, you MUST provide a description even if the information is limited.
+Then, using your description, reorder the NAICS titles and codes from the most likely relevance to the least likely relevance. Only report the top 5 unique titles and associated codes.
+The criteria for relevance is the environmental impact associated with the materials and manufacturing phase of the activity.
+
+Be sure to properly escape any special characters in the 'description' and 'justification' fields so that your response can be parsed with a python code interpreter.
+Return a Python dictionary with two keys: 'description', the plain language description of the activity, and 'naics', a list of dictionaries where each dictionary contains the keys 'naics_code', 'justification', and 'naics_title'. The format must match the following example: {{'description': '', 'naics': [{{'naics_code': , 'justification': '', 'naics_title': ''}},{{'naics_code': , 'justification': '', 'naics_title': ''}}]}}. Do not include any additional text or explanation in your response.
+
+### Example Input ###
+Activity description: 'COMMODITY_DESCRIPTION    IT HW/SW ENTERPRISE OPS'
+NAICS titles, descriptions and codes:
+[
+{{"naics_title": "Computer Facilities Management Services","naics description": "Computer systems facilities (i.e., clients' facilities) management and operation services","naics_code": "541513"}},
+{{"naics_title": "Electronic Computer Manufacturing","naics description": "Workstations, computer, manufacturing","naics_code": "334111"}},
+{{"naics_title": "All Other Support Services","naics description": "Inventory computing services","naics_code": "561990"}},
+{{"naics_title": "Facilities Support Services","naics description": "Facilities (except computer operation) support services","naics_code": "561210"}},
+{{"naics_title": "Computer Storage Device Manufacturing","naics description": "Storage devices, computer, manufacturing","naics_code": "334112"}}
+]
+
+### Example Output ###
+{{'description': 'IT hardware and software for enterprise operations',
+'naics': [
+{{'naics_code': 541513,
+'justification': 'This NAICS title covers the management and operation of computer systems facilities and data processing facilities for clients, which aligns with providing IT hardware and software for enterprise operations.',
+'naics_title': 'Computer Facilities Management Services'}},
+{{'naics_code': 334111,
+'justification': 'This covers manufacturing of computers, servers, and workstations, which are relevant hardware components for enterprise IT operations.',
+'naics_title': 'Electronic Computer Manufacturing'}}
+]}}
+
+### Input ###
+Activity description: {}
+NAICS titles, descriptions and codes: {}
+"""
+
 
 reference_prods_prompt = """
 ### Instructions ###
@@ -169,6 +207,48 @@ Reference products:
 ]
 
 
+### Input ###
+Information on item: {}
+Reference products: {}
+"""
+
+fused_reference_prods_prompt = """
+### Instructions ###
+You are a Life Cycle Assessment expert and is performing a process-based Life Cycle Assessment (LCA).
+I will give you a raw 'item description' and a list of 'reference_product's.
+First, describe the item in plain language. Do not remove its specifics (e.g. "date sugar" should NOT be described as just "sugar"). If the item is already generic, keep it as it is.
+Then, using your description, find a maximum of 5 highest matched 'reference_product's from the given list and report them in the order of match (highest match first).
+For each matched reference product, you must provide the 'justification' field, 'reference_product' and the 'index' of the 'reference_product'.
+
+### Detailed Instructions ###
+- Definition of match: Given an item description, a reference product is considered a match if it is either an exact match of the reference product (e.g. 'tomato' in an exact match for item "red tomato") or one of the components of the item description (e.g. given 'chili bean sauce' as the item, and 'bean' and 'chilli' as reference products, both are considered matches).
+- Similar reference products are not considered as a match. Example: For the item description 'rapini', the reference product 'spinach' is not a match; they are similar vegetables but not the same.
+- ALL 'index' and 'reference_product's that you return as an output MUST be in the reference_product's input data. DO NOT generate or hallucinate an 'index' or a 'reference_product' that is not in the input.
+- If none of reference products is a match, return one entry with 'reference_product': '', 'index': ''. DO NOT return this entry once there is at least one match.
+- If the given list contains duplicate reference products, only report the first occurrence of the reference product.
+- Always give a higher ranking to reference products that cover the most volume (thereby contributes to more CO2 emission) of the item.
+- Return a Python dictionary with two keys: 'description', the plain language description of the item, and 'reference_products', the list of matched reference products. The format of response must match the following example: {{'description': '', 'reference_products': [{{'justification': '', 'reference_product': '', 'index':}},{{'justification': '', 'reference_product': '', 'index':}}]}}. DO NOT break this rule.
+- Be sure to properly escape any special characters in the 'description' and 'justification' fields so that your response can be parsed with a python code interpreter.
+- Your response will be parsed using ast.literal_eval(response) command, so you MUST return a Python dictionary and nothing else.
+
+### Example Input ###
+item description: "Ingredient    popped popcorn"
+Reference products:
+ [
+ {{'index': 0, 'reference_product': 'sweet corn'}},
+ {{'index': 1, 'reference_product': 'palm kernel meal'}},
+ {{'index': 2, 'reference_product': 'maize grain, organic'}},
+ {{'index': 3, 'reference_product': 'maize grain'}},
+ {{'index': 4, 'reference_product': 'tomato, fresh grade'}}
+ ]
+
+### Example Output ###
+{{'description': 'popped popcorn',
+'reference_products': [
+{{"justification": 'Popcorn is made from maize/corn kernels, so "maize grain" is the most relevant reference product.',"reference_product": "maize grain","index": 3}},
+{{"justification": '"Maize grain, organic" is also highly relevant as popcorn is made from maize/corn.',"reference_product": "maize grain, organic","index": 2}}
+]}}
+
 ### Input ###
 Information on item: {}
 Reference products: {}
@@ -0,0 +1,172 @@
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from botocore.exceptions import ConnectionError, HTTPClientError
+
+logger = logging.getLogger("eifmap")
+
+THROTTLING_ERROR_CODES = {"ThrottlingException", "TooManyRequestsException", "ServiceQuotaExceededException"}
+TRANSIENT_ERROR_CODES = {"ServiceUnavailableException", "ModelNotReadyException", "InternalServerException", "ModelTimeoutException"}
+# Network errors that botocore's own retries would retry: failed connections, connect and read timeouts,
+# connections closed mid-response
+TRANSIENT_ERRORS = (ConnectionError, HTTPClientError)
+
+
+def error_code(exception):
+    # Only botocore's ClientError carries a parsed response, the response of network errors may be None
+    response = getattr(exception, "response", None)
+    return response.get("Error", {}).get("Code") if isinstance(response, dict) else None
+
+
+class TokenBucket:
+    """Refills `rate_per_minute` units per minute up to one `burst_seconds` worth of them."""
+
+    def __init__(self, rate_per_minute, burst_seconds=10.0, clock=time.monotonic):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(self.rate * burst_seconds, 1.0)
+        self.level = self.capacity
+        self.clock = clock
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` can be taken. A request larger than the bucket only waits for a full bucket."""
+        self._refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount):
+        self._refill()
+        self.level -= amount
+
+    def give_back(self, amount):
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class AdaptiveRateLimiter:
+    """Client-side scheduler for the Bedrock calls of a process, shared by all its assistants and threads.
+
+    Calls wait for a free concurrency slot and for the request and token buckets (requests and tokens per
+    minute). The concurrency limit follows AIMD: it grows by 1/limit after each call that succeeds within
+    `latency_target`, and is multiplied by `decrease_factor` on a throttling error or a slow call. A throttle
+    also pauses new calls for a jittered cooldown, and throttled calls are retried with full-jitter exponential
+    backoff so that processes sharing a quota don't retry in lockstep. Transient service and network errors are
+    retried the same way, the limiter replaces botocore's retries.
+    """
+
+    def __init__(
+        self,
+        max_concurrency=16,
+        min_concurrency=1,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        latency_target=None,
+        decrease_factor=0.5,
+        cooldown=1.0,
+        max_retries=10,
+        max_backoff=60.0,
+        clock=time.monotonic,
+    ):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        self.limit = float(max_concurrency)
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.request_bucket = TokenBucket(requests_per_minute, clock=clock) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute, clock=clock) if tokens_per_minute else None
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+        self.stats = {"calls": 0, "throttles": 0, "retries": 0, "waited_seconds": 0.0}
+
+    def _wait_time(self, tokens):
+        waits = [self.paused_until - self.clock()]
+        if self.request_bucket is not None:
+            waits.append(self.request_bucket.wait_time(1))
+        if self.token_bucket is not None:
+            waits.append(self.token_bucket.wait_time(tokens))
+        return max(waits)
+
+    @contextmanager
+    def slot(self, tokens=0):
+        """Hold one of the `limit` concurrent slots, once the buckets have room for a call of `tokens` tokens."""
+        start = self.clock()
+        with self.condition:
+            while True:
+                wait = self._wait_time(tokens)
+                if self.in_flight < int(self.limit) and wait <= 0:
+                    break
+                self.condition.wait(timeout=wait if wait > 0 else None)
+            self.in_flight += 1
+            if self.request_bucket is not None:
+                self.request_bucket.take(1)
+            if self.token_bucket is not None:
+                self.token_bucket.take(tokens)
+            self.stats["waited_seconds"] += self.clock() - start
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    def _decrease(self, reason):
+        previous = int(self.limit)
+        self.limit = max(float(self.min_concurrency), self.limit * self.decrease_factor)
+        if int(self.limit) != previous:
+            logger.warning(f"{reason}, lowering Bedrock concurrency from {previous} to {int(self.limit)}")
+
+    def on_success(self, latency, tokens=0, used_tokens=None):
+        with self.condition:
+            self.stats["calls"] += 1
+            if self.token_bucket is not None and used_tokens is not None:
+                # Settle the estimate taken before the call with the actual usage
+                self.token_bucket.give_back(tokens - used_tokens)
+            if self.latency_target is not None and latency > self.latency_target:
+                self._decrease(f"Bedrock call took {latency:.1f}s")
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+    def on_throttle(self):
+        with self.condition:
+            self.stats["throttles"] += 1
+            self._decrease("Bedrock throttled a call")
+            self.paused_until = max(self.paused_until, self.clock() + random.uniform(0.5, 1.5) * self.cooldown)
+            self.condition.notify_all()
+
+    def call(self, fn, tokens=0, usage_fn=None):
+        """Run `fn()` within the limits, retrying throttled and transient errors. `usage_fn(result)` returns the
+        number of tokens the call actually used, to correct the `tokens` estimate."""
+        for attempt in range(self.max_retries + 1):
+            with self.slot(tokens):
+                start = self.clock()
+                try:
+                    result = fn()
+                except Exception as e:
+                    code = error_code(e)
+                    transient = code in TRANSIENT_ERROR_CODES or isinstance(e, TRANSIENT_ERRORS)
+                    if code not in THROTTLING_ERROR_CODES and not transient or attempt == self.max_retries:
+                        raise
+                    if code in THROTTLING_ERROR_CODES:
+                        self.on_throttle()
+                    backoff = random.uniform(0, min(self.max_backoff, self.cooldown * 2**attempt))
+                    logger.info(f"{code or type(e).__name__}, retrying in {backoff:.1f}s (attempt {attempt + 1}/{self.max_retries})")
+                else:
+                    self.on_success(self.clock() - start, tokens, usage_fn(result) if usage_fn is not None else None)
+                    return result
+            with self.condition:
+                self.stats["retries"] += 1
+            time.sleep(backoff)
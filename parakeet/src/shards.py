@@ -0,0 +1,157 @@
+import csv
+import json
+import logging
+import os
+import subprocess
+
+from utils import md5_hash
+
+logger = logging.getLogger("eifmap")
+
+
+def shard_output_file(output_file, shard_index, num_shards):
+    return f"{output_file}.shard{shard_index}of{num_shards}"
+
+
+def shard_batch_file(batch_export, shard_index, num_shards):
+    root, ext = os.path.splitext(batch_export)
+    return f"{root}.shard{shard_index}of{num_shards}{ext}"
+
+
+def _merge_manifest_file(output_file):
+    return output_file + ".shards.json"
+
+
+def _read_merge_manifest(output_file):
+    if not os.path.exists(_merge_manifest_file(output_file)):
+        return None
+    with open(_merge_manifest_file(output_file), "r") as f:
+        return json.load(f)
+
+
+def check_merge_target(output_file):
+    """Refuse to merge shards over the output of a run that wasn't sharded: the merge replaces the output files."""
+    if _read_merge_manifest(output_file) is not None:
+        return
+    existing = [output_file + x for x in (".csv", ".jsonl") if os.path.exists(output_file + x) and os.path.getsize(output_file + x) > 0]
+    if existing:
+        error_message = f"{existing} hold the output of a run that wasn't sharded, a sharded run would replace them. Use another --output_file."
+        raise ValueError(error_message)
+
+
+def assign_shards(uniq_ids, positions, num_shards, shard_by="hash", n_activities=None):
+    """Shard of every activity: by a hash of its uniq_id, which keeps duplicates in one shard, or by contiguous
+    ranges of its position."""
+    if shard_by == "hash":
+        return [int(md5_hash(x), 16) % num_shards for x in uniq_ids]
+    if n_activities is None:
+        error_message = "Sharding by range needs the number of activities, pass --end_idx or shard by hash."
+        raise ValueError(error_message)
+    return [min(x * num_shards // max(n_activities, 1), num_shards - 1) for x in positions]
+
+
+def run_shards(command, output_file, num_shards, batch_export=None):
+    """Run `command` once per shard in parallel worker processes, each writing to its own shard output, and
+    exporting its batch-inference prompts to its own file when `batch_export` is given."""
+    processes = []
+    for shard_index in range(num_shards):
+        shard_output = shard_output_file(output_file, shard_index, num_shards)
+        shard_command = [*command, "--output_file", shard_output, "--shard_index", str(shard_index)]
+        if batch_export:
+            shard_command += ["--batch_export", shard_batch_file(batch_export, shard_index, num_shards)]
+        logger.info(f"Starting shard {shard_index}/{num_shards}: {shard_output}")
+        processes.append(subprocess.Popen(shard_command, stdout=subprocess.DEVNULL))
+    failed = [i for i, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        error_message = f"Shards {failed} failed, see {[shard_output_file(output_file, i, num_shards) + '.log' for i in failed]}. Rerun to resume them."
+        raise RuntimeError(error_message)
+
+
+def _read_shard(shard_output):
+    header, rows = None, {}
+    if os.path.exists(shard_output + ".csv") and os.path.getsize(shard_output + ".csv") > 0:
+        with open(shard_output + ".csv", "r", newline="") as csvfile:
+            reader = csv.reader(csvfile)
+            header = next(reader)
+            id_col = header.index("id")
+            for row in reader:
+                rows.setdefault(row[id_col], []).append(row)
+    forms = {}
+    if os.path.exists(shard_output + ".jsonl"):
+        with open(shard_output + ".jsonl", "r") as jsonfile:
+            for line in jsonfile:
+                if line.strip():
+                    forms.setdefault(json.loads(line)["formConfig"]["fields"][0]["id"], line)
+    return header, rows, forms
+
+
+def merge_shards(output_file, num_shards, activity_shards):
+    """Merge the shard outputs into `output_file`.jsonl/.csv in input order.
+
+    `activity_shards` yields (uniq_id, shard) for every activity in input order. The rows of an activity are
+    written where it first occurs in its shard, like a single run would, and a form is only written for the
+    first occurrence of each uniq_id. Rows are copied verbatim, and the shard logs are appended to the log.
+    `output_file`.shards.json records the merge, so a rerun of the shards merges over it again.
+    """
+    shards = [_read_shard(shard_output_file(output_file, i, num_shards)) for i in range(num_shards)]
+    header = next((x[0] for x in shards if x[0] is not None), None)
+    merged, written = set(), set()
+    n_rows = 0
+    with open(output_file + ".jsonl.tmp", "w") as jsonfile, open(output_file + ".csv.tmp", "w", newline="") as csvfile:
+        writer = csv.writer(csvfile, lineterminator="\n")
+        if header is not None:
+            writer.writerow(header)
+        for uniq_id, shard in activity_shards:
+            if (shard, uniq_id) in merged:
+                continue
+            merged.add((shard, uniq_id))
+            _, rows, forms = shards[shard]
+            if uniq_id in forms and uniq_id not in written:
+                jsonfile.write(forms[uniq_id])
+                written.add(uniq_id)
+            writer.writerows(rows.get(uniq_id, []))
+            n_rows += len(rows.get(uniq_id, []))
+    os.replace(output_file + ".jsonl.tmp", output_file + ".jsonl")
+    os.replace(output_file + ".csv.tmp", output_file + ".csv")
+    # A checkpoint of an earlier run on `output_file` no longer matches the merged files
+    if os.path.exists(output_file + ".checkpoint.sqlite"):
+        os.remove(output_file + ".checkpoint.sqlite")
+
+    # Shard logs grow with every rerun of their shard, only the lines not appended by an earlier merge are
+    manifest = _read_merge_manifest(output_file) or {}
+    log_offsets = manifest.get("log_offsets", {})
+    with open(output_file + ".log", "a") as logfile:
+        for i in range(num_shards):
+            shard_log = shard_output_file(output_file, i, num_shards) + ".log"
+            if os.path.exists(shard_log):
+                with open(shard_log, "r") as f:
+                    f.seek(log_offsets.get(shard_log, 0))
+                    logfile.writelines(f"[shard {i}] {line}" for line in f)
+                    log_offsets[shard_log] = f.tell()
+    with open(_merge_manifest_file(output_file) + ".tmp", "w") as f:
+        json.dump({"num_shards": num_shards, "log_offsets": log_offsets}, f, indent=2)
+    os.replace(_merge_manifest_file(output_file) + ".tmp", _merge_manifest_file(output_file))
+    logger.info(f"Merged {num_shards} shards into {output_file}.jsonl/.csv: {len(written)} forms, {n_rows} rows")
+
+
+def merge_batch_exports(batch_export, num_shards):
+    """Concatenate the batch-inference files of the shards into `batch_export`, returns the number of prompts.
+
+    Shards can export the same prompt, for activities with the same text, it is written once."""
+    record_ids = set()
+    with open(batch_export + ".tmp", "w") as f:
+        for i in range(num_shards):
+            shard_export = shard_batch_file(batch_export, i, num_shards)
+            if not os.path.exists(shard_export):
+                continue
+            with open(shard_export, "r") as shard_file:
+                for line in shard_file:
+                    if not line.strip():
+                        continue
+                    record_id = json.loads(line)["recordId"]
+                    if record_id not in record_ids:
+                        record_ids.add(record_id)
+                        f.write(line)
+    os.replace(batch_export + ".tmp", batch_export)
+    logger.info(f"Merged the prompts exported by {num_shards} shards into {batch_export}: {len(record_ids)} prompts")
+    return len(record_ids)
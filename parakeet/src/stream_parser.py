@@ -0,0 +1,101 @@
+from output_repair import parse_literal, repair_literal
+
+# Characters of preamble tolerated before the literal starts
+MAX_PREAMBLE = 500
+
+
+class StreamParseError(ValueError):
+    pass
+
+
+class StreamAborted(Exception):
+    """Raised when a response stream is cut short, with the text received so far and the error that stopped it."""
+
+    def __init__(self, text, error):
+        super().__init__(f"Stream aborted after {len(text)} characters: {error!r}")
+        self.text = text
+        self.error = error
+
+
+class IncrementalLiteralParser:
+    """Follows a python (or JSON) literal as the text of a response stream arrives.
+
+    Only tracks quotes and bracket depth while the text comes in: every element of a top-level list is parsed
+    as soon as the comma or bracket after it arrives, and `validation_fn` is run on the elements parsed so far,
+    so a malformed or invalid element fails the stream right away. Parsing goes through the local repairs of
+    `output_repair`, and a short preamble before the literal is skipped. `feed` returns True once the top-level
+    literal is closed, its value is then in `value`.
+    """
+
+    def __init__(self, validation_fn=None):
+        self.validation_fn = validation_fn
+        self.reset()
+
+    def reset(self):
+        self.text = ""
+        self.pos = 0
+        self.depth = 0
+        self.quote = None
+        self.escaped = False
+        self.container = None
+        self.start = None
+        self.element_start = None
+        self.elements = []
+        self.end = None
+        self.value = None
+
+    @property
+    def done(self):
+        return self.end is not None
+
+    def _element(self, end):
+        element = self.text[self.element_start : end].strip()
+        self.element_start = end + 1
+        if not element:
+            # Empty list or trailing comma
+            return
+        try:
+            self.elements.append(repair_literal(element)[0])
+        except (SyntaxError, ValueError) as e:
+            error_message = f"List element {len(self.elements)} can't be parsed: {element!r}"
+            raise StreamParseError(error_message) from e
+        if self.validation_fn is not None:
+            self.validation_fn(self.elements)
+
+    def feed(self, chunk):
+        self.text += chunk
+        while self.pos < len(self.text) and not self.done:
+            c = self.text[self.pos]
+            if self.quote is not None:
+                if self.escaped:
+                    self.escaped = False
+                elif c == "\\":
+                    self.escaped = True
+                elif c == self.quote:
+                    self.quote = None
+            elif self.container is None:
+                if c in "[{":
+                    self.container, self.start, self.element_start, self.depth = c, self.pos, self.pos + 1, 1
+                elif self.pos >= MAX_PREAMBLE:
+                    error_message = f"The response doesn't start with a python literal: {self.text[: self.pos + 1]!r}"
+                    raise StreamParseError(error_message)
+            elif c in "'\"":
+                self.quote = c
+            elif c in "[{(":
+                self.depth += 1
+            elif c in "]})":
+                self.depth -= 1
+                if self.depth == 0:
+                    if self.container == "[":
+                        self._element(self.pos)
+                    self.end = self.pos + 1
+                    try:
+                        # With the preamble, so that its removal is recorded as a repair
+                        self.value = parse_literal(self.text[: self.end])
+                    except (SyntaxError, ValueError) as e:
+                        error_message = f"The response can't be parsed: {self.text[self.start : self.end]!r}"
+                        raise StreamParseError(error_message) from e
+            elif c == "," and self.depth == 1 and self.container == "[":
+                self._element(self.pos)
+            self.pos += 1
+        return self.done
@@ -1,22 +1,29 @@
 import ast
 import base64
 import hashlib
+import json
 import logging
 import os
 import re
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from copy import deepcopy
+from functools import lru_cache
+from io import BytesIO
+from itertools import islice
 from time import time
 import requests
 
-import cohere_aws
-import nltk
 import numpy as np
 import pandas as pd
 import rich
 import rich.traceback
-import torch
-from nltk.corpus import stopwords as nltk_stopwords
+from embedding_store import EmbeddingStore
+from encoders import OnnxEncoder
 from prompts import eio_groundtruth_json, process_groundtruth_json
+from rate_limiter import AdaptiveRateLimiter
 from rich.logging import RichHandler
 from rich.progress import (
     BarColumn,
@@ -26,19 +33,20 @@ from rich.progress import (
     TimeElapsedColumn,
     TimeRemainingColumn,
 )
-from sentence_transformers import SentenceTransformer, util
-from spacy.lang.en import stop_words as spacy_stopwords
-from tqdm import tqdm
 
-torch.manual_seed(0)
+# torch, sentence_transformers, nltk and spacy take seconds to import: they are imported by the
+# functions that need them, so that --help or a resumed run whose embeddings are all cached start quickly.
+
 np.random.seed(0)
 
 rich.traceback.install(show_locals=False)
 
-nltk.download("stopwords", quiet=True)
-
 logger = logging.getLogger("eifmap")
 
+# Local NLTK data directory, searched after NLTK_DATA and nltk's own defaults. Corpora are never downloaded at
+# run time, fetch them once with: python -m nltk.downloader -d ~/.cache/parakeet/nltk_data stopwords
+NLTK_DATA_DIR = os.path.join(os.path.expanduser("~"), ".cache", "parakeet", "nltk_data")
+
 
 def md5_hash(text):
     return hashlib.md5(text.encode()).hexdigest()
@@ -62,8 +70,23 @@ def base64_to_uuid(text):
     return "_".join([uuid.UUID(bytes=base64.b64decode(x + "==")).hex for x in text.split(".")])
 
 
+@lru_cache(maxsize=None)
+def get_stop_words():
+    from nltk import data as nltk_data
+    from nltk.corpus import stopwords as nltk_stopwords
+    from spacy.lang.en import stop_words as spacy_stopwords
+
+    if NLTK_DATA_DIR not in nltk_data.path:
+        nltk_data.path.append(NLTK_DATA_DIR)
+    try:
+        return frozenset(spacy_stopwords.STOP_WORDS.union(nltk_stopwords.words("english")))
+    except LookupError:
+        logger.warning(f"NLTK stopwords not found locally, only using the spaCy ones. Fetch them with: python -m nltk.downloader -d {NLTK_DATA_DIR} stopwords")
+        return frozenset(spacy_stopwords.STOP_WORDS)
+
+
 def preprocess_texts(texts):
-    stop_words = spacy_stopwords.STOP_WORDS.union(set(nltk_stopwords.words("english")))
+    stop_words = get_stop_words()
 
     def clean_and_tokenize(text):
         text = re.sub(r"[^\w\s]", " ", text.lower())
@@ -81,6 +104,8 @@ def preprocess_texts(texts):
 
 
 def get_device():
+    import torch
+
     if torch.cuda.is_available():
         device = "cuda"
         logger.info("Using GPU to calculate semantic text embedding ...")
@@ -96,7 +121,8 @@ def get_device():
 class RichProgress:
     def __init__(self, data, disable_progress=False, description="Processing"):
         self.data = data
-        self.total_iterations = len(data)
+        # data can be None when the number of iterations isn't known upfront
+        self.total_iterations = len(data) if data is not None else None
         self.disable_progress = disable_progress
         self.description = description
 
@@ -111,7 +137,7 @@ class RichProgress:
                 TextColumn("[progress.custom] {task.fields[rate]}"),
             )
             self.task: TaskID = self.progress.add_task(
-                f"{self.description} (0/{self.total_iterations})",
+                f"{self.description} (0/{self.total_iterations or '?'})",
                 total=self.total_iterations,
                 rate="",
             )
@@ -143,7 +169,7 @@ class RichProgress:
                 self.task,
                 advance=advance,
                 rate=rate,
-                description=f"{self.description} ({completed}/{self.total_iterations})",
+                description=f"{self.description} ({completed}/{self.total_iterations or '?'})",
             )
 
         self.last_update_time = current_time
@@ -163,10 +189,18 @@ def setup_logging(filename="debug.log"):
     logger.addHandler(shell_handler)
     logger.addHandler(file_handler)
 
-# This ecoinvent_file is the public one (unlicensed). For Parakeet we used the licensed dataset.
-def get_ecoinvent_data(ecoinvent_file="https://19913970.fs1.hubspotusercontent-na1.net/hubfs/19913970/Database-Overview-for-ecoinvent-v3.9.1-9.xlsx"):
-    res = requests.get(ecoinvent_file)
-    excel_data = pd.ExcelFile(res.content, engine='openpyxl')
+def read_source(path):
+    # Raw bytes of a local file or a URL
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read()
+    res = requests.get(path)
+    res.raise_for_status()
+    return res.content
+
+
+def parse_ecoinvent_data(content):
+    excel_data = pd.ExcelFile(BytesIO(content), engine='openpyxl')
     eco_df = pd.read_excel(excel_data, sheet_name=2)
     eco_df = eco_df.rename(
         columns={
@@ -178,11 +212,14 @@ def get_ecoinvent_data(ecoinvent_file="https://19913970.fs1.hubspotusercontent-n
         )
     return eco_df
 
-def get_naics_data(
-    useeio_file="https://pasteur.epa.gov/uploads/10.23719/1528686/SupplyChainGHGEmissionFactors_v1.2_NAICS_CO2e_USD2021.csv",
-    naics_file="https://www.census.gov/naics/2017NAICS/2017_NAICS_Index_File.xlsx",
-):
-    useeio_df = pd.read_csv(useeio_file)
+
+# This ecoinvent_file is the public one (unlicensed). For Parakeet we used the licensed dataset.
+def get_ecoinvent_data(ecoinvent_file="https://19913970.fs1.hubspotusercontent-na1.net/hubfs/19913970/Database-Overview-for-ecoinvent-v3.9.1-9.xlsx"):
+    return parse_ecoinvent_data(read_source(ecoinvent_file))
+
+
+def parse_naics_data(useeio_content, naics_content):
+    useeio_df = pd.read_csv(BytesIO(useeio_content))
     useeio_df = useeio_df[
         [
             "2017 NAICS Code",
@@ -199,22 +236,75 @@ def get_naics_data(
             "Reference USEEIO Code": "bea_code",
         }
     )
-    logger.info(f"Loaded {useeio_df.shape[0]} rows from {useeio_file}")
+    logger.info(f"Loaded {useeio_df.shape[0]} USEEIO rows")
 
-    naics_df = pd.read_excel(naics_file)
+    naics_df = pd.read_excel(BytesIO(naics_content))
     naics_df = naics_df.rename(
         columns={
             "NAICS17": "naics_code",
             "INDEX ITEM DESCRIPTION": "naics_desc",
         }
     )
-    logger.info(f"Loaded {naics_df.shape[0]} rows from {naics_file}")
+    logger.info(f"Loaded {naics_df.shape[0]} NAICS index rows")
     naics_df = naics_df.merge(useeio_df, on="naics_code", how="left").dropna()
     naics_df = naics_df.groupby("naics_desc").first().reset_index()
     logger.info(f"Final shape after merge on naics_code: {naics_df.shape}")
     return naics_df
 
 
+def get_naics_data(
+    useeio_file="https://pasteur.epa.gov/uploads/10.23719/1528686/SupplyChainGHGEmissionFactors_v1.2_NAICS_CO2e_USD2021.csv",
+    naics_file="https://www.census.gov/naics/2017NAICS/2017_NAICS_Index_File.xlsx",
+):
+    return parse_naics_data(read_source(useeio_file), read_source(naics_file))
+
+
+def topk_cosine(query_embedding, ref_embedding, k, block_size=1024):
+    # The reference embeddings may come wrapped in one of the ann_index indexes
+    if hasattr(ref_embedding, "search"):
+        return ref_embedding.search(query_embedding, k)
+    import torch
+    from sentence_transformers import util
+
+    # Score the queries block by block so the (queries x references) matrix never has to be held at once,
+    # and only keep the k best references per query instead of sorting the full row.
+    k = min(k, len(ref_embedding))
+    top_scores, top_indices = [], []
+    for i in range(0, len(query_embedding), block_size):
+        cosine_scores = util.cos_sim(query_embedding[i : i + block_size], ref_embedding)
+        # One more than k, to tell whether the k-th score is tied with references that were left out
+        scores, indices = torch.topk(cosine_scores, min(k + 1, len(ref_embedding)), dim=1, largest=True, sorted=True)
+        scores, indices = scores.cpu().numpy(), indices.cpu().numpy()
+        # topk leaves the order of tied scores unspecified, order them like a stable descending sort
+        order = np.lexsort((indices, -scores), axis=1)
+        scores, indices = np.take_along_axis(scores, order, axis=1), np.take_along_axis(indices, order, axis=1)
+        tied = scores[:, k] == scores[:, k - 1] if scores.shape[1] > k else np.zeros(len(scores), dtype=bool)
+        scores, indices = scores[:, :k], indices[:, :k]
+        # topk kept any of the references tied with the k-th score, a stable sort keeps the first ones
+        for row in np.flatnonzero(tied):
+            row_scores = cosine_scores[row].cpu().numpy()
+            indices[row] = np.argsort(-row_scores, kind="stable")[:k]
+            scores[row] = row_scores[indices[row]]
+        top_scores.append(scores)
+        top_indices.append(indices)
+    return np.concatenate(top_scores), np.concatenate(top_indices)
+
+
+def format_ranked_list(eco_ix, scores, eco_df, eco_ref, lca_type):
+    # Create a ranked list for collecting ground truth
+    if lca_type == "process":
+        topK_df = pd.DataFrame(eco_ref[eco_ix], columns=["reference_product"]).copy(deep=True).reset_index()  
+        topK_df["cosine_score"] = scores
+        ranked_list = topK_df.reset_index()[["index", "reference_product"]].to_dict("records")  
+        topK_df = topK_df.reset_index()[["index", "reference_product", "cosine_score"]]
+    else:
+        topK_df = eco_df.loc[eco_ix].copy(deep=True).reset_index()
+        topK_df["cosine_score"] = scores
+        ranked_list = topK_df[["index", "naics_title", "naics_desc", "naics_code"]].to_dict("records")
+
+    return ranked_list, topK_df
+
+
 def get_ranked_list(
     text,
     semantic_text_model,
@@ -222,34 +312,48 @@ def get_ranked_list(
     eco_ref,
     eco_ref_embedding,
     lca_type,
+    k=None,
+    search_lock=None,
 ):
     activity_embedding = semantic_text_model.encode([text], show_progress_bar=False, batch_size=1)
     
-    k = 10 if lca_type == "process" else 20
-    cosine_scores = util.cos_sim(activity_embedding, eco_ref_embedding) 
-    sorted_cs, indices = cosine_scores.sort(dim=1, descending=True)
-    topK_sbert = indices.squeeze().numpy()[:k].tolist()
-    eco_ix = topK_sbert
+    if k is None:
+        k = 10 if lca_type == "process" else 20
+    with search_lock or nullcontext():
+        scores, indices = topk_cosine(activity_embedding, eco_ref_embedding, k)
+    # Approximate indexes may return fewer than k references, padded with -1
+    found = indices[0] >= 0
+    return format_ranked_list(indices[0][found].tolist(), scores[0][found], eco_df, eco_ref, lca_type)
 
-    # Create a ranked list for collecting ground truth
-    if lca_type == "process":
-        topK_df = pd.DataFrame(eco_ref[eco_ix], columns=["reference_product"]).copy(deep=True).reset_index()  
-        topK_df["cosine_score"] = sorted_cs.squeeze().numpy()[:k]
-        ranked_list = topK_df.reset_index()[["index", "reference_product"]].to_dict("records")  
-        topK_df = topK_df.reset_index()[["index", "reference_product"]]
-    else:
-        topK_df = eco_df.loc[eco_ix].copy(deep=True).reset_index()
-        topK_df["cosine_score"] = sorted_cs.squeeze().numpy()[:k]
-        ranked_list = topK_df[["index", "naics_title", "naics_desc", "naics_code"]].to_dict("records")
 
-    return ranked_list, topK_df
+def get_ranked_lists(
+    texts,
+    semantic_text_model,
+    eco_df,
+    eco_ref,
+    eco_ref_embedding,
+    lca_type,
+    batch_size=64,
+    block_size=1024,
+    k=None,
+    search_lock=None,
+):
+    """Batched counterpart of `get_ranked_list`, returns one (ranked_list, topK_df) pair per text."""
+    activity_embedding = semantic_text_model.encode(list(texts), show_progress_bar=False, batch_size=batch_size)
+
+    if k is None:
+        k = 10 if lca_type == "process" else 20
+    with search_lock or nullcontext():
+        scores, indices = topk_cosine(activity_embedding, eco_ref_embedding, k, block_size=block_size)
+    found = indices >= 0
+    return [format_ranked_list(indices[i][found[i]].tolist(), scores[i][found[i]], eco_df, eco_ref, lca_type) for i in range(len(texts))]
 
 
 def prepare_eio_json(entry, clean_text, response, uniq_id):
     if len(response) < 1:
         error_message = "Response length must be greater than 1."
         raise ValueError(error_message)
-    gt_json = eio_groundtruth_json
+    gt_json = deepcopy(eio_groundtruth_json)
     gt_json["source"] = "*Business Activity*: {}\n".format(re.sub(r"[^\w\s]", "", entry))
     gt_json["source"] += f"*AI paraphrased description:* {clean_text}\n\n"
 
@@ -278,7 +382,7 @@ def prepare_eio_json(entry, clean_text, response, uniq_id):
 
 
 def prepare_process_json(activity_text, response, sel_eco, uniq_id):
-    gt_json = process_groundtruth_json
+    gt_json = deepcopy(process_groundtruth_json)
     gt_json["source"] = "*Given description:* {}\n".format(re.sub(r"[^\w\s]", "", activity_text))
 
     gt_json["source"] += "\n*AI top choice:* {}\n".format(response[0]["impact_factor_name"])
@@ -317,7 +421,7 @@ def read_activities(
     if file_extension == ".csv":
         activity_df = pd.read_csv(activity_file)
     elif file_extension == ".xlsx":
-        activity_df = pd.read_excel(activity_file)
+        activity_df = pd.read_excel(activity_file, sheet_name=sheet_name)
     else:
         error_message = f"Unsupported file extension: {file_extension}"
         raise ValueError(error_message)
@@ -339,10 +443,196 @@ def read_activities(
     return sliced_df, activity_df
 
 
-class CohereEmbedding:  
-    def __init__(self, model_id) -> None:
-        self.co = cohere_aws.Client(mode=cohere_aws.Mode.BEDROCK, region_name="us-west-2")
+def _parquet_chunks(activity_file, start_idx, end_idx, chunk_size):
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(activity_file)
+    row_groups, first_row = [], 0
+    for i in range(parquet_file.num_row_groups):
+        n_rows = parquet_file.metadata.row_group(i).num_rows
+        # Row groups that end before start_idx are never read
+        if first_row + n_rows > start_idx and (end_idx is None or first_row < end_idx):
+            if not row_groups:
+                skip = start_idx - first_row
+            row_groups.append(i)
+        first_row += n_rows
+    if not row_groups:
+        return
+    remaining = None if end_idx is None else end_idx - start_idx
+    for batch in parquet_file.iter_batches(batch_size=chunk_size, row_groups=row_groups):
+        # Integer columns with nulls stay integers, instead of becoming floats in the batches that have nulls
+        df = batch.to_pandas(integer_object_nulls=True)
+        if skip > 0:
+            df, skip = df.iloc[skip:], max(0, skip - len(df))
+        if remaining is not None:
+            df = df.iloc[:remaining]
+            remaining -= len(df)
+        if len(df) > 0:
+            yield df
+        if remaining == 0:
+            return
+
+
+def _jsonl_chunks(activity_file, start_idx, end_idx, chunk_size, dtype=None):
+    columns = None
+    with open(activity_file, "r") as f:
+        # Lines before start_idx are skipped without being parsed
+        lines = (line for line in islice(f, start_idx, end_idx))
+        while True:
+            records = [json.loads(line) for line in islice(lines, chunk_size) if line.strip()]
+            if not records:
+                return
+            df = pd.DataFrame(records, dtype=dtype)
+            # Keep the columns of the first chunk, keys missing from a record become empty values
+            columns = df.columns if columns is None else columns
+            yield df.reindex(columns=columns)
+
+
+def iter_activity_chunks(
+    activity_file,
+    activity_col,
+    start_idx=0,
+    end_idx=None,
+    chunk_size=10_000,
+    sheet_name=0,
+    dtype=str,
+):
+    """Stream the activities of rows start_idx:end_idx of a .csv, .parquet, .jsonl or .xlsx file in chunks.
+
+    Yields (sliced_df, activity_df) pairs like `read_activities`, indexed by row number in the file. Unlike
+    `read_activities`, rows are never de-duplicated across the file and start_idx/end_idx count the rows of
+    the file itself. Spreadsheets can't be streamed and are read whole before being chunked.
+
+    pandas would infer the dtypes of every chunk on its own, so values aren't inferred: CSV columns are read
+    with `dtype`, as written in the file by default, JSONL values are those of the JSON and Parquet values
+    those of the file's schema. The rendered activities and their ids don't depend on the chunk size or on
+    the rows of a shard, but numbers of a CSV stay as written where `read_activities` parses them.
+    """
+    logger.info(f"Streaming {activity_file} in chunks of {chunk_size} rows, from index {start_idx} to {end_idx}")
+    _, file_extension = os.path.splitext(activity_file)
+    if file_extension == ".csv":
+        chunks = pd.read_csv(
+            activity_file,
+            skiprows=lambda i: 0 < i <= start_idx,
+            nrows=None if end_idx is None else max(0, end_idx - start_idx),
+            chunksize=chunk_size,
+            dtype=dtype,
+        )
+    elif file_extension == ".parquet":
+        chunks = _parquet_chunks(activity_file, start_idx, end_idx, chunk_size)
+    elif file_extension == ".jsonl":
+        # Built as objects, so the values of a chunk aren't upcast to a dtype of the chunk
+        chunks = _jsonl_chunks(activity_file, start_idx, end_idx, chunk_size, dtype=object)
+    elif file_extension == ".xlsx":
+        activity_df = pd.read_excel(activity_file, sheet_name=sheet_name).fillna("").iloc[start_idx:end_idx]
+        chunks = (activity_df.iloc[i : i + chunk_size] for i in range(0, len(activity_df), chunk_size))
+    else:
+        error_message = f"Unsupported file extension: {file_extension}"
+        raise ValueError(error_message)
+
+    first_row = start_idx
+    for activity_df in chunks:
+        if file_extension != ".xlsx":
+            # Every chunk has object columns, whichever of them have missing values
+            activity_df = activity_df.astype(object).fillna("")
+        activity_df.index = pd.RangeIndex(first_row, first_row + len(activity_df))
+        first_row += len(activity_df)
+        if activity_col == "auto":
+            columns = activity_df.columns.to_list()
+        else:
+            columns = ast.literal_eval(activity_col)
+        yield activity_df[columns], activity_df
+
+
+def activity_records(df):
+    """`df.iloc[i].to_dict()` for every row: values are upcast to the common dtype of the columns like a row is."""
+    dtype = df.iloc[:0].to_numpy().dtype
+    if dtype != object:
+        df = df.astype(dtype)
+    return df.to_dict("records")
+
+
+def activity_ids(df):
+    return [md5_hash_base64(json.dumps(record)) for record in activity_records(df)]
+
+
+def render_activities(df):
+    """`df.iloc[i].to_string()` without a column width limit for every row, as fed to the prompts.
+
+    Frames of strings are rendered with column-wise string operations: names are left-justified, followed by
+    four spaces and the values right-justified to the longest value of their row. Other frames go row by row.
+    """
+    names = [str(x) for x in df.columns]
+    escapes = [("\t", "\\t"), ("\n", "\\n"), ("\r", "\\r")]
+    is_plain = len(names) > 0 and not any(c in x for x in names for c, _ in escapes) and not df.columns.duplicated().any()
+    if not is_plain or not all(pd.api.types.infer_dtype(df[col], skipna=False) == "string" for col in df.columns):
+        with pd.option_context("display.max_colwidth", None):
+            return [row.to_string() for _, row in df.iterrows()]
+    if len(df) == 0:
+        return []
+
+    values = []
+    for col in df.columns:
+        value = df[col]
+        for char, escaped in escapes:
+            value = value.str.replace(char, escaped, regex=False)
+        values.append(value.reset_index(drop=True))
+    lengths = [x.str.len() for x in values]
+    width = pd.concat(lengths, axis=1).max(axis=1)
+    name_width = max(len(x) for x in names)
+    lines = [x.ljust(name_width) + "    " + pd.Series(" ", index=value.index) * (width - length) + value for x, value, length in zip(names, values, lengths)]
+    rendered = lines[0]
+    for line in lines[1:]:
+        rendered = rendered + "\n" + line
+    return rendered.to_list()
+
+
+class CohereEmbedding:
+    """Cohere embedding model on Bedrock.
+
+    Texts are sent in batches of at most `MAX_BATCH_SIZE`, up to `concurrency` batches at a time through an
+    AdaptiveRateLimiter that retries throttled batches with backoff, the `rate_limiter` of the process when it
+    shares its Bedrock quota with other calls. The embeddings come back in the order of the texts. With a `store`, texts embedded before are read from it and never sent again.
+    """
+
+    # Most texts per request accepted by the Cohere embed models on Bedrock
+    MAX_BATCH_SIZE = 96
+
+    def __init__(self, model_id, concurrency=8, store=None, client=None, rate_limiter=None, endpoint_url=None) -> None:
+        if client is None:
+            from assistant import get_bedrock_client
+
+            client = get_bedrock_client(region="us-west-2", max_pool_connections=max(10, concurrency), max_attempts=1, endpoint_url=endpoint_url)
+        self.client = client
         self.model_id = model_id
+        self.concurrency = concurrency
+        if rate_limiter is None:
+            rate_limiter = AdaptiveRateLimiter(max_concurrency=concurrency)
+        self.rate_limiter = rate_limiter
+        self.store = store
+        # The store's SQLite connection is shared by the threads calling encode
+        self.store_lock = threading.Lock()
+
+    def _embed_batch(self, texts):
+        def invoke():
+            response = self.client.invoke_model(body=json.dumps({"texts": texts, "input_type": "clustering"}), modelId=self.model_id)
+            return json.loads(response.get("body").read())["embeddings"]
+
+        embeddings = np.array(self.rate_limiter.call(invoke))
+        if embeddings.shape[0] != len(texts):
+            error_message = "Mismatch in embedding size"
+            raise ValueError(error_message)
+        return embeddings
+
+    def _embed(self, texts, batch_size, show_progress_bar):
+        batch_size = min(max(batch_size, 1), self.MAX_BATCH_SIZE)
+        batches = [texts[i : i + batch_size] for i in range(0, len(texts), batch_size)]
+        if len(batches) == 1:
+            return self._embed_batch(batches[0])
+        from tqdm import tqdm
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return np.concatenate(list(tqdm(executor.map(self._embed_batch, batches), total=len(batches), disable=not show_progress_bar)))
 
     def encode(self, data: pd.Series | list, *, show_progress_bar=False, batch_size=32):  
         if isinstance(data, pd.Series):
@@ -353,38 +643,73 @@ class CohereEmbedding:
         if not isinstance(data, list):
             error_message = "Input must be a list of strings"
             raise TypeError(error_message)
-        if batch_size > 1:
-            eco_ref_embedding = []
-            for i in tqdm(range(0, len(data), batch_size), disable=False):
-                eco_ref_embedding.append(np.array(self.co.embed(texts=data[i : min(len(data), i + batch_size)], input_type="clustering", model_id=self.model_id).embeddings))  # noqa: PERF401
-            eco_ref_embedding = np.concatenate(eco_ref_embedding)
-            if eco_ref_embedding.shape[0] != len(data):
-                error_message = "Mismatch in embedding size"
-                raise ValueError(error_message)
-            return eco_ref_embedding
-        return np.array(self.co.embed(texts=data, input_type="clustering", model_id=self.model_id).embeddings)
-
-
-def get_cached_embedding(eco_ref, embedding):
+        if self.store is None:
+            return self._embed(data, batch_size, show_progress_bar)
+
+        texts = [str(x) for x in data]
+        with self.store_lock:
+            rows = self.store.lookup(texts)
+        missing = list(dict.fromkeys(x for x, row in zip(texts, rows) if row < 0))
+        if missing:
+            embeddings = self._embed(missing, batch_size, show_progress_bar)
+            with self.store_lock:
+                self.store.add(missing, embeddings)
+        with self.store_lock:
+            return self.store.get(texts)
+
+
+class LazySentenceTransformer:
+    """SentenceTransformer loaded on the first `encode`: a run whose embeddings all come from the caches never
+    imports torch."""
+
+    def __init__(self, model_id):
+        self.model_id = model_id
+        self.model = None
+        self.lock = threading.Lock()
+
+    def encode(self, *args, **kwargs):
+        with self.lock:
+            if self.model is None:
+                import torch
+                from sentence_transformers import SentenceTransformer
+
+                torch.manual_seed(0)
+                device = get_device()
+                self.model = SentenceTransformer(self.model_id, device=device)
+                # CUDA graphs only pay off on a GPU, on CPU the compilation is pure startup cost
+                if device == "cuda":
+                    self.model = torch.compile(self.model, mode="reduce-overhead")
+        return self.model.encode(*args, **kwargs)
+
+
+def embedding_store_id(embedding, backend="torch"):
+    # The ONNX backends don't reproduce the torch embeddings exactly, they are stored apart
+    return embedding if backend == "torch" else f"{embedding}@{backend}"
+
+
+def get_cached_embedding(
+    eco_ref, embedding, cache_dir=None, max_entries=1_000_000, concurrency=8, endpoint_url=None, rate_limiter=None, backend="torch", intra_op_threads=None
+):
     
     if embedding.startswith("cohere"):
+        if backend != "torch":
+            error_message = f"The {backend} encoder backend only applies to local SentenceTransformer models, not to {embedding}."
+            raise ValueError(error_message)
         logger.info("Using Cohere model from BedRock for semantic text embedding ...")
-        semantic_text_model = CohereEmbedding(embedding)
+        semantic_text_model = CohereEmbedding(embedding, concurrency=concurrency, rate_limiter=rate_limiter, endpoint_url=endpoint_url)
+    elif backend == "torch":
+        semantic_text_model = LazySentenceTransformer(embedding)
     else:
-        semantic_text_model = SentenceTransformer(embedding, device=get_device())
-        semantic_text_model = torch.compile(semantic_text_model, mode="reduce-overhead")
-
-    cache_id = md5_hash(f"{embedding}+{str(eco_ref.tolist())!s}")
-    cache_file = f"/tmp/{cache_id}.pt"
-    if os.path.exists(cache_file):
-        logger.info("Loading cached embeddings")
-        eco_ref_embedding = torch.load(cache_file)
+        logger.info(f"Using the {backend} ONNX Runtime backend for semantic text embedding ...")
+        semantic_text_model = OnnxEncoder(embedding, quantize=backend == "onnx-int8", intra_op_threads=intra_op_threads)
+
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "parakeet", "embeddings")
+    embedding_store = EmbeddingStore(cache_dir, embedding_store_id(embedding, backend), max_entries=max_entries)
+    eco_ref_embedding = embedding_store.encode(eco_ref, semantic_text_model, batch_size=32)
+    if isinstance(semantic_text_model, CohereEmbedding):
+        # Every Bedrock call costs a round trip: the activity texts go through the store as well
+        semantic_text_model.store = embedding_store
     else:
-        logger.info("Encoding embedding")
-        eco_ref_embedding = semantic_text_model.encode(
-            eco_ref,
-            show_progress_bar=True,
-            batch_size=32,
-        )
-        torch.save(eco_ref_embedding, cache_file)
+        embedding_store.close()
     return semantic_text_model, eco_ref_embedding
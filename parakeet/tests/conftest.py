@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of parakeet/src import each other as top-level modules, like the scripts run from there
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
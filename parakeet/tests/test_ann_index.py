@@ -0,0 +1,16 @@
+import numpy as np
+import pytest
+
+from ann_index import topk_rows
+
+
+@pytest.mark.parametrize("k", [1, 3, 10, 30])
+def test_topk_rows_is_a_stable_sort(k):
+    rng = np.random.default_rng(0)
+    # Few distinct scores, so ties cross the k-th position
+    scores = rng.integers(0, 4, size=(20, 25)).astype(np.float32)
+    ids = np.stack([rng.permutation(100)[:25] for _ in range(len(scores))])
+    top_scores, top_ids = topk_rows(scores, k, ids=ids)
+    order = np.lexsort((ids, -scores), axis=1)[:, :k]
+    np.testing.assert_array_equal(top_ids, np.take_along_axis(ids, order, axis=1))
+    np.testing.assert_array_equal(top_scores, np.take_along_axis(scores, order, axis=1))
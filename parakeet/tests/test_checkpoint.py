@@ -0,0 +1,41 @@
+from checkpoint import CheckpointStore
+
+
+def write_activity(store, jsonfile, csvfile, uniq_id, n_rows):
+    jsonfile.write(f'{{"formConfig": {{"fields": [{{"id": "{uniq_id}"}}]}}}}\n')
+    if not store.csv_has_header:
+        csvfile.write("id,value\n")
+    for i in range(n_rows):
+        csvfile.write(f"{uniq_id},{i}\n")
+
+
+def test_resume_discards_uncommitted_writes(tmp_path):
+    output_file = str(tmp_path / "out")
+    store = CheckpointStore(output_file)
+    with open(output_file + ".jsonl", "a") as jsonfile, open(output_file + ".csv", "a") as csvfile:
+        write_activity(store, jsonfile, csvfile, "a", 2)
+        store.commit("a", 2, result={"id": "a", "value": 0}, files=[jsonfile, csvfile])
+        # Interrupted before its commit
+        write_activity(store, jsonfile, csvfile, "b", 1)
+    store.close()
+
+    store = CheckpointStore(output_file)
+    assert store.n_rows == {"a": 2}
+    assert store.result("a") == {"id": "a", "value": 0}
+    with open(output_file + ".csv") as f:
+        assert f.read() == "id,value\na,0\na,1\n"
+    with open(output_file + ".jsonl") as f:
+        assert f.read().count("\n") == 1
+    store.close()
+
+
+def test_indexes_outputs_written_without_a_checkpoint(tmp_path):
+    output_file = str(tmp_path / "out")
+    with open(output_file + ".jsonl", "w") as f:
+        f.write('{"formConfig": {"fields": [{"id": "a"}]}}\n{"formConfig": {"fields": [{"id": "b"}]}}\n')
+    with open(output_file + ".csv", "w") as f:
+        f.write("id,value\na,0\nb,1\nb,2\n")
+    store = CheckpointStore(output_file)
+    assert store.n_rows == {"a": 1, "b": 2}
+    assert store.result("b") == {"id": "b", "value": 1}
+    store.close()
@@ -0,0 +1,29 @@
+import pytest
+
+from output_repair import parse_literal
+
+
+def test_valid_literal():
+    assert parse_literal("[{'index': 3, 'reference_product': 'maize grain'}]") == [{"index": 3, "reference_product": "maize grain"}]
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "Here are the matches:\n```python\n[{'index': 3, 'ok': True}]\n```",
+        "[{“index”: 3, “ok”: True}]",
+        '[{"index": 3, "ok": true}]',
+        "[{'index': 3, 'ok': True},]",
+    ],
+)
+def test_repairs(text):
+    assert parse_literal(text) == [{"index": 3, "ok": True}]
+
+
+def test_repairs_leave_strings_alone():
+    assert parse_literal("[{'text': 'true, null,]'},]") == [{"text": "true, null,]"}]
+
+
+def test_unrepairable():
+    with pytest.raises((SyntaxError, ValueError)):
+        parse_literal("[{'index': 3, 'justification': 'unterminated}]")
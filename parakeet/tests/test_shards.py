@@ -0,0 +1,35 @@
+import json
+
+from shards import merge_shards, shard_output_file
+
+
+def write_shard(output_file, shard_index, num_shards, rows):
+    shard_output = shard_output_file(output_file, shard_index, num_shards)
+    with open(shard_output + ".csv", "w") as f:
+        f.write("id,row\n" + "".join(f"{uniq_id},{row}\n" for uniq_id, row in rows))
+    with open(shard_output + ".jsonl", "w") as f:
+        for uniq_id in dict.fromkeys(uniq_id for uniq_id, _ in rows):
+            f.write(json.dumps({"formConfig": {"fields": [{"id": uniq_id}]}}) + "\n")
+
+
+def test_merge_follows_input_order(tmp_path):
+    output_file = str(tmp_path / "out")
+    # Shards write their activities in their own order, "b" twice as it occurs twice in the input
+    write_shard(output_file, 0, 2, [("c", "c0"), ("a", "a0"), ("a", "a1")])
+    write_shard(output_file, 1, 2, [("b", "b0"), ("b", "b1")])
+    activity_shards = [("a", 0), ("b", 1), ("c", 0), ("b", 1), ("a", 0)]
+    merge_shards(output_file, 2, iter(activity_shards))
+
+    with open(output_file + ".csv") as f:
+        assert f.read() == "id,row\na,a0\na,a1\nb,b0\nb,b1\nc,c0\n"
+    with open(output_file + ".jsonl") as f:
+        assert [json.loads(line)["formConfig"]["fields"][0]["id"] for line in f] == ["a", "b", "c"]
+
+
+def test_merge_skips_unmapped_activities(tmp_path):
+    output_file = str(tmp_path / "out")
+    write_shard(output_file, 0, 2, [("a", "a0")])
+    write_shard(output_file, 1, 2, [])
+    merge_shards(output_file, 2, iter([("a", 0), ("b", 1)]))
+    with open(output_file + ".csv") as f:
+        assert f.read() == "id,row\na,a0\n"
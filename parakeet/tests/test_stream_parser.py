@@ -0,0 +1,50 @@
+import pytest
+
+from stream_parser import IncrementalLiteralParser, StreamParseError
+
+RESPONSE = "Sure:\n[{'index': 7, 'justification': 'popcorn, [maize]'}, {'index': 4, 'justification': \"it's maize\"}]\nDone."
+
+
+def feed(parser, text, size):
+    for i in range(0, len(text), size):
+        if parser.feed(text[i : i + size]):
+            return True
+    return False
+
+
+@pytest.mark.parametrize("size", [1, 3, 1000])
+def test_parses_in_any_chunks(size):
+    parser = IncrementalLiteralParser()
+    assert feed(parser, RESPONSE, size)
+    assert parser.value == [{"index": 7, "justification": "popcorn, [maize]"}, {"index": 4, "justification": "it's maize"}]
+    assert parser.text[: parser.end].endswith("}]")
+
+
+def test_not_done_before_the_literal_closes():
+    parser = IncrementalLiteralParser()
+    assert not parser.feed(RESPONSE[:40])
+    assert not parser.done
+
+
+def test_validation_fails_on_the_first_invalid_element():
+    def validation_fn(elements):
+        if elements[-1]["index"] != 7:
+            raise ValueError(f"Invalid index {elements[-1]['index']}")
+
+    parser = IncrementalLiteralParser(validation_fn)
+    with pytest.raises(ValueError, match="Invalid index 4"):
+        feed(parser, RESPONSE, 5)
+    assert not parser.done
+
+
+def test_long_preamble():
+    with pytest.raises(StreamParseError):
+        IncrementalLiteralParser().feed("x" * 1000 + "[1]")
+
+
+def test_reset():
+    parser = IncrementalLiteralParser()
+    parser.feed("[{'index': 1}, {'ind")
+    parser.reset()
+    assert parser.feed("[2]")
+    assert parser.value == [2]
@@ -0,0 +1,56 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import activity_ids, md5_hash_base64, topk_cosine
+
+
+def sorted_topk(query_embedding, ref_embedding, k):
+    # The full sort of the scores of every query that topk_cosine replaces, with ties in reference order
+    import torch
+    from sentence_transformers import util
+
+    scores, indices = [], []
+    for query in query_embedding:
+        query_scores, query_indices = util.cos_sim(torch.from_numpy(query[None]), torch.from_numpy(ref_embedding)).sort(dim=1, descending=True, stable=True)
+        scores.append(query_scores[0, :k].numpy())
+        indices.append(query_indices[0, :k].numpy())
+    return np.array(scores), np.array(indices)
+
+
+def sparse_signs(rng, n, dim=8):
+    # Four entries of +-1: normalized entries are +-0.5 and every cosine is exact, so ties are real ties
+    embeddings = np.zeros((n, dim), dtype=np.float32)
+    for row in embeddings:
+        row[rng.choice(dim, 4, replace=False)] = rng.choice([-1.0, 1.0], 4)
+    return embeddings
+
+
+@pytest.mark.parametrize("k", [1, 5, 40])
+@pytest.mark.parametrize("ties", [False, True])
+def test_topk_cosine_matches_sort(k, ties):
+    rng = np.random.default_rng(0)
+    if ties:
+        ref_embedding, query_embedding = sparse_signs(rng, 35), sparse_signs(rng, 10)
+    else:
+        ref_embedding, query_embedding = rng.normal(size=(35, 8)).astype(np.float32), rng.normal(size=(10, 8)).astype(np.float32)
+    scores, indices = topk_cosine(query_embedding, ref_embedding, k, block_size=4)
+    expected_scores, expected_indices = sorted_topk(query_embedding, ref_embedding, min(k, len(ref_embedding)))
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(scores, expected_scores, atol=1e-5)
+
+
+def test_activity_ids_collapse_duplicates():
+    df = pd.DataFrame({"desc": ["paper", "ink", "paper"], "unit": ["kg", "l", "kg"]})
+    ids = activity_ids(df)
+    assert ids[0] == ids[2]
+    assert len(set(ids)) == 2
+
+
+def test_activity_ids_match_the_rows():
+    # Values are upcast to the common dtype of the columns, like df.iloc[i].to_dict()
+    for df in [pd.DataFrame({"code": [1, 2], "price": [1.5, 2.0]}), pd.DataFrame({"desc": ["paper", "ink"], "code": [1, 2]})]:
+        expected = [md5_hash_base64(json.dumps(df.iloc[i].to_dict())) for i in range(len(df))]
+        assert activity_ids(df) == expected